@@ -0,0 +1,53 @@
+"""
+Login throughput of the pin hashing.
+
+    python -m benchmarks.pin_hash [--logins 200] [--n 16384] [--r 8] [--p 1]
+
+Verifies the same pin against a stored hash, first in this process (one
+core), then through the PinHasher process pool with every worker busy, and
+prints logins per second for both and per core for the pool. The legacy
+SHA-256 check is measured for comparison.
+"""
+import os, time, asyncio, argparse
+
+os.environ.setdefault("SALT", "benchmark")
+
+from budgetdiary.pin import PinHasher, PIN_HASH_WORKERS, hash_pin, legacy_hash_pin, verify_pin
+
+def single_core(logins: int, stored: str) -> float:
+    start = time.perf_counter()
+    for _ in range(logins):
+        verify_pin("123456", stored)
+    return logins / (time.perf_counter() - start)
+
+async def pool(logins: int, stored: str, workers: int) -> float:
+    hasher = PinHasher(workers)
+    await hasher.verify("123456", stored)  # start the processes
+    start = time.perf_counter()
+    await asyncio.gather(*[hasher.verify("123456", stored) for _ in range(logins)])
+    return logins / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--n", type=int, default=2 ** 14)
+    parser.add_argument("--r", type=int, default=8)
+    parser.add_argument("--p", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=PIN_HASH_WORKERS)
+    args = parser.parse_args()
+
+    stored = hash_pin("123456", args.n, args.r, args.p)
+    legacy = legacy_hash_pin("123456")
+    print("scrypt n={} r={} p={}, {} MiB per hash".format(
+        args.n, args.r, args.p, 128 * args.n * args.r // 2 ** 20))
+    print("legacy sha256    : {:10.0f} logins/s".format(single_core(args.logins * 100, legacy)))
+
+    one = single_core(args.logins, stored)
+    print("scrypt, 1 core   : {:10.1f} logins/s".format(one))
+
+    many = asyncio.run(pool(args.logins, stored, args.workers))
+    print("scrypt, {} workers: {:10.1f} logins/s, {:.1f} per core".format(
+        args.workers, many, many / args.workers))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Serialization time of a list response.
+
+    python -m benchmarks.response_serialization [--rows 10000] [--runs 20]
+
+Builds Income rows with their category attached, as the controllers return
+them, and serves them from routes of a throwaway app: the generic path
+(jsonable_encoder walking the ORM objects, json.dumps), BaseResponse with
+FastJSONResponse, and BaseResponse with DEFAULT_RESPONSE_CLASS, the one the
+app uses. Prints the median time per response of each and the body size.
+"""
+import time, argparse, statistics
+from datetime import datetime
+from decimal import Decimal
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+from budgetdiary.model.database import Income, IncomeCategory
+from budgetdiary.model.response import BaseResponse, FastJSONResponse, DEFAULT_RESPONSE_CLASS
+
+def build_rows(count: int) -> list:
+    categories = [IncomeCategory(id=i, name="Category {}".format(i), emoticon=None) for i in range(1, 6)]
+    rows = []
+    for i in range(1, count + 1):
+        row = Income(id=i, user_id=1, income_category_id=i % 5 + 1, description="Income {}".format(i),
+                     amount=Decimal("{}.50".format(i % 1000)), date_created=datetime(2024, 1, 1 + i % 28, 10))
+        row.income_category = categories[i % 5]
+        rows.append(row)
+    return rows
+
+def build_app(rows: list) -> FastAPI:
+    app = FastAPI(default_response_class=DEFAULT_RESPONSE_CLASS)
+
+    @app.get("/generic", response_class=JSONResponse)
+    async def generic():
+        # What FastAPI does for content of type Any holding ORM objects
+        return {"status": "Success", "content": rows, "next_after_id": None}
+
+    @app.get("/orjson", response_model=BaseResponse, response_class=FastJSONResponse)
+    async def fast():
+        return BaseResponse(**{"status": "Success", "content": rows})
+
+    @app.get("/app", response_model=BaseResponse)
+    async def default():
+        return BaseResponse(**{"status": "Success", "content": rows})
+
+    return app
+
+def measure(client: TestClient, path: str, runs: int):
+    body = client.get(path).content
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        client.get(path)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), len(body)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    client = TestClient(build_app(build_rows(args.rows)))
+    generic, generic_size = measure(client, "/generic", args.runs)
+    print("{} rows, median of {} responses".format(args.rows, args.runs))
+    print("generic (jsonable_encoder)  : {:8.1f} ms, {} bytes".format(generic * 1000, generic_size))
+    for label, path in (("BaseResponse + orjson      ", "/orjson"),
+                        ("BaseResponse + app default ", "/app")):
+        elapsed, size = measure(client, path, args.runs)
+        print("{}: {:8.1f} ms, {} bytes, {:.1f}x".format(label, elapsed * 1000, size, generic / elapsed))
+
+if __name__ == "__main__":
+    main()
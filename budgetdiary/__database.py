@@ -1,38 +1,671 @@
-import os
+import os, time, asyncio, threading, contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from urllib.parse import quote_plus as urlquote
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
+from typing import List, Optional, Tuple
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, update, delete
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import Session, sessionmaker
 
-engine = create_engine(
-    "mysql+pymysql://{}:{}@{}/{}".format(
+from .utils import Debug, DebugLevel
+from .metrics import METRICS, metrics
+
+# "sync" keeps the blocking pymysql engine, "async" runs the controllers on
+# an asyncio engine (aiomysql) so a slow query no longer stalls the event loop,
+# "thread" runs the blocking controllers on a bounded thread pool
+DB_MODE = os.environ.get("DB_MODE", "sync").lower()
+
+# Pool defaults per deployment profile (DB_PROFILE). "shared" fits the
+# connection limit and wait_timeout of a shared MySQL hosting account.
+# ping_idle is how long (seconds) a connection may sit in the pool before
+# it is checked with a ping on checkout, 0 pings on every checkout.
+POOL_PROFILES = {
+    "shared": {"pool_size": 5, "max_overflow": 5, "pool_recycle": 280,
+               "pool_timeout": 30, "ping_idle": 60},
+    "dedicated": {"pool_size": 20, "max_overflow": 20, "pool_recycle": 3600,
+                  "pool_timeout": 30, "ping_idle": 300},
+    "development": {"pool_size": 2, "max_overflow": 2, "pool_recycle": 280,
+                    "pool_timeout": 10, "ping_idle": 0},
+}
+
+DB_PROFILE = os.environ.get("DB_PROFILE", "shared").lower()
+if DB_PROFILE not in POOL_PROFILES:
+    raise RuntimeError("Unknown DB_PROFILE '{}', expected one of {}".format(
+        DB_PROFILE, ", ".join(POOL_PROFILES)))
+
+def _pool_setting(name: str, env_name: str, cast=int):
+    value = os.environ.get(env_name)
+    return cast(value) if value is not None else POOL_PROFILES[DB_PROFILE][name]
+
+POOL_SIZE = _pool_setting("pool_size", "DB_POOL_SIZE")
+MAX_OVERFLOW = _pool_setting("max_overflow", "DB_MAX_OVERFLOW")
+POOL_RECYCLE = _pool_setting("pool_recycle", "DB_POOL_RECYCLE")
+POOL_TIMEOUT = _pool_setting("pool_timeout", "DB_POOL_TIMEOUT", float)
+PING_IDLE = _pool_setting("ping_idle", "DB_PING_IDLE", float)
+
+# Queue wait (seconds) after which a thread mode call is reported as saturated
+EXECUTOR_WAIT_WARNING = float(os.environ.get("DB_EXECUTOR_WAIT_WARNING", 0.5))
+
+# Rows fetched per round trip when streaming with a server side cursor
+STREAM_YIELD_PER = int(os.environ.get("DB_STREAM_YIELD_PER", 500))
+
+# Seconds a connection may stay checked out before it is reported as a leak
+LEAK_THRESHOLD = float(os.environ.get("DB_LEAK_THRESHOLD", 5))
+
+# Controller method using the database, reported by the leak detection
+_current_method = contextvars.ContextVar("budgetdiary_current_method", default=None)
+
+class PoolMonitor:
+    """
+    Telemetry, leak detection and liveness checks for the connection pool
+    of one engine. Every checkout remembers the controller method that asked
+    for it, so a connection held longer than LEAK_THRESHOLD can be traced
+    back. Only connections that sat idle for more than PING_IDLE seconds are
+    pinged, hot connections skip the extra round trip.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.pool = None
+        self.dialect = None
+        self._lock = threading.Lock()
+        self._held = {}
+        self._last_scan = 0.0
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.pre_ping_failures = 0
+        self.leaks = 0
+
+    def attach(self, engine):
+        self.pool = engine.pool
+        self.dialect = engine.dialect
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+
+    def record_wait(self, wait: float):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def _ping_if_idle(self, dbapi_connection, connection_record):
+        last_checkin = connection_record.info.get("last_checkin")
+        if last_checkin is None or time.monotonic() - last_checkin < PING_IDLE:
+            return
+
+        try:
+            self.dialect.do_ping(dbapi_connection)
+        except Exception as e:
+            with self._lock:
+                self.pre_ping_failures += 1
+            # Makes the pool drop this connection and retry with a new one
+            raise DisconnectionError("Idle connection failed ping: {}".format(e)) from e
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self._ping_if_idle(dbapi_connection, connection_record)
+
+        now = time.perf_counter()
+        with self._lock:
+            self._held[id(connection_record)] = [now, _current_method.get(), False]
+            scan = now - self._last_scan > 1
+            if scan:
+                self._last_scan = now
+                overdue = [held for held in self._held.values()
+                           if not held[2] and now - held[0] > LEAK_THRESHOLD]
+                for held in overdue:
+                    held[2] = True
+                    self.leaks += 1
+        if scan:
+            for since, method, _ in overdue:
+                Debug.msg("PoolMonitor|{}".format(self.name),
+                          "{} has held a connection for {:.1f}s without returning it".format(method, now - since),
+                          DebugLevel.WARNING)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        connection_record.info["last_checkin"] = time.monotonic()
+        with self._lock:
+            held = self._held.pop(id(connection_record), None)
+        if held is None or held[2]:
+            return
+
+        duration = time.perf_counter() - held[0]
+        if duration > LEAK_THRESHOLD:
+            with self._lock:
+                self.leaks += 1
+            Debug.msg("PoolMonitor|{}".format(self.name),
+                      "{} held a connection for {:.1f}s".format(held[1], duration),
+                      DebugLevel.WARNING)
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the pool usage
+        @return: dict of connection counts, checkout wait and failure figures
+        """
+        with self._lock:
+            return {
+                "size": self.pool.size(),
+                "checked_out": self.pool.checkedout(),
+                "overflow": self.pool.overflow(),
+                "checkouts": self.checkouts,
+                "avg_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "max_wait": self.max_wait,
+                "pre_ping_failures": self.pre_ping_failures,
+                "leaks": self.leaks
+            }
+
+sync_pool_monitor = PoolMonitor("sync")
+async_pool_monitor = PoolMonitor("async")
+
+class MeteredQueuePool(QueuePool):
+    """
+    QueuePool timing how long a checkout waits for a free connection
+    """
+    monitor = sync_pool_monitor
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.monitor.record_wait(time.perf_counter() - started)
+
+class MeteredAsyncQueuePool(AsyncAdaptedQueuePool):
+    """
+    AsyncAdaptedQueuePool timing how long a checkout waits for a free connection
+    """
+    monitor = async_pool_monitor
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.monitor.record_wait(time.perf_counter() - started)
+
+def get_database_url(driver: str) -> str:
+    return "mysql+{}://{}:{}@{}/{}".format(
+        driver,
 		os.environ.get("DB_USER"),
 		urlquote(str(os.environ.get("DB_PASS"))),
 		os.environ.get("DB_HOST"),
 		os.environ.get("DB_NAME")
-    ),
-    pool_size=500,
-    max_overflow=500,
+    )
+
+engine = create_engine(
+    get_database_url("pymysql"),
+    poolclass=MeteredQueuePool,
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    pool_timeout=POOL_TIMEOUT,
     echo=False,
-    pool_recycle=280,
-    pool_pre_ping=True
+    pool_recycle=POOL_RECYCLE
 )
+sync_pool_monitor.attach(engine)
 
-@contextmanager
-def get_session():
-    try:
-        session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = None
+AsyncSessionFactory = None
+if DB_MODE == "async":
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+    async_engine = create_async_engine(
+        get_database_url("aiomysql"),
+        poolclass=MeteredAsyncQueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        echo=False,
+        pool_recycle=POOL_RECYCLE
+    )
+    async_pool_monitor.attach(async_engine.sync_engine)
+    AsyncSessionFactory = sessionmaker(
+        bind=async_engine,
+        class_=AsyncSession,
+        autoflush=False,
+        expire_on_commit=False
+    )
 
-        Session = scoped_session(session_factory)
+SessionFactory = sessionmaker(autocommit=False, autoflush=False,
+                              expire_on_commit=False, bind=engine)
 
-        session = Session()
+def after_commit(session, callback):
+    """
+    Run callback once the transaction of session is committed, or forget it
+    when the transaction is rolled back. Caches derived from the database use
+    it so they never see a write that may still be rolled back.
+    @param session: Session (or the sync session of an AsyncSession) of the write
+    @param callback: Function called without argument
+    """
+    session.info.setdefault("after_commit", []).append(callback)
 
+@event.listens_for(Session, "after_flush")
+def _mark_flush(session, flush_context):
+    session.info["writes"] = True
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["writes"] = True
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(session):
+    session.info.pop("writes", None)
+    for callback in session.info.pop("after_commit", []):
+        try:
+            callback()
+        except Exception as e:
+            Debug.msg("Database|after_commit",
+                      "Callback {} failed: {}".format(callback, e),
+                      DebugLevel.ERROR)
+
+@event.listens_for(Session, "after_rollback")
+def _drop_after_commit(session):
+    session.info.pop("after_commit", None)
+    session.info.pop("writes", None)
+
+# Session shared by the controller calls of the request being handled
+_request_scope = contextvars.ContextVar("budgetdiary_request_scope", default=None)
+
+def request_has_writes() -> bool:
+    """
+    Whether the request being handled has written in its transaction, its
+    reads must then see those writes and can not be shared with others
+    @return: bool
+    """
+    request_scope = _request_scope.get()
+    session = request_scope.session if request_scope is not None else None
+    return session is not None and bool(session.info.get("writes"))
+
+@contextmanager
+def get_session(method: str = None):
+    """
+    Session for scripts and generators, closed when the block ends
+    @param method: Name reported by the leak detection for this session
+    """
+    session = SessionFactory()
+    try:
+        if method:
+            # Check the connection out now, generators may resume in another context
+            token = _current_method.set(method)
+            try:
+                session.connection()
+            finally:
+                _current_method.reset(token)
         yield session
     except Exception as e:
         session.rollback()
+        raise
+    finally:
         session.close()
+
+@asynccontextmanager
+async def get_async_session():
+    """
+    Async counterpart of get_session, only available when DB_MODE is "async"
+    """
+    if AsyncSessionFactory is None:
+        raise RuntimeError("Async session requested but DB_MODE is '{}'".format(DB_MODE))
+
+    async with AsyncSessionFactory() as session:
+        try:
+            yield session
+        except Exception:
+            await session.rollback()
+            raise
+
+class DatabaseExecutor:
+    """
+    Size limited thread pool for the blocking controller bodies. It keeps
+    track of how many calls are waiting for a worker and how long they
+    waited, so saturation shows up before the latency does.
+    """
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                                        thread_name_prefix="budgetdiary-db")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, label: str, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) on the pool and wait for its result
+        @param label: Name reported when the call waited too long
+        @param func: Blocking function to execute
+        @return: Return value of func
+        """
+        context = contextvars.copy_context()
+        submitted = time.perf_counter()
+        with self._lock:
+            self.queued += 1
+
+        def task():
+            wait = time.perf_counter() - submitted
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            if wait > EXECUTOR_WAIT_WARNING:
+                Debug.msg("DatabaseExecutor|run",
+                          "{} waited {:.3f}s for a worker".format(label, wait),
+                          DebugLevel.WARNING)
+            try:
+                return context.run(func, *args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return await asyncio.get_running_loop().run_in_executor(self._pool, task)
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the pool usage
+        @return: dict of worker, queue depth and wait time figures
+        """
+        with self._lock:
+            started = self.completed + self.running
+            return {
+                "max_workers": self.max_workers,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "avg_wait": self.total_wait / started if started else 0.0,
+                "max_wait": self.max_wait
+            }
+
+# One worker per pooled connection, so a worker never waits on the pool
+db_executor = DatabaseExecutor(POOL_SIZE) if DB_MODE == "thread" else None
+
+async def _connect(session):
+    """
+    Check the connection of a blocking session out before its body runs.
+    While the pool has a free connection this is done in place. Once every
+    connection is checked out the wait runs on a spare thread: waiting in
+    the event loop (sync mode) or in a db_executor worker (thread mode)
+    would stop the requests holding the connections from ever giving them
+    back.
+    @param session: Session about to be used
+    """
+    if session.in_transaction():
+        return
+    pool = session.get_bind().pool
+    if MAX_OVERFLOW < 0 or pool.checkedout() < pool.size() + MAX_OVERFLOW:
+        return
+    await asyncio.to_thread(session.connection)
+
+def _run_in_session(session, func, args, kwargs):
+    try:
+        result = func(session, *args, **kwargs)
+        session.commit()
+        return result
+    except Exception:
+        session.rollback()
         raise
+    finally:
+        session.close()
+
+def _finish_session(session, commit: bool):
+    try:
+        if commit:
+            session.commit()
+        else:
+            session.rollback()
+    finally:
+        session.close()
+
+class RequestScope:
+    """
+    One session and one transaction for every controller call made while
+    handling a request. The session is only created by the first controller
+    call, and the transaction is committed (or rolled back when a controller
+    raised) once by finish().
+    """
+    def __init__(self):
+        self.session = None
+        self.failed = False
+        self._lock = asyncio.Lock()
+
+    async def run(self, func, args, kwargs):
+        """
+        Run a controller body on the request session, one call at a time
+        @param func: Function receiving the session as its first argument
+        @return: Return value of func
+        """
+        async with self._lock:
+            if self.session is None:
+                factory = AsyncSessionFactory if DB_MODE == "async" else SessionFactory
+                self.session = factory()
+            try:
+                if DB_MODE == "async":
+                    return await self.session.run_sync(func, *args, **kwargs)
+                await _connect(self.session)
+                if DB_MODE == "thread":
+                    return await db_executor.run(func.__qualname__, func,
+                                                 self.session, *args, **kwargs)
+                return func(self.session, *args, **kwargs)
+            except Exception:
+                self.failed = True
+                raise
+
+    async def finish(self):
+        """
+        Commit the request transaction, or roll it back if a controller
+        failed, and release the session. Safe to call more than once.
+        """
+        async with self._lock:
+            session, self.session = self.session, None
+            if session is None:
+                return
+
+            commit = not self.failed
+            if DB_MODE == "async":
+                try:
+                    if commit:
+                        await session.commit()
+                    else:
+                        await session.rollback()
+                finally:
+                    await session.close()
+            elif DB_MODE == "thread":
+                await db_executor.run("RequestScope|finish", _finish_session, session, commit)
+            else:
+                _finish_session(session, commit)
+
+class RequestSessionMiddleware:
+    """
+    ASGI middleware opening a RequestScope for every HTTP request. The
+    transaction is finished right before the response starts, so a failed
+    commit still turns into an error response instead of a silent success.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_scope = RequestScope()
+        token = _request_scope.set(request_scope)
+
+        async def send_after_commit(message):
+            if message["type"] == "http.response.start":
+                await request_scope.finish()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_after_commit)
+        except Exception:
+            request_scope.failed = True
+            raise
+        finally:
+            await request_scope.finish()
+            _request_scope.reset(token)
+
+async def release_request_session():
+    """
+    Finish the transaction of the request being handled now and give its
+    connection back to the pool, before awaiting something else than the
+    database (pin hashing, the write-behind queue). The next controller call
+    of the request opens a new session and transaction.
+    """
+    request_scope = _request_scope.get()
+    if request_scope is not None:
+        await request_scope.finish()
+
+def _auto_increment_settings(connection) -> Tuple[int, Optional[int]]:
+    # Read once per pooled connection, kept with it across checkouts
+    settings = connection.info.get("auto_increment")
+    if settings is None:
+        if connection.dialect.name == "mysql":
+            settings = tuple(connection.exec_driver_sql(
+                "SELECT @@auto_increment_increment, @@innodb_autoinc_lock_mode").one())
+        else:
+            settings = (1, None)
+        connection.info["auto_increment"] = settings
+    return settings
+
+def insert_rows(session, model, rows: list) -> List[int]:
+    """
+    Insert rows with one multi-row INSERT statement written directly in the
+    driver paramstyle. Building the same statement with insert().values()
+    costs more than the round trip it saves, the SQL compiler visits every
+    parameter of every row. Where the backend supports INSERT .. RETURNING
+    (MariaDB, SQLite) the ids come back with the statement. On MySQL they are
+    counted from LAST_INSERT_ID() by auto_increment_increment, which only
+    holds with innodb_autoinc_lock_mode 0 or 1: with the interleaved mode 2
+    the rows are inserted one statement each.
+    @param session: Session of the write
+    @param model: Mapped class of the table
+    @param rows: dict of column values per row, every row with the same keys
+    @return: List of the new ids, in the order of rows
+    """
+    columns = list(rows[0])
+    dialect = session.get_bind().dialect
+    marker = "?" if dialect.paramstyle == "qmark" else "%s"
+    row_sql = "(" + ", ".join([marker] * len(columns)) + ")"
+    table = model.__table__
+    sql = "INSERT INTO {} ({}) VALUES ".format(
+        dialect.identifier_preparer.format_table(table),
+        ", ".join(dialect.identifier_preparer.quote(column) for column in columns))
+    processors = [table.c[column].type.dialect_impl(dialect).bind_processor(dialect) or (lambda value: value)
+                  for column in columns]
+    params = tuple(processor(row.get(column)) for row in rows
+                   for column, processor in zip(columns, processors))
+    connection = session.connection()
+    session.info["writes"] = True
+
+    if dialect.insert_returning:
+        # The ids of one statement grow in the order of its rows
+        result = connection.exec_driver_sql(sql + ", ".join([row_sql] * len(rows)) + " RETURNING id", params)
+        return sorted(new_id for new_id, in result)
+
+    increment, lock_mode = _auto_increment_settings(connection)
+    if lock_mode == 2:
+        return [connection.exec_driver_sql(sql + row_sql, params[start:start + len(columns)]).lastrowid
+                for start in range(0, len(params), len(columns))]
+
+    first_id = connection.exec_driver_sql(sql + ", ".join([row_sql] * len(rows)), params).lastrowid
+    return list(range(first_id, first_id + increment * len(rows), increment))
+
+def update_returning(session, model, criteria, values: dict) -> Tuple[int, Optional[object]]:
+    """
+    Update the rows matching criteria in one statement. Where the backend
+    supports UPDATE .. RETURNING the updated row comes back with it, MySQL
+    only reports the number of matched rows (the driver sets FOUND_ROWS).
+    @param session: Session of the write
+    @param model: Mapped class of the table
+    @param criteria: WHERE clause of the update
+    @param values: dict of column name and new value
+    @return: (number of rows matched, updated ORM object or None)
+    """
+    statement = update(model).where(criteria).values(values)
+    if session.get_bind().dialect.update_returning:
+        rows = session.execute(statement.returning(model)).scalars().all()
+        return len(rows), rows[0] if rows else None
+    return session.execute(statement).rowcount, None
+
+def delete_returning(session, model, criteria, *columns) -> list:
+    """
+    Delete the rows matching criteria and get columns of the deleted rows.
+    One DELETE .. RETURNING where the backend supports it (MariaDB, SQLite),
+    a locked read of the columns then the DELETE on MySQL.
+    @param session: Session of the write
+    @param model: Mapped class of the table
+    @param criteria: WHERE clause of the delete
+    @param columns: Columns returned for each deleted row
+    @return: List of rows of the columns, empty when nothing matched
+    """
+    statement = delete(model).where(criteria)
+    if session.get_bind().dialect.delete_returning:
+        return session.execute(statement.returning(*columns)).all()
+
+    rows = session.query(*columns).filter(criteria).with_for_update().all()
+    if rows:
+        session.execute(statement)
+    return rows
+
+@contextmanager
+def own_transactions():
+    """
+    Controller calls made in the block get their own session and commit on
+    their own instead of joining the request transaction, for long running
+    work (imports) committed piece by piece
+    """
+    token = _request_scope.set(None)
+    try:
+        yield
+    finally:
+        _request_scope.reset(token)
+
+def with_session(func):
+    """
+    Turn a blocking controller body func(session, *args, **kwargs) into a
+    coroutine that runs it on the configured DB_MODE. In async mode the body
+    is executed through AsyncSession.run_sync, so the ORM code stays the same
+    for both engines, in thread mode it is handed to db_executor. Inside a
+    request the body joins the request session (see RequestScope), otherwise
+    it gets its own session and transaction.
+    @param func: Function receiving the session as its first argument
+    @return: Coroutine function taking the remaining arguments
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = _current_method.set(func.__qualname__)
+        try:
+            request_scope = _request_scope.get()
+            if request_scope is not None:
+                return await request_scope.run(func, args, kwargs)
+
+            if DB_MODE == "async":
+                async with get_async_session() as session:
+                    result = await session.run_sync(func, *args, **kwargs)
+                    await session.commit()
+                    return result
+
+            session = SessionFactory()
+            try:
+                await _connect(session)
+            except BaseException:
+                session.close()
+                raise
+            if DB_MODE == "thread":
+                return await db_executor.run(func.__qualname__, _run_in_session,
+                                             session, func, args, kwargs)
+
+            return _run_in_session(session, func, args, kwargs)
+        finally:
+            _current_method.reset(token)
+
+    # Decided once here, the calls pay nothing when METRICS is off
+    return metrics.timed(func.__qualname__, wrapper) if METRICS else wrapper
 
 DB_BASE = declarative_base()
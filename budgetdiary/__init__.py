@@ -1,6 +1,35 @@
 from fastapi import FastAPI
 
-app = FastAPI()
+from .__database import RequestSessionMiddleware
+from .metrics import METRICS, MetricsMiddleware
+from .model.response import DEFAULT_RESPONSE_CLASS
+
+app = FastAPI(default_response_class=DEFAULT_RESPONSE_CLASS)
+app.add_middleware(RequestSessionMiddleware)
+if METRICS:
+    # Outermost, so the timing includes the commit of the request transaction
+    app.add_middleware(MetricsMiddleware)
+
+from .controller.IncomeCategory import IncomeCategory as IncomeCategoryController
+from .controller.OutcomeCategory import OutcomeCategory as OutcomeCategoryController
+from .controller.Income import Income as IncomeController
+from .controller.Outcome import Outcome as OutcomeController
+from .utils import Debug, DebugLevel
+
+@app.on_event("startup")
+async def load_category_cache():
+    try:
+        await IncomeCategoryController.load_cache()
+        await OutcomeCategoryController.load_cache()
+    except Exception as e:
+        # The caches load on first use instead
+        Debug.msg("App|load_category_cache", "Exception Raised: {}".format(e), DebugLevel.WARNING)
+
+@app.on_event("shutdown")
+async def flush_write_behind():
+    # Rows still queued are committed before the process exits
+    await IncomeController.queue.close()
+    await OutcomeController.queue.close()
 
 from .route.User import subroute as user_route
 app.include_router(
@@ -30,4 +59,26 @@ app.include_router(
     tags=['Outcome']
 )
 
+from .route.Ledger import subroute as ledger_route
+app.include_router(
+    ledger_route,
+    prefix='/ledger',
+    tags=['Ledger']
+)
+
+from .route.Status import subroute as status_route
+app.include_router(
+    status_route,
+    prefix='/status',
+    tags=['Status']
+)
+
+if METRICS:
+    from .route.Metrics import subroute as metrics_route
+    app.include_router(
+        metrics_route,
+        prefix='/metrics',
+        tags=['Metrics']
+    )
+
 # from .route.Income import subroute as income_route
\ No newline at end of file
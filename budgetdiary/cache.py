@@ -0,0 +1,365 @@
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from functools import wraps
+from typing import Any, Dict, Hashable
+from sqlalchemy.orm.attributes import set_committed_value
+from .__database import after_commit, own_transactions, request_has_writes
+
+# Bound and lifetime (seconds) of the aggregate result cache, the lifetime
+# only matters for writes made outside of the app (scripts, SQL console)
+AGGREGATE_CACHE_SIZE = int(os.environ.get("AGGREGATE_CACHE_SIZE", 4096))
+AGGREGATE_CACHE_TTL = float(os.environ.get("AGGREGATE_CACHE_TTL", 300))
+
+# Lifetime (seconds) of the category tables kept in memory, the app drops
+# them on its own writes, this bounds how long other writes go unseen
+CATEGORY_CACHE_TTL = float(os.environ.get("CATEGORY_CACHE_TTL", 300))
+
+class TableCache:
+    """
+    Whole table kept in memory, for the small tables that rarely change.
+    The rows are loaded on first use (or at startup) and dropped after a
+    write on the table commits or ttl seconds after they were loaded, the
+    next read loads them again.
+    """
+    def __init__(self, model, ttl: float = CATEGORY_CACHE_TTL):
+        self.model = model
+        self.ttl = ttl
+        self._rows = None
+        self._expires = 0.0
+        self._version = 0
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def get_all(self, session) -> Dict[int, object]:
+        """
+        Rows of the table by id, loaded with session when not cached
+        @param session: Session used on a cache miss
+        @return: dict of id and detached ORM object
+        """
+        rows = self._rows
+        if rows is not None and time.monotonic() < self._expires:
+            return rows
+
+        version = self._version
+        expires = time.monotonic() + self.ttl
+        rows = {row.id: row for row in session.query(self.model).all()}
+        for row in rows.values():
+            session.expunge(row)
+        with self._lock:
+            # A write committed while loading, keep serving from the database
+            if version == self._version:
+                self._rows = rows
+                self._expires = expires
+                self.loads += 1
+        return rows
+
+    def get(self, session, target_id: int):
+        """
+        Row of the table by id
+        @param session: Session used on a cache miss
+        @param target_id: The id of the row
+        @return: ORM object or None
+        """
+        return self.get_all(session).get(target_id)
+
+    def attach(self, session, rows: list, relationship: str, foreign_key: str) -> list:
+        """
+        Fill a many-to-one relationship of ledger rows from the cache instead
+        of a join. The value is set as already loaded, so it is neither
+        lazy loaded nor flushed.
+        @param session: Session used on a cache miss
+        @param rows: ORM objects to fill
+        @param relationship: Name of the relationship attribute
+        @param foreign_key: Name of the foreign key column
+        @return: The rows
+        """
+        cached = self.get_all(session)
+        for row in rows:
+            set_committed_value(row, relationship, cached.get(getattr(row, foreign_key)))
+        return rows
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the cache usage
+        @return: dict of cached rows and load count
+        """
+        rows = self._rows
+        return {"rows": len(rows) if rows is not None else None, "ttl": self.ttl, "loads": self.loads}
+
+    def invalidate(self, session=None):
+        """
+        Drop the cached rows, once the transaction of session commits when given
+        @param session: Session of the write
+        """
+        if session is not None:
+            after_commit(session, self.invalidate)
+            return
+        with self._lock:
+            self._version += 1
+            self._rows = None
+
+
+class LRUCache:
+    """
+    Bounded mapping dropping the least recently used entry when full, and
+    any entry older than ttl seconds. Hits and misses are counted so the
+    size can be tuned. Every invalidation bumps version, a value read before
+    it can then no longer be put.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Any:
+        """
+        Cached value of a key, None when missing or expired
+        @param key: Cache key
+        @return: Cached value or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key: Hashable) -> Any:
+        """
+        Cached value of a key without counting it or refreshing its rank
+        @param key: Cache key
+        @return: Cached value or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def put(self, key: Hashable, value: Any, version: int = None) -> bool:
+        """
+        Cache a value, evicting the least recently used entry when full
+        @param key: Cache key
+        @param value: Value to cache, not None
+        @param version: version read before the value was loaded, the value
+                        is dropped when an invalidation happened since
+        @return: bool whether the value was cached
+        """
+        if self.max_size <= 0:
+            return False
+        with self._lock:
+            if version is not None and version != self.version:
+                return False
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, *keys: Hashable):
+        """
+        Drop the entries of the keys
+        @param keys: Cache keys
+        """
+        with self._lock:
+            self.version += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the cache usage
+        @return: dict of size, hit and miss figures
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions
+            }
+
+
+class SingleFlight:
+    """
+    Coalescing of identical concurrent reads: while a decorated controller
+    method is running, calls with the same arguments wait for the same
+    result instead of running the query again. Nothing is kept once the
+    call returns. The shared query runs in its own transaction, a request
+    that has already written reads on its own session as before. Callers
+    must not change the result, it may be shared.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = {}
+
+    def __call__(self, func):
+        name = func.__qualname__
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            if request_has_writes():
+                return await func(*args, **kwargs)
+
+            loop = asyncio.get_running_loop()
+            key = (loop, name, args, frozenset(kwargs.items()))
+            with self._lock:
+                self.calls[name] = self.calls.get(name, 0) + 1
+                flight = self._flights.get(key)
+                if flight is None:
+                    with own_transactions():
+                        flight = loop.create_task(func(*args, **kwargs))
+                    self._flights[key] = flight
+                    flight.add_done_callback(lambda done: self._land(key, done))
+                else:
+                    self.coalesced[name] = self.coalesced.get(name, 0) + 1
+            # A caller giving up does not cancel the query of the others
+            return await asyncio.shield(flight)
+
+        return wrapper
+
+    def _land(self, key: tuple, flight: asyncio.Task):
+        with self._lock:
+            self._flights.pop(key, None)
+        if not flight.cancelled():
+            # Marks the error as seen when every caller went away
+            flight.exception()
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the coalescing
+        @return: dict of calls and coalesced calls per method, and their totals
+        """
+        with self._lock:
+            calls = sum(self.calls.values())
+            coalesced = sum(self.coalesced.values())
+            return {
+                "in_flight": len(self._flights),
+                "calls": calls,
+                "coalesced": coalesced,
+                "coalesced_rate": coalesced / calls if calls else 0.0,
+                "methods": {name: {"calls": count, "coalesced": self.coalesced.get(name, 0)}
+                            for name, count in self.calls.items()}
+            }
+
+# Shared by the aggregate reads of the dashboard commands
+single_flight = SingleFlight()
+
+
+class ResultCache:
+    """
+    Results of aggregate reads kept in memory, keyed by method and arguments
+    (user and period) and tagged with the data version of every table they
+    read. A write bumps the version of its table for its User once its
+    transaction commits, so a result read before the write is never served
+    after it. A request that has already written reads its own transaction
+    instead. Callers must not change the result, it is shared. Versions live
+    in this process only, a write made by another worker is seen once the
+    entry expires.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self._entries = LRUCache(max_size, ttl)
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.bumps = 0
+
+    def _snapshot(self, tables: tuple, user_id) -> tuple:
+        with self._lock:
+            return tuple((self._versions.get((table, user_id), 0), self._versions.get((table, None), 0))
+                         for table in tables)
+
+    def _bump(self, table: str, user_id):
+        with self._lock:
+            self._versions[(table, user_id)] = self._versions.get((table, user_id), 0) + 1
+            self.bumps += 1
+
+    def bump(self, session, table: str, user_id: int = None):
+        """
+        Invalidate the cached results reading a table, once the transaction
+        of session commits
+        @param session: Session of the write
+        @param table: Name of the table written
+        @param user_id: The id of the User whose rows changed, every User when None
+        """
+        after_commit(session, lambda: self._bump(table, user_id))
+
+    def __call__(self, *tables: str):
+        """
+        Cache the results of a controller read whose first argument is the id
+        of a User
+        @param tables: Names of the tables the read depends on
+        @return: Decorator of the coroutine function
+        """
+        def decorator(func):
+            name = func.__qualname__
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                if request_has_writes():
+                    return await func(*args, **kwargs)
+
+                user_id = args[0] if args else kwargs["target_user_id"]
+                key = (name, args, frozenset(kwargs.items()))
+                versions = self._snapshot(tables, user_id)
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == versions:
+                    self.hits += 1
+                    return entry[1]
+                if entry is not None:
+                    self.stale += 1
+                self.misses += 1
+
+                # Tagged with the versions seen before the query, a write
+                # committed meanwhile makes the entry stale right away. The
+                # query gets a transaction started after that snapshot, the
+                # request one may still read an older REPEATABLE READ view.
+                with own_transactions():
+                    result = await func(*args, **kwargs)
+                self._entries.put(key, (versions, result))
+                return result
+
+            return wrapper
+
+        return decorator
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the cache usage
+        @return: dict of size, hit, miss and invalidation figures
+        """
+        entries = self._entries.stats()
+        lookups = self.hits + self.misses
+        return {
+            "size": entries["size"],
+            "max_size": entries["max_size"],
+            "ttl": entries["ttl"],
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stale": self.stale,
+            "bumps": self.bumps,
+            "evictions": entries["evictions"]
+        }
+
+# Results of the aggregate reads, by method, user and period
+aggregate_cache = ResultCache(AGGREGATE_CACHE_SIZE, AGGREGATE_CACHE_TTL)
@@ -0,0 +1,149 @@
+from typing import List
+from datetime import date
+from sqlalchemy import select, union_all, literal
+from sqlalchemy.sql import func
+from sqlalchemy.dialects.mysql import insert
+from ..__database import with_session
+from ..model.database import BalanceCheckpoint as BalanceCheckpointModel
+from ..model.database import Income as IncomeModel
+from ..model.database import Outcome as OutcomeModel
+from ..model.database import OutcomePlan as OutcomePlanModel
+from .MonthlySummary import MonthlySummary
+
+# Checkpoint column holding the cumulative total of each ledger table
+TOTAL_COLUMNS = {
+    IncomeModel: "total_income",
+    OutcomeModel: "total_outcome",
+    OutcomePlanModel: "total_outcome_plan",
+}
+
+class BalanceCheckpoint:
+    """
+    One row per user and month holding the cumulative Income, Outcome and
+    OutcomePlan totals up to the end of that month (bucketed by date_created).
+    A total before any date is the previous checkpoint plus the rows of its
+    own month.
+    """
+    @staticmethod
+    @with_session
+    def get_all_by_user_id(session, target_user_id: int) -> List[BalanceCheckpointModel]:
+        """
+        Get the all result of BalanceCheckpoint of a User
+        @param target_user_id: The id of the User
+        @return: List of BalanceCheckpoint object
+        """
+        checkpoint = session.query(BalanceCheckpointModel).filter_by(
+            user_id=target_user_id).order_by(BalanceCheckpointModel.month).all()
+
+        return checkpoint
+
+    @staticmethod
+    def checkpoint_before(target_user_id: int, data_date: date, name: str):
+        """
+        Build the scalar subquery of the last checkpoint total of a User before
+        the month of a date
+        @param target_user_id: The id of the User
+        @param data_date: date or datetime
+        @param name: total_income, total_outcome or total_outcome_plan
+        @return: SQL expression, 0 when there is no checkpoint
+        """
+        return func.coalesce(select(getattr(BalanceCheckpointModel, name)).where(
+            BalanceCheckpointModel.user_id == target_user_id,
+            BalanceCheckpointModel.month < MonthlySummary.month_of(data_date)).order_by(
+                BalanceCheckpointModel.month.desc()).limit(1).scalar_subquery(), 0)
+
+    @staticmethod
+    def total_before(session, target_user_id: int, data_date: date, ledger) -> list:
+        """
+        Get the sum of a ledger table of a User before a date in one statement:
+        the last checkpoint before the month of the date plus the rows of that
+        month, in the caller session
+        @param target_user_id: The id of the User
+        @param data_date: date or datetime, rows created before it are summed
+        @param ledger: IncomeModel, OutcomeModel or OutcomePlanModel
+        @return: List with one amount row
+        """
+        checkpoint = BalanceCheckpoint.checkpoint_before(target_user_id, data_date,
+                                                         TOTAL_COLUMNS[ledger])
+        tail = select(func.sum(ledger.amount)).where(
+            ledger.user_id == target_user_id,
+            ledger.date_created >= date(data_date.year, data_date.month, 1),
+            ledger.date_created < data_date).scalar_subquery()
+
+        return session.query((checkpoint +
+                              func.coalesce(tail, 0)).label("amount")).all()
+
+    @staticmethod
+    def apply_delta(session, user_id: int, day: date, income=0, outcome=0, outcome_plan=0):
+        """
+        Add the deltas to the checkpoint of the month of a day and to every
+        later checkpoint of the User, creating the month checkpoint from the
+        previous one when missing. Runs in the caller session, so the
+        checkpoints are committed or rolled back together with the ledger write.
+        @param user_id: The id of the User
+        @param day: date_created of the ledger row
+        @param income: Decimal added to the Income total, negative to remove
+        @param outcome: Decimal added to the Outcome total, negative to remove
+        @param outcome_plan: Decimal added to the OutcomePlan total, negative to remove
+        """
+        deltas = {name: delta for name, delta in (("total_income", income),
+                                                   ("total_outcome", outcome),
+                                                   ("total_outcome_plan", outcome_plan)) if delta}
+        if not deltas:
+            return
+        month = MonthlySummary.month_of(day)
+
+        previous = session.query(BalanceCheckpointModel).filter(
+            BalanceCheckpointModel.user_id == user_id,
+            BalanceCheckpointModel.month < month).order_by(
+                BalanceCheckpointModel.month.desc()).with_for_update().first()
+        values = {name: (getattr(previous, name) if previous else 0) + deltas.get(name, 0)
+                  for name in TOTAL_COLUMNS.values()}
+        stmt = insert(BalanceCheckpointModel).values(user_id=user_id, month=month, **values)
+        stmt = stmt.on_duplicate_key_update(
+            **{name: getattr(BalanceCheckpointModel, name) + delta for name, delta in deltas.items()})
+        session.execute(stmt)
+
+        session.query(BalanceCheckpointModel).filter(
+            BalanceCheckpointModel.user_id == user_id,
+            BalanceCheckpointModel.month > month).update(
+                {getattr(BalanceCheckpointModel, name): getattr(BalanceCheckpointModel, name) + delta
+                 for name, delta in deltas.items()}, synchronize_session=False)
+
+    @staticmethod
+    @with_session
+    def rebuild(session, target_user_id: int = None) -> int:
+        """
+        Recompute the BalanceCheckpoint rows from the ledger tables, for one
+        User or for everyone. Run it with the writes stopped.
+        @param target_user_id: The id of the User, every User when not given
+        @return: int number of BalanceCheckpoint rows written
+        """
+        names = list(TOTAL_COLUMNS.values())
+        parts = []
+        for ledger, name in TOTAL_COLUMNS.items():
+            part = select(ledger.user_id.label("user_id"),
+                          (func.year(ledger.date_created) * 100 +
+                           func.month(ledger.date_created)).label("month"),
+                          *[(ledger.amount if other == name else literal(0)).label(other)
+                            for other in names])
+            if target_user_id is not None:
+                part = part.where(ledger.user_id == target_user_id)
+            parts.append(part)
+        rows = union_all(*parts).subquery()
+        monthly = select(rows.c.user_id, rows.c.month,
+                         *[func.sum(rows.c[name]).label(name) for name in names]).group_by(
+                             rows.c.user_id, rows.c.month).subquery()
+        cumulative = select(monthly.c.user_id, monthly.c.month,
+                            *[func.sum(monthly.c[name]).over(partition_by=monthly.c.user_id,
+                                                             order_by=monthly.c.month).label(name)
+                              for name in names])
+
+        query = session.query(BalanceCheckpointModel)
+        if target_user_id is not None:
+            query = query.filter(BalanceCheckpointModel.user_id == target_user_id)
+        query.delete(synchronize_session=False)
+        result = session.execute(insert(BalanceCheckpointModel).from_select(
+            ["user_id", "month"] + names, cumulative))
+
+        return result.rowcount
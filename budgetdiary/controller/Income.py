@@ -1,201 +1,365 @@
-from typing import List
-from datetime import date
+from typing import List, Iterator, Optional, Tuple
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 from sqlalchemy.sql import func
-from sqlalchemy.orm import joinedload
-from ..__database import get_session
+from sqlalchemy.orm import make_transient_to_detached
+from ..__database import (with_session, get_session, insert_rows, update_returning, delete_returning,
+                          release_request_session, STREAM_YIELD_PER)
+from ..cache import single_flight, aggregate_cache
 from ..model.database import Income as IncomeModel
 from ..model.database import IncomeCategory as IncomeCategoryModel
-from ..utils import Debug, DebugLevel
+from ..model.database import MonthlySummary as MonthlySummaryModel
+from .MonthlySummary import MonthlySummary
+from .BalanceCheckpoint import BalanceCheckpoint
+from .User import User
+from .IncomeCategory import IncomeCategory
+from ..write_behind import GroupCommitQueue
 
 class Income:
+    # Write-behind queue of add, used when WRITE_BEHIND is on
+    queue = GroupCommitQueue("income", lambda rows: Income.insert_group(rows))
+
     @staticmethod
-    async def get_by_id(target_id: int) -> IncomeModel:
+    def _apply_delta(session, user_id: int, day: date, amount):
+        """
+        Keep the derived data and the balance of a User in step with an
+        Income write, in the same session as the write
+        @param user_id: The id of the User
+        @param day: date_created of the Income
+        @param amount: Amount added, negative when removed
+        """
+        MonthlySummary.apply_delta(session, user_id, day, income=amount)
+        BalanceCheckpoint.apply_delta(session, user_id, day, income=amount)
+        User.apply_balance_delta(session, user_id, amount)
+        aggregate_cache.bump(session, "income", user_id)
+
+    @staticmethod
+    @with_session
+    def get_by_id(session, target_id: int) -> IncomeModel:
         """
         Get the first result of Income by its id
         @param target_id: The id of the Income data
         @return: Income object
         """
-        with get_session() as session:
-            income = session.query(IncomeModel).filter_by(id=target_id).first()
+        income = session.query(IncomeModel).filter_by(id=target_id).first()
 
         return income
 
     @staticmethod
-    async def get_by_income_category_and_date(income_category_id: int,
-                                          first_date: date,
-                                          last_date: date) -> IncomeModel:
+    @with_session
+    def get_by_income_category_and_date(session, target_user_id: int,
+                                        income_category_id: int,
+                                        first_date: date,
+                                        last_date: date) -> IncomeModel:
         """
-        Get the first result of Income by its id
-        @param target_id: The id of the Income data
-        @return: Income object
+        Get the Income of a User in a category between two dates
+        @param target_user_id: The id of the User
+        @param income_category_id: The id of the IncomeCategory
+        @return: List of Income object
         """
-        with get_session() as session:
-            income = session.query(IncomeModel).filter(
-                IncomeModel.income_category_id == income_category_id,
-                IncomeModel.date_created >= first_date,
-                IncomeModel.date_created <= last_date).all()
+        income = session.query(IncomeModel).filter(
+            IncomeModel.user_id == target_user_id,
+            IncomeModel.income_category_id == income_category_id,
+            IncomeModel.date_created >= first_date,
+            IncomeModel.date_created <= last_date).all()
 
         return income
 
     @staticmethod
-    async def get_all() -> List[IncomeModel]:
+    @with_session
+    def get_all(session, after_id: int = 0, limit: int = 100) -> List[IncomeModel]:
         """
-        Get all result of Income data
+        Get a page of Income data, ordered by id
+        @param after_id: Only Income with an id greater than this one
+        @param limit: Maximum number of Income in the page
         @return: List of Income object
         """
-        with get_session() as session:
-            income = session.query(IncomeModel).options(
-                joinedload(IncomeModel.income_category)).all()
+        income = session.query(IncomeModel).filter(
+            IncomeModel.id > after_id).order_by(IncomeModel.id).limit(limit).all()
+        IncomeCategory.cache.attach(session, income, "income_category", "income_category_id")
         return income
-        
+
     @staticmethod
-    async def get_daily_income(date:date) -> List[IncomeModel]:
+    @with_session
+    def get_all_by_user_id(session, target_user_id: int, after_id: int = 0,
+                           limit: int = 100) -> List[IncomeModel]:
         """
-        Get all result of Income data
+        Get a page of Income data of a User, ordered by id
+        @param target_user_id: The id of the User
+        @param after_id: Only Income with an id greater than this one
+        @param limit: Maximum number of Income in the page
         @return: List of Income object
         """
-        with get_session() as session:
-            income = session.query(IncomeModel).options(
-                joinedload(IncomeModel.income_category)
-                ).filter(IncomeModel.date_created == date).all()
+        income = session.query(IncomeModel).filter(
+            IncomeModel.user_id == target_user_id,
+            IncomeModel.id > after_id).order_by(IncomeModel.id).limit(limit).all()
+        IncomeCategory.cache.attach(session, income, "income_category", "income_category_id")
         return income
 
     @staticmethod
-    async def get_monthly_income(first_date: date,
-                                 last_date: date) -> List[IncomeModel]:
+    def stream_all(after_id: int = 0, target_user_id: int = None) -> Iterator[IncomeModel]:
+        """
+        Stream Income data ordered by id with a server side cursor, so memory
+        stays flat whatever the number of rows
+        @param after_id: Only Income with an id greater than this one
+        @param target_user_id: Only Income of this User when given
+        @return: Generator of Income object
+        """
+        with get_session("Income.stream_all") as session:
+            query = session.query(IncomeModel).filter(IncomeModel.id > after_id)
+            if target_user_id is not None:
+                query = query.filter(IncomeModel.user_id == target_user_id)
+            yield from query.order_by(IncomeModel.id).yield_per(STREAM_YIELD_PER)
+        
+    @staticmethod
+    @with_session
+    def get_daily_income(session, target_user_id: int, date:date) -> List[IncomeModel]:
         """
-        Get all result of Income data
+        Get the Income of a User created on a day
+        @param target_user_id: The id of the User
         @return: List of Income object
         """
-        with get_session() as session:
-            income = session.query(IncomeModel).options(
-                joinedload(IncomeModel.income_category)).filter(
-                    IncomeModel.date_created >= first_date,
-                    IncomeModel.date_created <= last_date,
-                    IncomeModel.amount > 0).order_by(
-                        IncomeModel.date_created).all()
+        income = session.query(IncomeModel).filter(IncomeModel.user_id == target_user_id,
+                     IncomeModel.date_created >= date,
+                     IncomeModel.date_created < date + timedelta(days=1)).all()
+        IncomeCategory.cache.attach(session, income, "income_category", "income_category_id")
         return income
 
     @staticmethod
-    async def get_group_income() -> List[IncomeModel]:
+    @with_session
+    def get_monthly_income(session, target_user_id: int, first_date: date,
+                           last_date: date) -> List[IncomeModel]:
         """
-        Get all result of Income data
+        Get the Income of a User between two dates
+        @param target_user_id: The id of the User
         @return: List of Income object
         """
-        with get_session() as session:
-            income = session.query(
-                func.sum(IncomeModel.amount).label("amount"),
-                IncomeCategoryModel.name.label("name")).join(
-                    IncomeCategoryModel).group_by(
-                            IncomeCategoryModel.name
-            ).order_by(IncomeCategoryModel.name).all()
+        income = session.query(IncomeModel).filter(
+                IncomeModel.user_id == target_user_id,
+                IncomeModel.date_created >= first_date,
+                IncomeModel.date_created <= last_date,
+                IncomeModel.amount > 0).order_by(
+                    IncomeModel.date_created).all()
+        IncomeCategory.cache.attach(session, income, "income_category", "income_category_id")
+        return income
+
+    @staticmethod
+    @aggregate_cache("income", "income_category")
+    @single_flight
+    @with_session
+    def get_group_income(session, target_user_id: int) -> List[IncomeModel]:
+        """
+        Get the Income total of a User per category
+        @param target_user_id: The id of the User
+        @return: List of amount and name rows
+        """
+        income = session.query(
+            func.sum(IncomeModel.amount).label("amount"),
+            IncomeCategoryModel.name.label("name")).join(
+                IncomeCategoryModel).filter(
+                    IncomeModel.user_id == target_user_id).group_by(
+                        IncomeCategoryModel.name
+        ).order_by(IncomeCategoryModel.name).all()
         return income
 
     @staticmethod
-    async def get_this_month_income(first_date: date,
-                                    last_date: date) -> List[IncomeModel]:
+    @aggregate_cache("income")
+    @single_flight
+    @with_session
+    def get_this_month_income(session, target_user_id: int, first_date: date,
+                              last_date: date) -> List[IncomeModel]:
         """
-        Get sum result of Income data
+        Get sum result of Income data of a User between two dates, read from
+        the MonthlySummary when the dates are one calendar month
+        @param target_user_id: The id of the User
         @return: int value of the sum result
         """
-        with get_session() as session:
-            income = session.query(
-                func.sum(IncomeModel.amount).label("amount")).filter(
-                    IncomeModel.date_created >= first_date,
-                    IncomeModel.date_created <= last_date).all()
+        month = MonthlySummary.month_of_range(first_date, last_date)
+        if month is not None:
+            return MonthlySummary.total_of(session, target_user_id, month,
+                                           MonthlySummaryModel.total_income)
+
+        income = session.query(
+            func.sum(IncomeModel.amount).label("amount")).filter(
+                IncomeModel.user_id == target_user_id,
+                IncomeModel.date_created >= first_date,
+                IncomeModel.date_created <= last_date).all()
         return income
 
     @staticmethod
-    async def get_last_income(data_date: date) -> List[IncomeModel]:
+    @with_session
+    def get_last_income(session, target_user_id: int, data_date: date) -> List[IncomeModel]:
         """
-        Get all result of Income data
-        @return: List of Income object
+        Get sum result of Income data of a User before a date, from the last
+        BalanceCheckpoint and the Income of the month of the date
+        @param target_user_id: The id of the User
+        @return: int value of the sum result
         """
-        with get_session() as session:
-            income = session.query(
-                func.sum(IncomeModel.amount).label("amount")).filter(
-                    IncomeModel.date_created < data_date).all()
+        income = BalanceCheckpoint.total_before(session, target_user_id, data_date, IncomeModel)
         return income
 
     @staticmethod
-    async def add(amount: int, date_created: date, income_category_id: int,
-                  detail: str) -> IncomeModel:
+    async def add(user_id: int, income_category_id: int, description: str,
+                  amount: float, date_created: date = None) -> IncomeModel:
         """
-        Create Income object and add it to the database
-        @param last_layer: Income last_layer
-        @param last_room: Income last_room
+        Create Income object and add it to the database. With WRITE_BEHIND
+        the request transaction is committed first, then the row is queued
+        and committed with the other rows of its group.
+        @param user_id: The id of the User
+        @param income_category_id: The id of the IncomeCategory
+        @param description: Income description
+        @param amount: Income amount
+        @param date_created: Income date, now when not given
         @return: Income object
         """
-        with get_session() as session:
-            income = IncomeModel(amount=amount,
-                                 date_created=date_created,
-                                 income_category_id=income_category_id,
-                                 detail=detail)
-            session.add(income)
-            session.commit()
-            session.flush()
-            session.refresh(income)
+        if not Income.queue.enabled:
+            return await Income._add(user_id, income_category_id, description, amount, date_created)
 
-            return income
+        row = {"income_category_id": income_category_id,
+               "description": description,
+               "amount": Decimal(str(amount)),
+               "date_created": date_created or datetime.now()}
+        # The queue may wait for a connection of its own, the request gives its back first
+        await release_request_session()
+        income = IncomeModel(id=await Income.queue.submit(user_id, row), user_id=user_id, **row)
+        make_transient_to_detached(income)
+        return income
 
     @staticmethod
-    async def update_by_id(target_id: int,
-                           new_obj: IncomeModel) -> IncomeModel:
+    @with_session
+    def _add(session, user_id: int, income_category_id: int, description: str,
+             amount: float, date_created: date = None) -> IncomeModel:
+        income = IncomeModel(user_id=user_id,
+                             income_category_id=income_category_id,
+                             description=description,
+                             amount=amount,
+                             date_created=date_created)
+        session.add(income)
+        session.flush()
+        session.refresh(income)
+        Income._apply_delta(session, income.user_id, income.date_created, income.amount)
+
+        return income
+
+    @staticmethod
+    @with_session
+    def insert_group(session, rows: List[Tuple[int, dict]]) -> List[int]:
         """
-        Update Income object that have the specific id
-        @param taget_id: Income id
-        @param new_obj: Income Income new set of data
-        @return: Income object
+        Insert the Income rows of a write-behind group in one transaction,
+        one multi-row INSERT per User
+        @param rows: (user id, dict of the Income columns) per row
+        @return: List of the new Income ids, in the order of rows
+        """
+        positions = {}
+        for position, (user_id, row) in enumerate(rows):
+            positions.setdefault(user_id, []).append(position)
+        ids = [None] * len(rows)
+        for user_id, user_positions in positions.items():
+            new_ids = Income._insert_bulk(session, user_id, [rows[position][1] for position in user_positions])
+            for position, new_id in zip(user_positions, new_ids):
+                ids[position] = new_id
+        return ids
+
+    @staticmethod
+    @with_session
+    def add_bulk(session, user_id: int, rows: List[dict]) -> List[int]:
+        """
+        Insert many Income of a User with one multi-row INSERT, in the request
+        transaction
+        @param user_id: The id of the User
+        @param rows: dict of the Income columns per row, date_created defaults to now
+        @return: List of the new Income ids, in the order of rows
+        """
+        return Income._insert_bulk(session, user_id, rows)
+
+    @staticmethod
+    def _insert_bulk(session, user_id: int, rows: List[dict]) -> List[int]:
+        """
+        Insert many Income of a User with one multi-row INSERT in the caller
+        session and apply their deltas (see insert_rows for how the new ids are
+        read).
+        @param user_id: The id of the User
+        @param rows: dict of the Income columns per row, date_created defaults to now
+        @return: List of the new Income ids, in the order of rows
+        """
+        now = datetime.now()
+        values = [dict(row, user_id=user_id, date_created=row.get("date_created") or now)
+                  for row in rows]
+        ids = insert_rows(session, IncomeModel, values)
+
+        # One delta per month instead of one per row
+        months = {}
+        for value in values:
+            day, amount = months.get(MonthlySummary.month_of(value["date_created"]),
+                                     (value["date_created"], 0))
+            months[MonthlySummary.month_of(day)] = (day, amount + value["amount"])
+        for day, amount in months.values():
+            Income._apply_delta(session, user_id, day, amount)
+
+        return ids
+
+    @staticmethod
+    @with_session
+    def update_by_id(sess, target_id: int, values: dict) -> Tuple[int, Optional[IncomeModel]]:
+        """
+        Update Income object that have the specific id. The row is only read
+        first when the amount, the date or the category changes, for the
+        deltas of the derived tables, the update itself is one statement.
+        @param target_id: Income id
+        @param values: dict of column name and new value
+        @return: (number of rows matched, updated Income object where the
+                 backend supports UPDATE .. RETURNING, None otherwise)
         """
-        with get_session() as sess:
-            sess.query(IncomeModel).filter_by(id=int(target_id)).update({
-                IncomeModel.income_category_id:
-                new_obj.income_category_id,
-                IncomeModel.date_created:
-                new_obj.date_created,
-                IncomeModel.amount:
-                new_obj.amount,
-                IncomeModel.detail:
-                new_obj.detail,
-            })
-            sess.commit()
-        return new_obj
+        criteria = IncomeModel.id == int(target_id)
+        old = None
+        if "amount" in values or "date_created" in values or "income_category_id" in values:
+            old = sess.query(IncomeModel.user_id, IncomeModel.amount,
+                             IncomeModel.date_created).filter(criteria).with_for_update().first()
+            if not old:
+                return 0, None
+
+        matched, income = update_returning(sess, IncomeModel, criteria, values)
+        if old and ("amount" in values or "date_created" in values):
+            new_amount = Decimal(str(values.get("amount", old.amount)))
+            new_date = values.get("date_created") or old.date_created
+            if MonthlySummary.month_of(old.date_created) == MonthlySummary.month_of(new_date):
+                Income._apply_delta(sess, old.user_id, old.date_created, new_amount - old.amount)
+            else:
+                Income._apply_delta(sess, old.user_id, old.date_created, -old.amount)
+                Income._apply_delta(sess, old.user_id, new_date, new_amount)
+        elif old:
+            # Only the category changed, the totals of the derived tables stay
+            aggregate_cache.bump(sess, "income", old.user_id)
+        return matched, income
 
     @staticmethod
-    async def reduce_amount_by_id(target_id: int, amount: int) -> IncomeModel:
+    @with_session
+    def reduce_amount_by_id(sess, target_id: int, amount: int) -> IncomeModel:
         """
         Update Income object that have the specific id
         @param taget_id: Income id
         @param new_obj: Income Income new set of data
         @return: Income object
         """
-        with get_session() as sess:
-            sess.query(IncomeModel).filter_by(id=int(target_id)).update(
-                {IncomeModel.amount: IncomeModel.amount - amount})
-            data = sess.commit()
+        old = sess.query(IncomeModel.user_id, IncomeModel.date_created).filter_by(
+            id=int(target_id)).with_for_update().first()
+        data = sess.query(IncomeModel).filter_by(id=int(target_id)).update(
+            {IncomeModel.amount: IncomeModel.amount - amount})
+        if data:
+            Income._apply_delta(sess, old.user_id, old.date_created, -Decimal(str(amount)))
         return data
 
     @staticmethod
-    async def delete_by_id(target_id: int):
+    @with_session
+    def delete_by_id(sess, target_id: int) -> int:
         """
-        Delete Income object that have the specific id
-        @param taget_id: Income id
+        Delete Income object that have the specific id and take its amount off
+        the derived tables
+        @param target_id: Income id
+        @return: Number of rows deleted
         """
-        try:
-            with get_session() as sess:
-
-                try:
-                    sess.query(IncomeModel).filter_by(
-                        id=int(target_id)).delete()
-                    sess.commit()
-                    sess.flush()
-
-                except Exception as e:
-                    sess.rollback()
-                    Debug.msg("IncomeController|delete_by_id",
-                              "Failed to Delete {}".format(e),
-                              DebugLevel.WARNING)
-
-        except Exception as e:
-            Debug.msg("IncomeController|delete_by_id",
-                      "Exception Raised {}".format(e), DebugLevel.ERROR)
+        deleted = delete_returning(sess, IncomeModel, IncomeModel.id == int(target_id),
+                                   IncomeModel.user_id, IncomeModel.amount, IncomeModel.date_created)
+        for old in deleted:
+            Income._apply_delta(sess, old.user_id, old.date_created, -old.amount)
+        return len(deleted)
@@ -1,84 +1,88 @@
 from typing import List
-from __database import get_session
-from model.database import IncomeCategory as IncomeCategoryModel
-from utils import Debug, DebugLevel
+from ..__database import with_session
+from ..cache import TableCache, aggregate_cache
+from ..model.database import IncomeCategory as IncomeCategoryModel
 
 class IncomeCategory:
+    # Served from memory, the table is tiny and rarely changes
+    cache = TableCache(IncomeCategoryModel)
+
+    @staticmethod
+    @with_session
+    def load_cache(session) -> int:
+        """
+        Load the IncomeCategory cache, called at startup
+        @return: int number of IncomeCategory
+        """
+        return len(IncomeCategory.cache.get_all(session))
+
     @staticmethod
-    async def get_by_id(target_id: int) -> IncomeCategoryModel:
+    @with_session
+    def get_by_id(session, target_id: int) -> IncomeCategoryModel:
         """
         Get the first result of IncomeCategory by its id
         @param target_id: The id of the IncomeCategory data
         @return: IncomeCategory object
         """
-        with get_session() as session:
-            IncomeCategory = session.query(IncomeCategoryModel).filter_by(id=target_id).first()
+        income_category = IncomeCategory.cache.get(session, target_id)
 
-        return IncomeCategory
+        return income_category
     
     @staticmethod
-    def get_all() -> List[IncomeCategoryModel]:
+    @with_session
+    def get_all(session) -> List[IncomeCategoryModel]:
         """
         Get all result of IncomeCategory data
         @return: List of IncomeCategory object
         """
-        with get_session() as session:
-            IncomeCategory = session.query(IncomeCategoryModel).all()
-        return IncomeCategory
+        income_category = list(IncomeCategory.cache.get_all(session).values())
+        return income_category
 
     @staticmethod
-    async def add(name:str,emoticon:str)-> IncomeCategoryModel:
+    @with_session
+    def add(session, name:str,emoticon:str)-> IncomeCategoryModel:
         """
         Create IncomeCategory object and add it to the database
         @param name: The name of the IncomeCategory
         @param emoticon: The emoticon of the IncomeCategory
         @return: IncomeCategory object
         """
-        with get_session() as session:
-            IncomeCategory = IncomeCategoryModel(name=name,emoticon=emoticon)
-            session.add(IncomeCategory)
-            session.commit()
-            session.flush()
-            session.refresh(IncomeCategory)
+        income_category = IncomeCategoryModel(name=name,emoticon=emoticon)
+        session.add(income_category)
+        session.flush()
+        session.refresh(income_category)
+        IncomeCategory.cache.invalidate(session)
 
-            return IncomeCategory
+        return income_category
     
     @staticmethod
-    async def update_by_id(target_id: int, new_obj:IncomeCategoryModel) -> IncomeCategoryModel:
+    @with_session
+    def update_by_id(sess, target_id: int, new_obj:IncomeCategoryModel) -> IncomeCategoryModel:
         """
         Update IncomeCategory object that have the specific id
         @param taget_id: IncomeCategory id
         @param new_obj: IncomeCategory IncomeCategory new set of data
         @return: IncomeCategory object
         """
-        with get_session() as sess:
-            sess.query(IncomeCategoryModel).filter_by(id=int(target_id)).update(
-                    {
-                        IncomeCategoryModel.name: new_obj.name,
-                        IncomeCategoryModel.emoticon: new_obj.emoticon
-                        
-                    }
-                )
-            sess.commit()
+        sess.query(IncomeCategoryModel).filter_by(id=int(target_id)).update(
+                {
+                    IncomeCategoryModel.name: new_obj.name,
+                    IncomeCategoryModel.emoticon: new_obj.emoticon
+                    
+                }
+            )
+        IncomeCategory.cache.invalidate(sess)
+        aggregate_cache.bump(sess, "income_category")
         return new_obj
    
     @staticmethod
-    async def delete_by_id(target_id: int):
+    @with_session
+    def delete_by_id(sess, target_id: int):
         """
         Delete IncomeCategory object that have the specific id
         @param taget_id: IncomeCategory id
         """
-        try:
-            with get_session() as sess:
-            
-                try:
-                    sess.query(IncomeCategoryModel).filter_by(id=int(target_id)).delete()
-                    sess.commit()
-                    sess.flush()
-                    
-                except Exception as e:
-                    sess.rollback()
-                    Debug.msg("IncomeCategoryController|delete_by_id", "Failed to Delete {}".format(e), DebugLevel.WARNING)
-                    
-        except Exception as e:
-            Debug.msg("IncomeCategoryController|delete_by_id", "Exception Raised {}".format(e), DebugLevel.ERROR)
+        sess.query(IncomeCategoryModel).filter_by(id=int(target_id)).delete()
+        IncomeCategory.cache.invalidate(sess)
+        aggregate_cache.bump(sess, "income_category")
+        sess.flush()
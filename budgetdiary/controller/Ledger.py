@@ -0,0 +1,258 @@
+import os, csv, time, asyncio
+from decimal import Decimal, InvalidOperation
+from datetime import date, datetime, timedelta
+from typing import Iterable, Iterator, List, Optional, Tuple
+from sqlalchemy import select, union_all, literal, case, and_
+from sqlalchemy.sql import func
+from ..__database import with_session, get_session, own_transactions, STREAM_YIELD_PER
+from ..cache import single_flight, aggregate_cache
+from ..model.database import Income as IncomeModel
+from ..model.database import Outcome as OutcomeModel
+from ..model.database import Saving as SavingModel
+from ..model.database import User as UserModel
+from .BalanceCheckpoint import BalanceCheckpoint, TOTAL_COLUMNS
+from .Income import Income
+from .Outcome import Outcome
+from .IncomeCategory import IncomeCategory
+from .OutcomeCategory import OutcomeCategory
+from ..utils import Debug, DebugLevel
+
+# Rows inserted per transaction by the CSV import
+IMPORT_CHUNK_ROWS = int(os.environ.get("IMPORT_CHUNK_ROWS", 1000))
+
+# Columns of the export, the import reads the same ones back
+EXPORT_COLUMNS = ("type", "id", "date", "description", "amount", "category")
+
+class Ledger:
+    """
+    Reads, imports and exports spanning the ledger tables of a User
+    """
+    @staticmethod
+    @aggregate_cache("income", "outcome", "outcome_plan", "user")
+    @single_flight
+    @with_session
+    def get_overview(session, target_user_id: int, first_date: date, last_date: date) -> dict:
+        """
+        Get the balance overview of a User for a period in one statement. The
+        opening balance is the opening_balance of the User plus the
+        BalanceCheckpoint before the month of first_date and the rows of that
+        month before first_date, so the closing balance of a period ending
+        today is the balance of the User. The period sums are
+        conditional aggregates over the same UNION ALL of the ledger rows.
+        @param target_user_id: The id of the User
+        @param first_date: First day of the period
+        @param last_date: Last day of the period, included
+        @return: dict of opening_balance, income, outcome, outcome_plan and closing_balance
+        """
+        month_start = date(first_date.year, first_date.month, 1)
+        period_end = last_date + timedelta(days=1)
+        parts = []
+        for ledger, name in TOTAL_COLUMNS.items():
+            parts.append(select(literal(name).label("kind"),
+                                ledger.amount.label("amount"),
+                                ledger.date_created.label("date_created")).where(
+                ledger.user_id == target_user_id,
+                ledger.date_created >= month_start,
+                ledger.date_created < period_end))
+        rows = union_all(*parts).subquery()
+
+        def total(name, in_period):
+            period = rows.c.date_created >= first_date
+            return func.coalesce(func.sum(case(
+                (and_(rows.c.kind == name, period if in_period else ~period), rows.c.amount),
+                else_=0)), 0)
+
+        opening = (func.coalesce(select(UserModel.opening_balance).where(
+                       UserModel.id == target_user_id).scalar_subquery(), 0)
+                   + BalanceCheckpoint.checkpoint_before(target_user_id, first_date, "total_income")
+                   + total("total_income", False)
+                   - BalanceCheckpoint.checkpoint_before(target_user_id, first_date, "total_outcome")
+                   - total("total_outcome", False))
+        income = total("total_income", True)
+        outcome = total("total_outcome", True)
+        overview = session.execute(select(
+            opening.label("opening_balance"),
+            income.label("income"),
+            outcome.label("outcome"),
+            total("total_outcome_plan", True).label("outcome_plan"),
+            (opening + income - outcome).label("closing_balance")).select_from(rows)).one()
+
+        return dict(overview._mapping)
+
+    @staticmethod
+    def stream_export(target_user_id: int, first_date: Optional[date] = None,
+                      last_date: Optional[date] = None) -> Iterator[dict]:
+        """
+        Stream the Income, Outcome and Saving of a User merged in date order
+        with a server side cursor, so memory stays flat whatever the number
+        of rows. Category names come from the category caches instead of a join.
+        @param target_user_id: The id of the User
+        @param first_date: Only rows created on or after this day when given
+        @param last_date: Only rows created on or before this day when given
+        @return: Generator of dict with the EXPORT_COLUMNS
+        """
+        parts = []
+        for kind, ledger, category_id in (
+                ("income", IncomeModel, IncomeModel.income_category_id),
+                ("outcome", OutcomeModel, OutcomeModel.outcome_category_id),
+                ("saving", SavingModel, literal(None))):
+            part = select(literal(kind).label("type"), ledger.id.label("id"),
+                          ledger.date_created.label("date_created"),
+                          ledger.description.label("description"), ledger.amount.label("amount"),
+                          category_id.label("category_id")).where(ledger.user_id == target_user_id)
+            if first_date:
+                part = part.where(ledger.date_created >= first_date)
+            if last_date:
+                part = part.where(ledger.date_created < last_date + timedelta(days=1))
+            parts.append(part)
+        rows = union_all(*parts).subquery()
+        query = select(rows).order_by(rows.c.date_created, rows.c.type, rows.c.id)
+
+        with get_session("Ledger.stream_export") as session:
+            categories = {"income": IncomeCategory.cache.get_all(session),
+                          "outcome": OutcomeCategory.cache.get_all(session)}
+            result = session.execute(query.execution_options(yield_per=STREAM_YIELD_PER))
+            for row in result:
+                category = categories.get(row.type, {}).get(row.category_id)
+                yield {"type": row.type,
+                       "id": row.id,
+                       "date": row.date_created.isoformat(),
+                       "description": row.description,
+                       "amount": row.amount,
+                       "category": category.name if category else None}
+
+    @staticmethod
+    def parse_csv(lines: Iterable[str]) -> Iterator[Tuple[int, dict]]:
+        """
+        Parse a CSV export one row at a time. The columns are date,
+        description, amount, category and optionally type (income or
+        outcome), without type a negative amount is an outcome.
+        @param lines: Iterable of text lines, the first one is the header
+        @return: Generator of (line number, row dict or None when invalid)
+        """
+        reader = csv.DictReader(lines)
+        for row in reader:
+            try:
+                row = {key.strip().lower(): (value or "").strip()
+                       for key, value in row.items() if key}
+                amount = Decimal(row["amount"].replace(",", ""))
+                kind = row.get("type", "").lower() or ("outcome" if amount < 0 else "income")
+                if kind not in ("income", "outcome"):
+                    raise ValueError("Unknown type {}".format(kind))
+                yield reader.line_num, {"type": kind,
+                                        "date_created": datetime.fromisoformat(row["date"]),
+                                        "description": row["description"][:250],
+                                        "amount": abs(amount),
+                                        "category": row["category"].lower()}
+            except (KeyError, ValueError, InvalidOperation):
+                yield reader.line_num, None
+
+    @staticmethod
+    def _chunks(rows: Iterable[dict], size: int) -> Iterator[List[dict]]:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    @with_session
+    def import_chunk(session, target_user_id: int, rows: List[dict]) -> Tuple[int, int]:
+        """
+        Insert parsed rows of a User, skipping the ones already stored with
+        the same date, description and amount
+        @param target_user_id: The id of the User
+        @param rows: Parsed rows with their category_id
+        @return: (number of rows inserted, number of duplicates skipped)
+        """
+        inserted = duplicates = 0
+        for kind, ledger, category_column in (("income", IncomeModel, "income_category_id"),
+                                              ("outcome", OutcomeModel, "outcome_category_id")):
+            part = [row for row in rows if row["type"] == kind]
+            if not part:
+                continue
+
+            # Only the days of the chunk, read through (user_id, date_created)
+            existing = {tuple(stored) for stored in session.query(
+                ledger.date_created, ledger.description, ledger.amount).filter(
+                    ledger.user_id == target_user_id,
+                    ledger.date_created.in_({row["date_created"] for row in part}))}
+            values = []
+            for row in part:
+                key = (row["date_created"], row["description"], row["amount"])
+                if key in existing:
+                    duplicates += 1
+                    continue
+                existing.add(key)
+                value = {category_column: row["category_id"],
+                         "description": row["description"],
+                         "amount": row["amount"],
+                         "date_created": row["date_created"]}
+                if kind == "outcome":
+                    value["date_spend"] = row["date_created"].date()
+                values.append(value)
+
+            if values:
+                if kind == "income":
+                    Income._insert_bulk(session, target_user_id, values)
+                else:
+                    Outcome._insert_bulk(session, target_user_id, values)
+                inserted += len(values)
+
+        return inserted, duplicates
+
+    @staticmethod
+    async def import_csv(target_user_id: int, lines: Iterable[str],
+                         chunk_rows: int = IMPORT_CHUNK_ROWS) -> dict:
+        """
+        Import a CSV export of a User through a generator pipeline: parse, map
+        the category names to ids, then dedupe and insert chunk_rows rows per
+        transaction, so only one chunk is ever held in memory. Each chunk is
+        read and parsed off the event loop.
+        @param target_user_id: The id of the User
+        @param lines: Iterable of text lines of the CSV
+        @param chunk_rows: Rows per transaction
+        @return: dict of row counts, elapsed seconds and rows per second
+        """
+        start = time.perf_counter()
+        with own_transactions():
+            category_ids = {
+                "income": {category.name.lower(): category.id for category in await IncomeCategory.get_all()},
+                "outcome": {category.name.lower(): category.id for category in await OutcomeCategory.get_all()},
+            }
+        stats = {"rows": 0, "inserted": 0, "duplicates": 0, "invalid": 0, "invalid_lines": []}
+
+        def mapped_rows():
+            for line, row in Ledger.parse_csv(lines):
+                stats["rows"] += 1
+                if row is not None:
+                    row["category_id"] = category_ids[row["type"]].get(row["category"])
+                if row is None or row["category_id"] is None:
+                    stats["invalid"] += 1
+                    if len(stats["invalid_lines"]) < 100:
+                        stats["invalid_lines"].append(line)
+                    continue
+                yield row
+
+        chunks = Ledger._chunks(mapped_rows(), chunk_rows)
+        with own_transactions():
+            while True:
+                # Reading and parsing the upload blocks, it runs on a worker thread
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    break
+                inserted, duplicates = await Ledger.import_chunk(target_user_id, chunk)
+                stats["inserted"] += inserted
+                stats["duplicates"] += duplicates
+
+        stats["seconds"] = time.perf_counter() - start
+        stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+        Debug.msg("LedgerController|import_csv",
+                  "User {}: {} rows, {} inserted, {} duplicates, {} invalid, {:.0f} rows/s".format(
+                      target_user_id, stats["rows"], stats["inserted"], stats["duplicates"],
+                      stats["invalid"], stats["rows_per_second"]),
+                  DebugLevel.INFO)
+        return stats
@@ -1,70 +1,147 @@
-from typing import List
+from typing import List, Optional
+from datetime import date, timedelta
 from sqlalchemy.sql import func
 from sqlalchemy.orm import joinedload
-from ..__database import get_session
+from sqlalchemy.dialects.mysql import insert
+from ..__database import with_session
 from ..model.database import MonthlySummary as MonthlySummaryModel
-from ..utils import Debug, DebugLevel
 
 class MonthlySummary:
     @staticmethod
-    async def get_by_id(target_id: int) -> MonthlySummaryModel:
+    @with_session
+    def get_by_id(session, target_id: int) -> MonthlySummaryModel:
         """
         Get the first result of MonthlySummary by its id
         @param target_id: The id of the MonthlySummary data
         @return: MonthlySummary object
         """
-        with get_session() as session:
-            monthly_summary = session.query(MonthlySummaryModel).options(
-                joinedload(MonthlySummaryModel.user)).filter_by(id=target_id).first()
+        monthly_summary = session.query(MonthlySummaryModel).options(
+            joinedload(MonthlySummaryModel.user)).filter_by(id=target_id).first()
 
         return monthly_summary
     
     @staticmethod
-    async def get_all_by_user_id(target_user_id: int) -> MonthlySummaryModel:
+    @with_session
+    def get_all_by_user_id(session, target_user_id: int) -> MonthlySummaryModel:
         """
-        Get the all result of MonthlySummary by its id
-        @param target_id: The id of the MonthlySummary data
-        @return: MonthlySummary object
+        Get the all result of MonthlySummary of a User
+        @param target_user_id: The id of the User
+        @return: List of MonthlySummary object
         """
-        with get_session() as session:
-            monthly_summary = session.query(MonthlySummaryModel).options(
-                joinedload(MonthlySummaryModel.user)).filter_by(id=target_user_id).all()
+        monthly_summary = session.query(MonthlySummaryModel).options(
+            joinedload(MonthlySummaryModel.user)).filter_by(user_id=target_user_id).all()
 
         return monthly_summary
 
     @staticmethod
-    async def get_all() -> List[MonthlySummaryModel]:
+    @with_session
+    def get_all(session) -> List[MonthlySummaryModel]:
         """
         Get all result of MonthlySummary data
         @return: List of MonthlySummary object
         """
-        with get_session() as session:
-            monthly_summary = session.query(MonthlySummaryModel).options(
-                joinedload(MonthlySummaryModel.user)).all()
+        monthly_summary = session.query(MonthlySummaryModel).options(
+            joinedload(MonthlySummaryModel.user)).all()
         return monthly_summary
 
     @staticmethod
-    async def add(month: int, total_income: float, total_outcome: float) -> MonthlySummaryModel:
+    @with_session
+    def get_by_user_and_month(session, target_user_id: int, month: int) -> MonthlySummaryModel:
+        """
+        Get the MonthlySummary of a User for a month
+        @param target_user_id: The id of the User
+        @param month: The month as YYYYMM
+        @return: MonthlySummary object
+        """
+        monthly_summary = session.query(MonthlySummaryModel).filter_by(
+            user_id=target_user_id, month=month).first()
+
+        return monthly_summary
+
+    @staticmethod
+    def month_of(day: date) -> int:
+        """
+        Get the month key of a date
+        @param day: date or datetime
+        @return: int month as YYYYMM
+        """
+        return day.year * 100 + day.month
+
+    @staticmethod
+    def month_of_range(first_date: date, last_date: date) -> Optional[int]:
+        """
+        Get the month key when the range is exactly one calendar month, from its
+        first to its last day
+        @param first_date: First day of the range
+        @param last_date: Last day of the range
+        @return: int month as YYYYMM, None for any other range
+        """
+        if first_date.day != 1 or (first_date.year, first_date.month) != (last_date.year, last_date.month):
+            return None
+        if (last_date + timedelta(days=1)).month == last_date.month:
+            return None
+        return MonthlySummary.month_of(first_date)
+
+    @staticmethod
+    def total_of(session, target_user_id: int, month: int, column) -> list:
+        """
+        Get a total of a User for a month from its MonthlySummary row, in the
+        caller session. The row is found by the unique (user_id, month) index.
+        @param target_user_id: The id of the User
+        @param month: The month as YYYYMM
+        @param column: MonthlySummary.total_income or MonthlySummary.total_outcome
+        @return: List with one amount row, amount is None when there is no row
+        """
+        return session.query(func.sum(column).label("amount")).filter(
+            MonthlySummaryModel.user_id == target_user_id,
+            MonthlySummaryModel.month == month).all()
+
+    @staticmethod
+    def apply_delta(session, user_id: int, day: date, income=0, outcome=0):
+        """
+        Add the deltas to the MonthlySummary of a User for the month of a day,
+        creating the row when missing. Runs in the caller session, so the
+        summary is committed or rolled back together with the ledger write.
+        @param user_id: The id of the User
+        @param day: Date of the ledger row
+        @param income: Amount added to total_income, negative to remove
+        @param outcome: Amount added to total_outcome, negative to remove
+        """
+        if not income and not outcome:
+            return
+        stmt = insert(MonthlySummaryModel).values(user_id=user_id,
+                                                  month=MonthlySummary.month_of(day),
+                                                  total_income=income,
+                                                  total_outcome=outcome)
+        stmt = stmt.on_duplicate_key_update(
+            total_income=MonthlySummaryModel.total_income + stmt.inserted.total_income,
+            total_outcome=MonthlySummaryModel.total_outcome + stmt.inserted.total_outcome)
+        session.execute(stmt)
+
+    @staticmethod
+    @with_session
+    def add(session, user_id: int, month: int, total_income: float, total_outcome: float) -> MonthlySummaryModel:
         """
         Create MonthlySummary object and add it to the database
-        @param month: MonthlySummary last_layer
+        @param user_id: The id of the User
+        @param month: MonthlySummary month as YYYYMM
         @param total_income: MonthlySummary total income
         @param total_outcome: MonthlySummary total outcome
         @return: MonthlySummary object
         """
-        with get_session() as session:
-            monthly_summary = MonthlySummaryModel(description=description,
-                                 amount=amount,
-                                 due_date=due_date)
-            session.add(monthly_summary)
-            session.commit()
-            session.flush()
-            session.refresh(monthly_summary)
+        monthly_summary = MonthlySummaryModel(user_id=user_id,
+                             month=month,
+                             total_income=total_income,
+                             total_outcome=total_outcome)
+        session.add(monthly_summary)
+        session.flush()
+        session.refresh(monthly_summary)
 
-            return monthly_summary
+        return monthly_summary
 
     @staticmethod
-    async def update_by_id(target_id: int,
+    @with_session
+    def update_by_id(sess, target_id: int,
                            new_obj: MonthlySummaryModel) -> MonthlySummaryModel:
         """
         Update MonthlySummary object that have the specific id
@@ -72,36 +149,20 @@ class MonthlySummary:
         @param new_obj: MonthlySummary MonthlySummary new set of data
         @return: MonthlySummary object
         """
-        with get_session() as sess:
-            sess.query(MonthlySummaryModel).filter_by(id=int(target_id)).update({
-                MonthlySummaryModel.month:new_obj.month,
-                MonthlySummaryModel.total_income:new_obj.total_income,
-                MonthlySummaryModel.total_outcome:new_obj.total_outcome,
-            })
-            sess.commit()
+        sess.query(MonthlySummaryModel).filter_by(id=int(target_id)).update({
+            MonthlySummaryModel.month:new_obj.month,
+            MonthlySummaryModel.total_income:new_obj.total_income,
+            MonthlySummaryModel.total_outcome:new_obj.total_outcome,
+        })
         return new_obj
 
     @staticmethod
-    async def delete_by_id(target_id: int):
+    @with_session
+    def delete_by_id(sess, target_id: int):
         """
         Delete MonthlySummary object that have the specific id
         @param taget_id: MonthlySummary id
         """
-        try:
-            with get_session() as sess:
-
-                try:
-                    sess.query(MonthlySummaryModel).filter_by(
-                        id=int(target_id)).delete()
-                    sess.commit()
-                    sess.flush()
-
-                except Exception as e:
-                    sess.rollback()
-                    Debug.msg("MonthlySummaryController|delete_by_id",
-                              "Failed to Delete {}".format(e),
-                              DebugLevel.ERROR)
-
-        except Exception as e:
-            Debug.msg("MonthlySummaryController|delete_by_id",
-                      "Exception Raised {}".format(e), DebugLevel.ERROR)
+        sess.query(MonthlySummaryModel).filter_by(
+            id=int(target_id)).delete()
+        sess.flush()
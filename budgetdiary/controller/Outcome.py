@@ -1,184 +1,350 @@
-from typing import List
+from typing import List, Iterator, Optional, Tuple
 from sqlalchemy.sql import func
-from datetime import date
-from sqlalchemy.orm import joinedload
-from ..__database import get_session
+from sqlalchemy.orm import make_transient_to_detached
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from ..__database import (with_session, get_session, insert_rows, update_returning, delete_returning,
+                          release_request_session, STREAM_YIELD_PER)
+from ..cache import single_flight, aggregate_cache
 from ..model.database import Outcome as OutcomeModel
 from ..model.database import OutcomeCategory as OutcomeCategoryModel
-from ..utils import Debug, DebugLevel
+from ..model.database import MonthlySummary as MonthlySummaryModel
+from .MonthlySummary import MonthlySummary
+from .BalanceCheckpoint import BalanceCheckpoint
+from .User import User
+from .OutcomeCategory import OutcomeCategory
+from ..write_behind import GroupCommitQueue
 
 class Outcome:
+    # Write-behind queue of add, used when WRITE_BEHIND is on
+    queue = GroupCommitQueue("outcome", lambda rows: Outcome.insert_group(rows))
+
+    @staticmethod
+    def _apply_delta(session, user_id: int, day: date, amount):
+        """
+        Keep the derived data and the balance of a User in step with an
+        Outcome write, in the same session as the write
+        @param user_id: The id of the User
+        @param day: date_created of the Outcome
+        @param amount: Amount added, negative when removed
+        """
+        MonthlySummary.apply_delta(session, user_id, day, outcome=amount)
+        BalanceCheckpoint.apply_delta(session, user_id, day, outcome=amount)
+        User.apply_balance_delta(session, user_id, -amount)
+        aggregate_cache.bump(session, "outcome", user_id)
+
     @staticmethod
-    async def get_by_id(target_id: int) -> OutcomeModel:
+    @with_session
+    def get_by_id(session, target_id: int) -> OutcomeModel:
         """
         Get the first result of Outcome by its id
         @param target_id: The id of the Outcome data
         @return: Outcome object
         """
-        with get_session() as session:
-            outcome = session.query(OutcomeModel).filter_by(id=target_id).first()
+        outcome = session.query(OutcomeModel).filter_by(id=target_id).first()
 
         return outcome
 
     @staticmethod
-    async def get_outcome() -> OutcomeModel:
+    @with_session
+    def get_outcome(session, target_user_id: int) -> OutcomeModel:
         """
-        Get the first result of Outcome by its id
-        @param target_id: The id of the Outcome data
-        @return: Outcome object
+        Get sum result of Outcome data of a User
+        @param target_user_id: The id of the User
+        @return: int value of the sum result
         """
-        with get_session() as session:
-            outcome = session.query(func.sum(OutcomeModel.amount).label("amount")).all()
+        outcome = session.query(func.sum(OutcomeModel.amount).label("amount")).filter(
+            OutcomeModel.user_id == target_user_id).all()
 
         return outcome
 
     @staticmethod
-    async def get_last_outcome(data_date:date) -> OutcomeModel:
+    @with_session
+    def get_last_outcome(session, target_user_id: int, data_date:date) -> OutcomeModel:
         """
-        Get the first result of Outcome by its id
-        @param target_id: The id of the Outcome data
-        @return: Outcome object
+        Get sum result of Outcome data of a User before a date, from the last
+        BalanceCheckpoint and the Outcome of the month of the date
+        @param target_user_id: The id of the User
+        @return: int value of the sum result
         """
-        with get_session() as session:
-            outcome = session.query(func.sum(OutcomeModel.amount).label("amount")
-            ).filter(OutcomeModel.date_created<data_date).all()
+        outcome = BalanceCheckpoint.total_before(session, target_user_id, data_date, OutcomeModel)
 
         return outcome
 
-    
     @staticmethod
-    async def get_specific_latest_outcome(keyword:str,outcome_category:int) -> OutcomeModel:
+    @with_session
+    def get_specific_latest_outcome(session, target_user_id: int, keyword:str,outcome_category:int) -> OutcomeModel:
         """
-        Get the first result of Outcome by its outcome_category id and depend on the keyword
-        @param target_id: The id of the Outcome data
+        Get the latest Outcome of a User in an outcome_category whose description matches the keyword
+        @param target_user_id: The id of the User
+        @param keyword: LIKE pattern matched against the description, case insensitive
+        @param outcome_category: The id of the OutcomeCategory
         @return: Outcome object
         """
-        with get_session() as session:
-            outcome = session.query(OutcomeModel).options(joinedload(OutcomeModel.outcome_category), joinedload(OutcomeModel.outcome_category)
-            ).filter(OutcomeModel.outcome_category==outcome_category,func.lower(OutcomeModel.description.like(keyword))
-                ).order_by(OutcomeModel.date_created.desc()).first()
+        outcome = session.query(OutcomeModel).filter(OutcomeModel.user_id == target_user_id, OutcomeModel.outcome_category_id==outcome_category,
+                 func.lower(OutcomeModel.description).like(func.lower(keyword))
+            ).order_by(OutcomeModel.date_created.desc()).first()
+        if outcome:
+            OutcomeCategory.cache.attach(session, [outcome], "outcome_category", "outcome_category_id")
 
         return outcome
   
     @staticmethod
-    async def get_daily_outcome(target_date: date) -> OutcomeModel:
+    @with_session
+    def get_daily_outcome(session, target_user_id: int, target_date: date) -> OutcomeModel:
         """
-        Get the first result of Outcome by its id
-        @param target_id: The id of the Outcome data
-        @return: Outcome object
+        Get the Outcome of a User created on a day
+        @param target_user_id: The id of the User
+        @return: List of Outcome object
         """
-        with get_session() as session:
-            outcome = session.query(OutcomeModel).options(joinedload(OutcomeModel.outcome_category), joinedload(OutcomeModel.outcome_category)
-            ).filter_by(date_created=target_date).all()
+        outcome = session.query(OutcomeModel).filter(OutcomeModel.user_id == target_user_id, OutcomeModel.date_created>=target_date,
+                 OutcomeModel.date_created<target_date + timedelta(days=1)).all()
+        OutcomeCategory.cache.attach(session, outcome, "outcome_category", "outcome_category_id")
 
         return outcome
     
     @staticmethod
-    async def get_monthly_outcome(first_date: date, last_date: date) -> OutcomeModel:
+    @with_session
+    def get_monthly_outcome(session, target_user_id: int, first_date: date, last_date: date) -> OutcomeModel:
         """
-        Get the first result of Outcome by its id
-        @param target_id: The id of the Outcome data
-        @return: Outcome object
+        Get the Outcome of a User between two dates
+        @param target_user_id: The id of the User
+        @return: List of Outcome object
         """
-        with get_session() as session:
-            outcome = session.query(OutcomeModel).options(joinedload(OutcomeModel.outcome_category), joinedload(OutcomeModel.outcome_category)
-            ).filter(OutcomeModel.date_created>=first_date,OutcomeModel.date_created<=last_date).order_by(OutcomeModel.date_created).all()
+        outcome = session.query(OutcomeModel).filter(OutcomeModel.user_id == target_user_id, OutcomeModel.date_created>=first_date,
+                 OutcomeModel.date_created<=last_date).order_by(OutcomeModel.date_created).all()
+        OutcomeCategory.cache.attach(session, outcome, "outcome_category", "outcome_category_id")
 
         return outcome
 
     @staticmethod
-    async def get_group_outcome() -> List[OutcomeModel]:
+    @aggregate_cache("outcome", "outcome_category")
+    @single_flight
+    @with_session
+    def get_group_outcome(session, target_user_id: int) -> List[OutcomeModel]:
         """
-        Get all result of Outcome data
-        @return: List of Outcome object
+        Get the Outcome total of a User per category
+        @param target_user_id: The id of the User
+        @return: List of amount and name rows
         """
-        with get_session() as session:
-            income = session.query(
-                func.sum(OutcomeModel.amount).label("amount"),
-                OutcomeCategoryModel.name.label("name")).join(
-                    OutcomeCategoryModel).group_by(
-                            OutcomeCategoryModel.name
-            ).order_by(OutcomeCategoryModel.name).all()
-        return income
+        outcome = session.query(
+            func.sum(OutcomeModel.amount).label("amount"),
+            OutcomeCategoryModel.name.label("name")).join(
+                OutcomeCategoryModel).filter(
+                    OutcomeModel.user_id == target_user_id).group_by(
+                        OutcomeCategoryModel.name
+        ).order_by(OutcomeCategoryModel.name).all()
+        return outcome
 
     @staticmethod
-    async def get_monthly_total(first_date: date, last_date: date) -> OutcomeModel:
+    @aggregate_cache("outcome")
+    @single_flight
+    @with_session
+    def get_monthly_total(session, target_user_id: int, first_date: date, last_date: date) -> OutcomeModel:
         """
-        Get the first result of Outcome by its id
-        @param target_id: The id of the Outcome data
-        @return: Outcome object
+        Get sum result of Outcome data of a User between two dates, read from
+        the MonthlySummary when the dates are one calendar month
+        @param target_user_id: The id of the User
+        @return: int value of the sum result
         """
-        with get_session() as session:
-            outcome = session.query(func.sum(OutcomeModel.amount).label("amount")).filter(
-                OutcomeModel.date_created>=first_date,OutcomeModel.date_created<=last_date).all()
+        month = MonthlySummary.month_of_range(first_date, last_date)
+        if month is not None:
+            return MonthlySummary.total_of(session, target_user_id, month,
+                                           MonthlySummaryModel.total_outcome)
+
+        outcome = session.query(func.sum(OutcomeModel.amount).label("amount")).filter(
+            OutcomeModel.user_id == target_user_id,
+            OutcomeModel.date_created>=first_date,OutcomeModel.date_created<=last_date).all()
 
         return outcome
     
     @staticmethod
-    async def get_all() -> List[OutcomeModel]:
+    @with_session
+    def get_all(session, after_id: int = 0, limit: int = 100) -> List[OutcomeModel]:
+        """
+        Get a page of Outcome data, ordered by id
+        @param after_id: Only Outcome with an id greater than this one
+        @param limit: Maximum number of Outcome in the page
+        @return: List of Outcome object
+        """
+        outcome = session.query(OutcomeModel).filter(
+            OutcomeModel.id > after_id).order_by(OutcomeModel.id).limit(limit).all()
+        OutcomeCategory.cache.attach(session, outcome, "outcome_category", "outcome_category_id")
+        return outcome
+
+    @staticmethod
+    @with_session
+    def get_all_by_user_id(session, target_user_id: int, after_id: int = 0,
+                           limit: int = 100) -> List[OutcomeModel]:
         """
-        Get all result of Outcome data
+        Get a page of Outcome data of a User, ordered by id
+        @param target_user_id: The id of the User
+        @param after_id: Only Outcome with an id greater than this one
+        @param limit: Maximum number of Outcome in the page
         @return: List of Outcome object
         """
-        with get_session() as session:
-            outcome = session.query(OutcomeModel).all()
+        outcome = session.query(OutcomeModel).filter(
+            OutcomeModel.user_id == target_user_id,
+            OutcomeModel.id > after_id).order_by(OutcomeModel.id).limit(limit).all()
+        OutcomeCategory.cache.attach(session, outcome, "outcome_category", "outcome_category_id")
         return outcome
 
     @staticmethod
-    async def add(user_id:str, outcome_category_id:int,description:str, amount:int, date_spend:date) -> OutcomeModel:
+    def stream_all(after_id: int = 0, target_user_id: int = None) -> Iterator[OutcomeModel]:
+        """
+        Stream Outcome data ordered by id with a server side cursor, so memory
+        stays flat whatever the number of rows
+        @param after_id: Only Outcome with an id greater than this one
+        @param target_user_id: Only Outcome of this User when given
+        @return: Generator of Outcome object
+        """
+        with get_session("Outcome.stream_all") as session:
+            query = session.query(OutcomeModel).filter(OutcomeModel.id > after_id)
+            if target_user_id is not None:
+                query = query.filter(OutcomeModel.user_id == target_user_id)
+            yield from query.order_by(OutcomeModel.id).yield_per(STREAM_YIELD_PER)
+
+    @staticmethod
+    async def add(user_id: int, outcome_category_id: int, description: str, amount: int,
+                  date_spend: date) -> OutcomeModel:
         """
-        Create Outcome object and add it to the database
-        @param last_layer: Outcome last_layer
-        @param last_room: Outcome last_room
+        Create Outcome object and add it to the database. With WRITE_BEHIND
+        the request transaction is committed first, then the row is queued
+        and committed with the other rows of its group.
+        @param user_id: The id of the User
+        @param outcome_category_id: The id of the OutcomeCategory
+        @param description: Outcome description
+        @param amount: Outcome amount
+        @param date_spend: Day the amount was spent
         @return: Outcome object
         """
-        with get_session() as session:
-            outcome = OutcomeModel(user_id=user_id,outcome_category_id=outcome_category_id,description=description, amount=amount,date_spend=date_spend)
-            session.add(outcome)
-            session.commit()
-            session.flush()
-            session.refresh(outcome)
+        if not Outcome.queue.enabled:
+            return await Outcome._add(user_id, outcome_category_id, description, amount, date_spend)
+
+        row = {"outcome_category_id": outcome_category_id,
+               "description": description,
+               "amount": Decimal(str(amount)),
+               "date_spend": date_spend,
+               "date_created": datetime.now()}
+        # The queue may wait for a connection of its own, the request gives its back first
+        await release_request_session()
+        outcome = OutcomeModel(id=await Outcome.queue.submit(user_id, row), user_id=user_id, **row)
+        make_transient_to_detached(outcome)
+        return outcome
 
-            return outcome
+    @staticmethod
+    @with_session
+    def _add(session, user_id:str, outcome_category_id:int,description:str, amount:int, date_spend:date) -> OutcomeModel:
+        outcome = OutcomeModel(user_id=user_id,outcome_category_id=outcome_category_id,description=description, amount=amount,date_spend=date_spend)
+        session.add(outcome)
+        session.flush()
+        session.refresh(outcome)
+        Outcome._apply_delta(session, outcome.user_id, outcome.date_created, outcome.amount)
+
+        return outcome
+
+    @staticmethod
+    @with_session
+    def insert_group(session, rows: List[Tuple[int, dict]]) -> List[int]:
+        """
+        Insert the Outcome rows of a write-behind group in one transaction,
+        one multi-row INSERT per User
+        @param rows: (user id, dict of the Outcome columns) per row
+        @return: List of the new Outcome ids, in the order of rows
+        """
+        positions = {}
+        for position, (user_id, row) in enumerate(rows):
+            positions.setdefault(user_id, []).append(position)
+        ids = [None] * len(rows)
+        for user_id, user_positions in positions.items():
+            new_ids = Outcome._insert_bulk(session, user_id, [rows[position][1] for position in user_positions])
+            for position, new_id in zip(user_positions, new_ids):
+                ids[position] = new_id
+        return ids
     
     @staticmethod
-    async def update_by_id(target_id: int, new_obj:OutcomeModel) -> OutcomeModel:
+    @with_session
+    def add_bulk(session, user_id: int, rows: List[dict]) -> List[int]:
         """
-        Update Outcome object that have the specific id
-        @param taget_id: Outcome id
-        @param new_obj: Outcome Outcome new set of data
-        @return: Outcome object
+        Insert many Outcome of a User with one multi-row INSERT, in the request
+        transaction
+        @param user_id: The id of the User
+        @param rows: dict of the Outcome columns per row, date_created defaults to now
+        @return: List of the new Outcome ids, in the order of rows
+        """
+        return Outcome._insert_bulk(session, user_id, rows)
+
+    @staticmethod
+    def _insert_bulk(session, user_id: int, rows: List[dict]) -> List[int]:
+        """
+        Insert many Outcome of a User with one multi-row INSERT in the caller
+        session and apply their deltas (see insert_rows for how the new ids are
+        read).
+        @param user_id: The id of the User
+        @param rows: dict of the Outcome columns per row, date_created defaults to now
+        @return: List of the new Outcome ids, in the order of rows
+        """
+        now = datetime.now()
+        values = [dict(row, user_id=user_id, date_created=row.get("date_created") or now)
+                  for row in rows]
+        ids = insert_rows(session, OutcomeModel, values)
+
+        # One delta per month instead of one per row
+        months = {}
+        for value in values:
+            day, amount = months.get(MonthlySummary.month_of(value["date_created"]),
+                                     (value["date_created"], 0))
+            months[MonthlySummary.month_of(day)] = (day, amount + value["amount"])
+        for day, amount in months.values():
+            Outcome._apply_delta(session, user_id, day, amount)
+
+        return ids
+
+    @staticmethod
+    @with_session
+    def update_by_id(sess, target_id: int, values: dict) -> Tuple[int, Optional[OutcomeModel]]:
+        """
+        Update Outcome object that have the specific id. The row is only read
+        first when the amount, the date or the category changes, for the
+        deltas of the derived tables, the update itself is one statement.
+        @param target_id: Outcome id
+        @param values: dict of column name and new value
+        @return: (number of rows matched, updated Outcome object where the
+                 backend supports UPDATE .. RETURNING, None otherwise)
+        """
+        criteria = OutcomeModel.id == int(target_id)
+        old = None
+        if "amount" in values or "date_created" in values or "outcome_category_id" in values:
+            old = sess.query(OutcomeModel.user_id, OutcomeModel.amount,
+                             OutcomeModel.date_created).filter(criteria).with_for_update().first()
+            if not old:
+                return 0, None
+
+        matched, outcome = update_returning(sess, OutcomeModel, criteria, values)
+        if old and ("amount" in values or "date_created" in values):
+            new_amount = Decimal(str(values.get("amount", old.amount)))
+            new_date = values.get("date_created") or old.date_created
+            if MonthlySummary.month_of(old.date_created) == MonthlySummary.month_of(new_date):
+                Outcome._apply_delta(sess, old.user_id, old.date_created, new_amount - old.amount)
+            else:
+                Outcome._apply_delta(sess, old.user_id, old.date_created, -old.amount)
+                Outcome._apply_delta(sess, old.user_id, new_date, new_amount)
+        elif old:
+            # Only the category changed, the totals of the derived tables stay
+            aggregate_cache.bump(sess, "outcome", old.user_id)
+        return matched, outcome
+
+    @staticmethod
+    @with_session
+    def delete_by_id(sess, target_id: int) -> int:
+        """
+        Delete Outcome object that have the specific id and take its amount off
+        the derived tables
+        @param target_id: Outcome id
+        @return: Number of rows deleted
         """
-        with get_session() as sess:
-            sess.query(OutcomeModel).filter_by(id=int(target_id)).update(
-                    {
-                        OutcomeModel.outcome_category_id: new_obj.outcome_category_id,
-                        OutcomeModel.description : new_obj.description,
-                        OutcomeModel.amount: new_obj.amount,
-                        OutcomeModel.date_spend: new_obj.date_spend
-                        
-                    }
-                )
-            sess.commit()
-        return new_obj
-   
-    @staticmethod
-    async def delete_by_id(target_id: int):
-        """
-        Delete Outcome object that have the specific id
-        @param taget_id: Outcome id
-        """
-        try:
-            with get_session() as sess:
-            
-                try:
-                    sess.query(OutcomeModel).filter_by(id=int(target_id)).delete()
-                    sess.commit()
-                    sess.flush()
-                    
-                except Exception as e:
-                    sess.rollback()
-                    Debug.msg("OutcomeController|delete_by_id", "Failed to Delete {}".format(e), DebugLevel.ERROR)
-                    
-        except Exception as e:
-            Debug.msg("OutcomeController|delete_by_id", "Exception Raised {}".format(e), DebugLevel.ERROR)
+        deleted = delete_returning(sess, OutcomeModel, OutcomeModel.id == int(target_id),
+                                   OutcomeModel.user_id, OutcomeModel.amount, OutcomeModel.date_created)
+        for old in deleted:
+            Outcome._apply_delta(sess, old.user_id, old.date_created, -old.amount)
+        return len(deleted)
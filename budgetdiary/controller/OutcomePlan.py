@@ -1,185 +1,210 @@
 from typing import List
 from sqlalchemy.sql import func
-from datetime import date
-from sqlalchemy.orm import joinedload
-from ..__database import get_session
+from datetime import date, timedelta
+from decimal import Decimal
+from ..__database import with_session
+from ..cache import aggregate_cache
 from ..model.database import OutcomePlan as OutcomePlanModel
-from ..model.database import OutcomePlanCategory as OutcomePlanCategoryModel
-from ..utils import Debug, DebugLevel
+from ..model.database import OutcomeCategory as OutcomeCategoryModel
+from .BalanceCheckpoint import BalanceCheckpoint
+from .OutcomeCategory import OutcomeCategory
 
 class OutcomePlan:
     @staticmethod
-    async def get_by_id(target_id: int) -> OutcomePlanModel:
+    def _apply_delta(session, user_id: int, day: date, amount):
+        """
+        Keep the derived data of a User in step with an OutcomePlan write, in
+        the same session as the write
+        @param user_id: The id of the User
+        @param day: date_created of the OutcomePlan
+        @param amount: Amount added, negative when removed
+        """
+        BalanceCheckpoint.apply_delta(session, user_id, day, outcome_plan=amount)
+        aggregate_cache.bump(session, "outcome_plan", user_id)
+
+    @staticmethod
+    @with_session
+    def get_by_id(session, target_id: int) -> OutcomePlanModel:
         """
         Get the first result of OutcomePlan by its id
         @param target_id: The id of the OutcomePlan data
         @return: OutcomePlan object
         """
-        with get_session() as session:
-            outcome_plan = session.query(OutcomePlanModel).filter_by(id=target_id).first()
+        outcome_plan = session.query(OutcomePlanModel).filter_by(id=target_id).first()
 
         return outcome_plan
 
     @staticmethod
-    async def get_outcome_plan() -> OutcomePlanModel:
+    @with_session
+    def get_outcome_plan(session, target_user_id: int) -> OutcomePlanModel:
         """
-        Get the first result of OutcomePlan by its id
-        @param target_id: The id of the OutcomePlan data
-        @return: OutcomePlan object
+        Get sum result of OutcomePlan data of a User
+        @param target_user_id: The id of the User
+        @return: int value of the sum result
         """
-        with get_session() as session:
-            outcome_plan = session.query(func.sum(OutcomePlanModel.amount).label("amount")).all()
+        outcome_plan = session.query(func.sum(OutcomePlanModel.amount).label("amount")).filter(
+            OutcomePlanModel.user_id == target_user_id).all()
 
         return outcome_plan
 
     @staticmethod
-    async def get_last_outcome_plan(data_date:date) -> OutcomePlanModel:
+    @with_session
+    def get_last_outcome_plan(session, target_user_id: int, data_date:date) -> OutcomePlanModel:
         """
-        Get the first result of OutcomePlan by its id
-        @param target_id: The id of the OutcomePlan data
-        @return: OutcomePlan object
+        Get sum result of OutcomePlan data of a User before a date, from the
+        last BalanceCheckpoint and the OutcomePlan of the month of the date
+        @param target_user_id: The id of the User
+        @return: int value of the sum result
         """
-        with get_session() as session:
-            outcome_plan = session.query(func.sum(OutcomePlanModel.amount).label("amount")
-            ).filter(OutcomePlanModel.date_created<data_date).all()
+        outcome_plan = BalanceCheckpoint.total_before(session, target_user_id, data_date, OutcomePlanModel)
 
         return outcome_plan
 
-    
     @staticmethod
-    async def get_specific_latest_outcome_plan(keyword:str,outcome_plan_category:int) -> OutcomePlanModel:
+    @with_session
+    def get_specific_latest_outcome_plan(session, target_user_id: int, keyword:str,outcome_category:int) -> OutcomePlanModel:
         """
-        Get the first result of OutcomePlan by its outcome_plan_category id and depend on the keyword
-        @param target_id: The id of the OutcomePlan data
+        Get the latest OutcomePlan of a User in an outcome_category whose description matches the keyword
+        @param target_user_id: The id of the User
+        @param keyword: LIKE pattern matched against the description, case insensitive
+        @param outcome_category: The id of the OutcomeCategory
         @return: OutcomePlan object
         """
-        with get_session() as session:
-            outcome_plan = session.query(OutcomePlanModel).options(joinedload(OutcomePlanModel.outcome_plan_category), joinedload(OutcomePlanModel.outcome_plan_category)
-            ).filter(OutcomePlanModel.outcome_plan_category==outcome_plan_category,func.lower(OutcomePlanModel.description.like(keyword))
-                ).order_by(OutcomePlanModel.date_created.desc()).first()
+        outcome_plan = session.query(OutcomePlanModel).filter(OutcomePlanModel.user_id == target_user_id, OutcomePlanModel.outcome_category_id==outcome_category,
+                 func.lower(OutcomePlanModel.description).like(func.lower(keyword))
+            ).order_by(OutcomePlanModel.date_created.desc()).first()
+        if outcome_plan:
+            OutcomeCategory.cache.attach(session, [outcome_plan], "outcome_category", "outcome_category_id")
 
         return outcome_plan
   
     @staticmethod
-    async def get_daily_outcome_plan(target_date: date) -> OutcomePlanModel:
+    @with_session
+    def get_daily_outcome_plan(session, target_user_id: int, target_date: date) -> OutcomePlanModel:
         """
-        Get the first result of OutcomePlan by its id
-        @param target_id: The id of the OutcomePlan data
-        @return: OutcomePlan object
+        Get the OutcomePlan of a User created on a day
+        @param target_user_id: The id of the User
+        @return: List of OutcomePlan object
         """
-        with get_session() as session:
-            outcome_plan = session.query(OutcomePlanModel).options(joinedload(OutcomePlanModel.outcome_plan_category), joinedload(OutcomePlanModel.outcome_plan_category)
-            ).filter_by(date_created=target_date).all()
+        outcome_plan = session.query(OutcomePlanModel).filter(OutcomePlanModel.user_id == target_user_id, OutcomePlanModel.date_created>=target_date,
+                 OutcomePlanModel.date_created<target_date + timedelta(days=1)).all()
+        OutcomeCategory.cache.attach(session, outcome_plan, "outcome_category", "outcome_category_id")
 
         return outcome_plan
     
     @staticmethod
-    async def get_monthly_outcome_plan(first_date: date, last_date: date) -> OutcomePlanModel:
+    @with_session
+    def get_monthly_outcome_plan(session, target_user_id: int, first_date: date, last_date: date) -> OutcomePlanModel:
         """
-        Get the first result of OutcomePlan by its id
-        @param target_id: The id of the OutcomePlan data
-        @return: OutcomePlan object
+        Get the OutcomePlan of a User between two dates
+        @param target_user_id: The id of the User
+        @return: List of OutcomePlan object
         """
-        with get_session() as session:
-            outcome_plan = session.query(OutcomePlanModel).options(joinedload(OutcomePlanModel.outcome_plan_category), joinedload(OutcomePlanModel.outcome_plan_category)
-            ).filter(OutcomePlanModel.date_created>=first_date,OutcomePlanModel.date_created<=last_date).order_by(OutcomePlanModel.date_created).all()
+        outcome_plan = session.query(OutcomePlanModel).filter(OutcomePlanModel.user_id == target_user_id, OutcomePlanModel.date_created>=first_date,
+                 OutcomePlanModel.date_created<=last_date).order_by(OutcomePlanModel.date_created).all()
+        OutcomeCategory.cache.attach(session, outcome_plan, "outcome_category", "outcome_category_id")
 
         return outcome_plan
 
     @staticmethod
-    async def get_group_outcome_plan() -> List[OutcomePlanModel]:
-        """
-        Get all result of OutcomePlan data
-        @return: List of OutcomePlan object
-        """
-        with get_session() as session:
-            income = session.query(
-                func.sum(OutcomePlanModel.amount).label("amount"),
-                OutcomePlanCategoryModel.name.label("name")).join(
-                    OutcomePlanCategoryModel).group_by(
-                            OutcomePlanCategoryModel.name
-            ).order_by(OutcomePlanCategoryModel.name).all()
-        return income
+    @aggregate_cache("outcome_plan", "outcome_category")
+    @with_session
+    def get_group_outcome_plan(session, target_user_id: int) -> List[OutcomePlanModel]:
+        """
+        Get the OutcomePlan total of a User per category
+        @param target_user_id: The id of the User
+        @return: List of amount and name rows
+        """
+        outcome_plan = session.query(
+            func.sum(OutcomePlanModel.amount).label("amount"),
+            OutcomeCategoryModel.name.label("name")).join(
+                OutcomeCategoryModel).filter(
+                    OutcomePlanModel.user_id == target_user_id).group_by(
+                        OutcomeCategoryModel.name
+        ).order_by(OutcomeCategoryModel.name).all()
+        return outcome_plan
 
     @staticmethod
-    async def get_monthly_total(first_date: date, last_date: date) -> OutcomePlanModel:
+    @aggregate_cache("outcome_plan")
+    @with_session
+    def get_monthly_total(session, target_user_id: int, first_date: date, last_date: date) -> OutcomePlanModel:
         """
-        Get the first result of OutcomePlan by its id
-        @param target_id: The id of the OutcomePlan data
-        @return: OutcomePlan object
+        Get sum result of OutcomePlan data of a User between two dates
+        @param target_user_id: The id of the User
+        @return: int value of the sum result
         """
-        with get_session() as session:
-            outcome_plan = session.query(func.sum(OutcomePlanModel.amount).label("amount")).filter(
-                OutcomePlanModel.date_created>=first_date,OutcomePlanModel.date_created<=last_date).all()
+        outcome_plan = session.query(func.sum(OutcomePlanModel.amount).label("amount")).filter(
+            OutcomePlanModel.user_id == target_user_id,
+            OutcomePlanModel.date_created>=first_date,OutcomePlanModel.date_created<=last_date).all()
 
         return outcome_plan
     
     @staticmethod
-    async def get_all() -> List[OutcomePlanModel]:
+    @with_session
+    def get_all(session) -> List[OutcomePlanModel]:
         """
         Get all result of OutcomePlan data
         @return: List of OutcomePlan object
         """
-        with get_session() as session:
-            outcome_plan = session.query(OutcomePlanModel).all()
+        outcome_plan = session.query(OutcomePlanModel).all()
         return outcome_plan
 
     @staticmethod
-    async def add(user_id:str, outcome_plan_category_id:int,description:str, amount:int, quantity:int, date_spend:date) -> OutcomePlanModel:
+    @with_session
+    def add(session, user_id:str, outcome_category_id:int,description:str, amount:int, date_spend:date) -> OutcomePlanModel:
         """
         Create OutcomePlan object and add it to the database
         @param last_layer: OutcomePlan last_layer
         @param last_room: OutcomePlan last_room
         @return: OutcomePlan object
         """
-        with get_session() as session:
-            outcome_plan = OutcomePlanModel(user_id=user_id,outcome_plan_category_id=outcome_plan_category_id,description=description, amount=amount,quantity=quantity,date_spend=date_spend)
-            session.add(outcome_plan)
-            session.commit()
-            session.flush()
-            session.refresh(outcome_plan)
+        outcome_plan = OutcomePlanModel(user_id=user_id,outcome_category_id=outcome_category_id,description=description, amount=amount,date_spend=date_spend)
+        session.add(outcome_plan)
+        session.flush()
+        session.refresh(outcome_plan)
+        OutcomePlan._apply_delta(session, outcome_plan.user_id, outcome_plan.date_created, outcome_plan.amount)
 
-            return outcome_plan
+        return outcome_plan
     
     @staticmethod
-    async def update_by_id(target_id: int, new_obj:OutcomePlanModel) -> OutcomePlanModel:
+    @with_session
+    def update_by_id(sess, target_id: int, new_obj:OutcomePlanModel) -> OutcomePlanModel:
         """
         Update OutcomePlan object that have the specific id
         @param taget_id: OutcomePlan id
         @param new_obj: OutcomePlan OutcomePlan new set of data
         @return: OutcomePlan object
         """
-        with get_session() as sess:
-            sess.query(OutcomePlanModel).filter_by(id=int(target_id)).update(
-                    {
-                        OutcomePlanModel.outcome_plan_category_id: new_obj.outcome_plan_category_id,
-                        OutcomePlanModel.description : new_obj.description,
-                        OutcomePlanModel.amount: new_obj.amount,
-                        OutcomePlanModel.quantity: new_obj.quantity,
-                        OutcomePlanModel.date_spend: new_obj.date_spend
-                        
-                    }
-                )
-            sess.commit()
+        old = sess.query(OutcomePlanModel.user_id, OutcomePlanModel.amount,
+                         OutcomePlanModel.date_created).filter_by(
+                             id=int(target_id)).with_for_update().first()
+        if not old:
+            return None
+
+        sess.query(OutcomePlanModel).filter_by(id=int(target_id)).update(
+                {
+                    OutcomePlanModel.outcome_category_id: new_obj.outcome_category_id,
+                    OutcomePlanModel.description : new_obj.description,
+                    OutcomePlanModel.amount: new_obj.amount,
+                    OutcomePlanModel.date_spend: new_obj.date_spend
+                    
+                }
+            )
+        OutcomePlan._apply_delta(sess, old.user_id, old.date_created,
+                                 Decimal(str(new_obj.amount)) - old.amount)
         return new_obj
    
     @staticmethod
-    async def delete_by_id(target_id: int):
+    @with_session
+    def delete_by_id(sess, target_id: int):
         """
         Delete OutcomePlan object that have the specific id
         @param taget_id: OutcomePlan id
         """
-        try:
-            with get_session() as sess:
-            
-                try:
-                    sess.query(OutcomePlanModel).filter_by(id=int(target_id)).delete()
-                    sess.commit()
-                    sess.flush()
-                    
-                except Exception as e:
-                    sess.rollback()
-                    Debug.msg("OutcomePlanController|delete_by_id", "Failed to Delete {}".format(e), DebugLevel.ERROR)
-                    
-        except Exception as e:
-            Debug.msg("OutcomePlanController|delete_by_id", "Exception Raised {}".format(e), DebugLevel.ERROR)
+        old = sess.query(OutcomePlanModel.user_id, OutcomePlanModel.amount,
+                         OutcomePlanModel.date_created).filter_by(
+                             id=int(target_id)).with_for_update().first()
+        if old:
+            sess.query(OutcomePlanModel).filter_by(id=int(target_id)).delete()
+            OutcomePlan._apply_delta(sess, old.user_id, old.date_created, -old.amount)
+        sess.flush()
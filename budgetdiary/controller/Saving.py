@@ -1,107 +1,101 @@
-from typing import List
+from typing import List, Iterator, Optional, Tuple
 from datetime import date
-from sqlalchemy.sql import func
-from sqlalchemy.orm import joinedload
-from ..__database import get_session
+from ..__database import with_session, get_session, update_returning, STREAM_YIELD_PER
 from ..model.database import Saving as SavingModel
-from ..utils import Debug, DebugLevel
 
 class Saving:
     @staticmethod
-    async def get_by_id(target_id: int) -> SavingModel:
+    @with_session
+    def get_by_id(session, target_id: int) -> SavingModel:
         """
         Get the first result of Saving by its id
         @param target_id: The id of the Saving data
         @return: Saving object
         """
-        with get_session() as session:
-            saving = session.query(SavingModel).options(
-                joinedload(SavingModel.user)).filter_by(id=target_id).first()
+        saving = session.query(SavingModel).filter_by(id=target_id).first()
 
         return saving
     
     @staticmethod
-    async def get_all_by_user_id(target_user_id: int) -> SavingModel:
+    @with_session
+    def get_all(session, after_id: int = 0, limit: int = 100) -> List[SavingModel]:
         """
-        Get the all result of Saving by its id
-        @param target_id: The id of the Saving data
-        @return: Saving object
+        Get a page of Saving data, ordered by id
+        @param after_id: Only Saving with an id greater than this one
+        @param limit: Maximum number of Saving in the page
+        @return: List of Saving object
         """
-        with get_session() as session:
-            saving = session.query(SavingModel).options(
-                joinedload(SavingModel.user)).filter_by(id=target_user_id).all()
-
+        saving = session.query(SavingModel).filter(
+            SavingModel.id > after_id).order_by(SavingModel.id).limit(limit).all()
         return saving
 
     @staticmethod
-    async def get_all() -> List[SavingModel]:
+    @with_session
+    def get_all_by_user_id(session, target_user_id: int, after_id: int = 0,
+                           limit: int = 100) -> List[SavingModel]:
         """
-        Get all result of Saving data
+        Get a page of Saving data of a User, ordered by id
+        @param target_user_id: The id of the User
+        @param after_id: Only Saving with an id greater than this one
+        @param limit: Maximum number of Saving in the page
         @return: List of Saving object
         """
-        with get_session() as session:
-            saving = session.query(SavingModel).options(
-                joinedload(SavingModel.user)).all()
+        saving = session.query(SavingModel).filter(
+            SavingModel.user_id == target_user_id,
+            SavingModel.id > after_id).order_by(SavingModel.id).limit(limit).all()
         return saving
 
     @staticmethod
-    async def add(description: str, amount: float, due_date: date) -> SavingModel:
+    def stream_all(after_id: int = 0, target_user_id: int = None) -> Iterator[SavingModel]:
+        """
+        Stream Saving data ordered by id with a server side cursor, so memory
+        stays flat whatever the number of rows
+        @param after_id: Only Saving with an id greater than this one
+        @param target_user_id: Only Saving of this User when given
+        @return: Generator of Saving object
+        """
+        with get_session("Saving.stream_all") as session:
+            query = session.query(SavingModel).filter(SavingModel.id > after_id)
+            if target_user_id is not None:
+                query = query.filter(SavingModel.user_id == target_user_id)
+            yield from query.order_by(SavingModel.id).yield_per(STREAM_YIELD_PER)
+
+    @staticmethod
+    @with_session
+    def add(session, description: str, amount: float, due_date: date) -> SavingModel:
         """
         Create Saving object and add it to the database
         @param last_layer: Saving last_layer
         @param last_room: Saving last_room
         @return: Saving object
         """
-        with get_session() as session:
-            saving = SavingModel(description=description,
-                                 amount=amount,
-                                 due_date=due_date)
-            session.add(saving)
-            session.commit()
-            session.flush()
-            session.refresh(saving)
+        saving = SavingModel(description=description,
+                             amount=amount,
+                             due_date=due_date)
+        session.add(saving)
+        session.flush()
+        session.refresh(saving)
 
-            return saving
+        return saving
 
     @staticmethod
-    async def update_by_id(target_id: int,
-                           new_obj: SavingModel) -> SavingModel:
+    @with_session
+    def update_by_id(sess, target_id: int, values: dict) -> Tuple[int, Optional[SavingModel]]:
         """
-        Update Saving object that have the specific id
-        @param taget_id: Saving id
-        @param new_obj: Saving Saving new set of data
-        @return: Saving object
+        Update Saving object that have the specific id in one statement
+        @param target_id: Saving id
+        @param values: dict of column name and new value
+        @return: (number of rows matched, updated Saving object where the
+                 backend supports UPDATE .. RETURNING, None otherwise)
         """
-        with get_session() as sess:
-            sess.query(SavingModel).filter_by(id=int(target_id)).update({
-                SavingModel.description:new_obj.description,
-                SavingModel.amount:new_obj.amount,
-                SavingModel.due_date:new_obj.due_date
-            })
-            sess.commit()
-        return new_obj
+        return update_returning(sess, SavingModel, SavingModel.id == int(target_id), values)
 
     @staticmethod
-    async def delete_by_id(target_id: int):
+    @with_session
+    def delete_by_id(sess, target_id: int) -> int:
         """
-        Delete Saving object that have the specific id
-        @param taget_id: Saving id
+        Delete Saving object that have the specific id in one statement
+        @param target_id: Saving id
+        @return: Number of rows deleted
         """
-        try:
-            with get_session() as sess:
-
-                try:
-                    sess.query(SavingModel).filter_by(
-                        id=int(target_id)).delete()
-                    sess.commit()
-                    sess.flush()
-
-                except Exception as e:
-                    sess.rollback()
-                    Debug.msg("SavingController|delete_by_id",
-                              "Failed to Delete {}".format(e),
-                              DebugLevel.WARNING)
-
-        except Exception as e:
-            Debug.msg("SavingController|delete_by_id",
-                      "Exception Raised {}".format(e), DebugLevel.ERROR)
+        return sess.query(SavingModel).filter_by(id=int(target_id)).delete()
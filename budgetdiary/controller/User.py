@@ -1,236 +1,305 @@
-import hashlib, os
-from typing import List
-from sqlalchemy.orm import joinedload
-from ..__database import get_session
+import os
+from datetime import datetime
+from decimal import Decimal
+from typing import List, Iterator, Optional, Tuple
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from ..__database import with_session, get_session, after_commit, update_returning, release_request_session, STREAM_YIELD_PER
+from ..cache import LRUCache, aggregate_cache
+from ..pin import pin_hasher
 from ..model.database import User as UserModel
-from ..utils import Debug, DebugLevel
+from ..utils import Debug, DebugLevel, Util
+
+# Bound and lifetime (seconds) of the User cache
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 1024))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 60))
 
 class User:
+    # Users by ("id", id) and by ("discord_username", discord_username)
+    cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+    @staticmethod
+    def _copy(user: UserModel) -> UserModel:
+        """
+        Detached copy of a User, callers may change it freely
+        @param user: User object
+        @return: User object
+        """
+        copy = UserModel(**Util.to_dict(user))
+        make_transient_to_detached(copy)
+        return copy
+
+    @staticmethod
+    def _cached(session, key: tuple, query) -> UserModel:
+        """
+        Get a User from the cache, or from the query and cache it under both
+        keys. Nothing is cached from a session that has uncommitted writes.
+        @param key: ("id", id) or ("discord_username", discord_username)
+        @param query: Query returning the User
+        @return: User object
+        """
+        user = User.cache.get(key)
+        if user is None:
+            # A write forgetting a User while the query runs bumps the version,
+            # the row read before it is then not cached
+            version = User.cache.version
+            user = query.first()
+            if user is None:
+                return None
+            if not session.info.get("after_commit"):
+                snapshot = User._copy(user)
+                if User.cache.put(("id", user.id), snapshot, version):
+                    User.cache.put(("discord_username", user.discord_username), snapshot, version)
+            return user
+        return User._copy(user)
+
+    @staticmethod
+    def _forget(session, target_id: int = None, discord_username: str = None):
+        """
+        Drop a User from the cache now and again once the write commits, so a
+        read racing the write can not cache the old row for long
+        @param target_id: The id of the User
+        @param discord_username: The discord username of the User
+        """
+        def forget():
+            keys = []
+            if target_id is not None:
+                keys.append(("id", int(target_id)))
+            if discord_username is not None:
+                keys.append(("discord_username", discord_username))
+            for key in list(keys):
+                user = User.cache.peek(key)
+                if user is not None:
+                    keys += [("id", user.id), ("discord_username", user.discord_username)]
+            User.cache.invalidate(*keys)
+
+        forget()
+        after_commit(session, forget)
+
+    @staticmethod
+    def apply_balance_delta(session, target_id: int, delta):
+        """
+        Add an amount to the balance of a User with an atomic
+        balance = balance + delta, in the session of the ledger write
+        @param target_id: The id of the User
+        @param delta: Amount added, negative when removed
+        """
+        session.query(UserModel).filter_by(id=int(target_id)).update(
+            {UserModel.balance: UserModel.balance + delta}, synchronize_session=False)
+        User._forget(session, target_id)
+        aggregate_cache.bump(session, "user", int(target_id))
+
     @staticmethod
-    async def get_by_id(target_id: int) -> UserModel:
+    @with_session
+    def get_by_id(session, target_id: int) -> UserModel:
         """
         Get the User object by its id
         @param target_id: The id of the User data
         @return: User object
         """
-        with get_session() as session:
-            user = session.query(UserModel).filter_by(id=target_id).first()
+        user = User._cached(session, ("id", int(target_id)),
+                            session.query(UserModel).filter_by(id=target_id))
 
         return user
 
-    async def get_by_discord_username(target_username: str) -> UserModel:
+    @staticmethod
+    @with_session
+    def get_by_discord_username(session, target_username: str) -> UserModel:
         """
-        Get the first result of User by its id
-        @param target_id: The id of the User data
+        Get the User object by its discord username
+        @param target_username: The discord username of the User
         @return: User object
         """
-        with get_session() as session:
-            data = session.query(UserModel).filter_by(discord_username=target_username).first()
+        data = User._cached(session, ("discord_username", target_username),
+                            session.query(UserModel).filter_by(discord_username=target_username))
 
         return data
     
     @staticmethod
-    async def get_all() -> UserModel:
+    @with_session
+    def get_all(session, after_id: int = 0, limit: int = 100) -> List[UserModel]:
         """
-        Get the User object by its username
-        @param target_id: The id of the User data
-        @return: User object
+        Get a page of User data, ordered by id
+        @param after_id: Only User with an id greater than this one
+        @param limit: Maximum number of User in the page
+        @return: List of User object
         """
-        with get_session() as session:
-            user = session.query(UserModel).all()
+        user = session.query(UserModel).filter(
+            UserModel.id > after_id).order_by(UserModel.id).limit(limit).all()
         return user
 
     @staticmethod
-    async def add(discord_username: str, pin: str) -> UserModel:
+    def stream_all(after_id: int = 0) -> Iterator[UserModel]:
+        """
+        Stream User data ordered by id with a server side cursor, so memory
+        stays flat whatever the number of rows
+        @param after_id: Only User with an id greater than this one
+        @return: Generator of User object
+        """
+        with get_session("User.stream_all") as session:
+            yield from session.query(UserModel).filter(UserModel.id > after_id).order_by(
+                UserModel.id).yield_per(STREAM_YIELD_PER)
+
+    @staticmethod
+    @with_session
+    def add(session, discord_username: str, pin: str) -> Optional[UserModel]:
         """
-        Add a new User object to the database
+        Add a new User object to the database with one INSERT and no read
+        first: the unique discord_username index decides between concurrent
+        sign-ups of the same name
         @param discord_username: Discord username of the user
-        @param pin: PIN of the user
-        @param balance: balance of the user
-        @return: User object
+        @param pin: Encrypted PIN of the user
+        @return: User object, None when the discord username already exists
         """
-        with get_session() as session:
-            user = UserModel(discord_username=discord_username,
-                                 pin=pin)
-            session.add(user)
-            session.commit()
-            session.flush()
-            session.refresh(user)
+        values = {"discord_username": discord_username,
+                  "pin": pin,
+                  "balance": Decimal("0.00"),
+                  "opening_balance": Decimal("0.00"),
+                  # DATETIME column, stored without fractional seconds
+                  "date_created": datetime.now().replace(microsecond=0)}
+        try:
+            result = session.execute(insert(UserModel).values(values))
+        except IntegrityError:
+            return None
 
-            return user
+        user = UserModel(id=result.inserted_primary_key[0], **values)
+        make_transient_to_detached(user)
+        return user
 
     @staticmethod
-    async def update_by_id(target_id: int,
-                           new_obj: UserModel) -> UserModel:
+    def _correct_balance(session, criteria, values: dict) -> dict:
+        """
+        A balance set by hand is a correction: shift opening_balance by the
+        same amount, so balance stays opening_balance plus the ledger
+        @param criteria: WHERE clause of the User to update
+        @param values: dict of column name and new value
+        @return: dict of the values to update
         """
-        Update the User object by its id
+        if values.get("balance") is None:
+            return values
+        current = session.query(UserModel.id, UserModel.balance).filter(criteria).with_for_update().first()
+        if current is None:
+            return values
+        aggregate_cache.bump(session, "user", current.id)
+        return dict(values, opening_balance=UserModel.opening_balance
+                    + (Decimal(str(values["balance"])) - current.balance))
+
+    @staticmethod
+    @with_session
+    def update_by_id(sess, target_id: int, values: dict) -> Tuple[int, Optional[UserModel]]:
+        """
+        Update the User object by its id in one statement
         @param target_id: Id of the User object to update
-        @param new_obj: New User object data
-        @return: Updated User object
-        """
-        with get_session() as sess:
-            sess.query(UserModel).filter_by(id=int(target_id)).update({
-                UserModel.discord_username:new_obj.discord_username,
-                UserModel.pin:new_obj.pin,
-                UserModel.balance:new_obj.balance
-            })
-            sess.commit()
-        return new_obj
-    
+        @param values: dict of column name and new value
+        @return: (number of rows matched, updated User object where the
+                 backend supports UPDATE .. RETURNING, None otherwise)
+        """
+        criteria = UserModel.id == int(target_id)
+        updated = update_returning(sess, UserModel, criteria, User._correct_balance(sess, criteria, values))
+        User._forget(sess, target_id, values.get("discord_username"))
+        return updated
+
     @staticmethod
-    async def update_by_discord_username(target_username: str,
-                           new_obj: UserModel) -> UserModel:
+    @with_session
+    def update_by_discord_username(sess, target_username: str,
+                                   values: dict) -> Tuple[int, Optional[UserModel]]:
         """
-        Update User object that have the specific id
-        @param taget_id: User id
-        @param new_obj: User User new set of data
-        @return: User object
+        Update User object that have the specific discord username in one statement
+        @param target_username: User discord username
+        @param values: dict of column name and new value
+        @return: (number of rows matched, updated User object where the
+                 backend supports UPDATE .. RETURNING, None otherwise)
         """
-        with get_session() as sess:
-            sess.query(UserModel).filter_by(id=int(target_username)).update({
-                UserModel.discord_username:new_obj.discord_username,
-                UserModel.pin:new_obj.pin,
-                UserModel.balance:new_obj.balance
-            })
-            sess.commit()
-        return new_obj
+        criteria = UserModel.discord_username == target_username
+        updated = update_returning(sess, UserModel, criteria, User._correct_balance(sess, criteria, values))
+        User._forget(sess, discord_username=target_username)
+        User._forget(sess, discord_username=values.get("discord_username"))
+        return updated
 
     @staticmethod
-    async def delete_by_id(target_id: int):
+    @with_session
+    def delete_by_id(sess, target_id: int) -> int:
         """
-        Delete the User object by its id
+        Delete the User object by its id in one statement
         @param target_id: Id of the User object to delete
-        @return: True if User object is deleted, False otherwise
+        @return: Number of rows deleted
         """
-        try:
-            with get_session() as sess:
-                try:
-                    sess.query(UserModel).filter_by(
-                        id=int(target_id)).delete()
-                    sess.flush()
-
-                except Exception as e:
-                    sess.rollback()
-                    Debug.msg("UserController|delete_by_id",
-                              "Failed to Delete {}".format(e),
-                              DebugLevel.WARNING)
-                    return False
-
-                try:
-                    sess.commit()
-                except Exception as e:
-                    sess.rollback()
-                    Debug.msg("UserController|delete_by_id",
-                              "Failed to commit transaction: {}".format(e),
-                              DebugLevel.ERROR)
-                    return False
-
-            return True
-
-        except Exception as e:
-            Debug.msg("UserController|delete_by_id",
-                      "Exception Raised {}".format(e), DebugLevel.ERROR)
-    @staticmethod
-    async def delete_by_discord_username(target_id: int) -> bool:
-        """
-        Delete User object that have the specific id
-        @param taget_id: User id
+        rows_affected = sess.query(UserModel).filter_by(id=int(target_id)).delete()
+        User._forget(sess, target_id)
+        return rows_affected
+
+    @staticmethod
+    @with_session
+    def delete_by_discord_username(sess, target_username: str) -> int:
         """
-        try:
-            with get_session() as sess:
-
-                try:
-                    rows_affected = sess.query(UserModel).filter_by(
-                        id=target_id).delete()
-                    sess.commit()
-                    sess.flush()
-                    return rows_affected > 0
-
-                except Exception as e:
-                    sess.rollback()
-                    Debug.msg("UserController|delete_by_id",
-                            "Failed to Delete {}".format(e),
-                            DebugLevel.WARNING)
-                    return False
-
-        except Exception as e:
-            Debug.msg("UserController|delete_by_id",
-                    "Exception Raised {}".format(e), DebugLevel.ERROR)
-            return False
-        
-    @staticmethod
-    async def delete_by_discord_username(target_username: str) -> bool:
-        """
-        Delete User object that have the specific discord username
+        Delete User object that have the specific discord username in one statement
         @param target_username: User discord username
+        @return: Number of rows deleted
         """
-        try:
-            with get_session() as sess:
-
-                try:
-                    rows_affected = sess.query(UserModel).filter_by(
-                        discord_username=target_username).delete()
-                    sess.commit()
-                    sess.flush()
-                    return rows_affected > 0
-
-                except Exception as e:
-                    sess.rollback()
-                    Debug.msg("UserController|delete_by_discord_username",
-                            "Failed to Delete {}".format(e),
-                            DebugLevel.WARNING)
-                    return False
-
-        except Exception as e:
-            Debug.msg("UserController|delete_by_discord_username",
-                    "Exception Raised {}".format(e), DebugLevel.ERROR)
-            return False
+        rows_affected = sess.query(UserModel).filter_by(
+            discord_username=target_username).delete()
+        User._forget(sess, discord_username=target_username)
+        return rows_affected
 
     @staticmethod
     async def update_pin_by_reset(discord_username:str) -> bool:
             enc_username = await User.encrypt_pin(discord_username)
-            with get_session() as sess:
-                    sess.query(UserModel).filter_by(discord_username=discord_username).update(
-                        {
-                            UserModel.pin: enc_username
-                        }
-                    )
-                    sess.commit()
-                    sess.flush()
-            return True
+            return await User.set_pin_by_discord_username(discord_username, enc_username)
     
     @staticmethod
     async def update_pin_by_change(discord_username:str, pin: str) -> bool:
             if not await User.authenticate(discord_username,pin):
                 return False
-            with get_session() as sess:
-                    sess.query(UserModel).filter_by(discord_username=discord_username).update(
-                        {
-                            UserModel.pin: await User.encrypt_pin(pin)
-                        }
-                    )
-                    sess.commit()
-                    sess.flush()
-            return True
+            return await User.set_pin_by_discord_username(discord_username, await User.encrypt_pin(pin))
+
+    @staticmethod
+    @with_session
+    def set_pin_by_discord_username(sess, discord_username:str, encrypted_pin: str) -> bool:
+        """
+        Store an already encrypted pin for the User with the discord username
+        @param discord_username: User discord username
+        @param encrypted_pin: Result of encrypt_pin
+        @return: True once the pin is stored
+        """
+        sess.query(UserModel).filter_by(discord_username=discord_username).update(
+            {
+                UserModel.pin: encrypted_pin
+            }
+        )
+        User._forget(sess, discord_username=discord_username)
+        sess.flush()
+        return True
 
     @staticmethod
     async def encrypt_pin(pin:str) -> str:
-        encoded = (pin+os.environ.get("SALT")).encode()
-        result = hashlib.sha256(encoded)
-        
-        return result.hexdigest()
+        """
+        Hash a pin with scrypt on the pin hashing processes
+        @param pin: Plain pin
+        @return: str hash to store, None without pin
+        """
+        if pin is None:
+            return None
+        # Hashing takes tens of milliseconds, the request keeps no connection meanwhile
+        await release_request_session()
+        return await pin_hasher.hash(pin)
 
     @staticmethod
     async def authenticate(discord_username:str, pin:str) -> bool :
         log_identifier = "UserController|check_pin"
 
-        result = await User.encrypt_pin(pin)
         data = await User.get_by_discord_username(discord_username)
         if not data:
             Debug.msg(log_identifier, "Data not found", DebugLevel.INFO)
             return None
-        if result!=data.pin:
+        await release_request_session()
+        matches, needs_rehash = await pin_hasher.verify(pin, data.pin)
+        if not matches:
             Debug.msg(log_identifier, "Wrong pin", DebugLevel.INFO)
             return None
+        if needs_rehash:
+            # Legacy SHA-256 or older scrypt cost, store a current hash
+            data.pin = await User.encrypt_pin(pin)
+            await User.set_pin_by_discord_username(discord_username, data.pin)
 
         return data
@@ -0,0 +1,177 @@
+import os, time
+from bisect import bisect_left
+from functools import wraps
+from typing import Dict, Tuple
+
+from starlette.routing import Match
+
+# Opt-in: request and controller timing, exposed on GET /metrics
+METRICS = os.environ.get("METRICS", "0").lower() in ("1", "true", "yes", "on")
+
+# Upper bounds (seconds) of the latency histogram buckets
+METRICS_BUCKETS = tuple(sorted(float(bound) for bound in os.environ.get(
+    "METRICS_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10").split(",")))
+
+# Clients allowed to read /metrics
+METRICS_HOSTS = {"127.0.0.1", "::1", "localhost"}
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, a count and a sum
+    """
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(METRICS_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+class Metrics:
+    """
+    Request latency per route template and status, and call latency per
+    controller method, with their error counts. Only updated from the event
+    loop, so no locking is needed.
+    """
+    def __init__(self):
+        self.requests: Dict[Tuple[str, str, str], Histogram] = {}
+        self.request_errors: Dict[Tuple[str, str], int] = {}
+        self.controllers: Dict[str, Histogram] = {}
+        self.controller_errors: Dict[str, int] = {}
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float, failed: bool):
+        key = (method, route, str(status))
+        histogram = self.requests.get(key)
+        if histogram is None:
+            histogram = self.requests[key] = Histogram()
+        histogram.observe(seconds)
+        if failed or status >= 500:
+            self.request_errors[(method, route)] = self.request_errors.get((method, route), 0) + 1
+
+    def observe_controller(self, name: str, seconds: float, failed: bool):
+        histogram = self.controllers.get(name)
+        if histogram is None:
+            histogram = self.controllers[name] = Histogram()
+        histogram.observe(seconds)
+        if failed:
+            self.controller_errors[name] = self.controller_errors.get(name, 0) + 1
+
+    def timed(self, name: str, func):
+        """
+        Wrap a coroutine function so every call is timed as controller name
+        @param name: Label of the calls
+        @param func: Coroutine function
+        @return: Coroutine function
+        """
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = await func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self.observe_controller(name, time.perf_counter() - started, failed)
+
+        return wrapper
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition of the metrics
+        @return: str in the text format 0.0.4
+        """
+        lines = []
+        self._histogram(lines, "budgetdiary_http_request_duration_seconds",
+                        "HTTP request latency by route template and status",
+                        [((("method", method), ("route", route), ("status", status)), histogram)
+                         for (method, route, status), histogram in sorted(self.requests.items())])
+        self._counter(lines, "budgetdiary_http_request_errors_total",
+                      "HTTP requests answered with a 5xx status or an unhandled exception",
+                      [((("method", method), ("route", route)), count)
+                       for (method, route), count in sorted(self.request_errors.items())])
+        self._histogram(lines, "budgetdiary_controller_duration_seconds",
+                        "Controller method call latency, waiting for the session included",
+                        [((("method", name),), histogram) for name, histogram in sorted(self.controllers.items())])
+        self._counter(lines, "budgetdiary_controller_errors_total",
+                      "Controller method calls that raised",
+                      [((("method", name),), count) for name, count in sorted(self.controller_errors.items())])
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(labels: tuple) -> str:
+        return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                        for name, value in labels)
+
+    @staticmethod
+    def _counter(lines: list, name: str, description: str, samples: list):
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} counter".format(name))
+        for labels, count in samples:
+            lines.append("{}{{{}}} {}".format(name, Metrics._labels(labels), count))
+
+    @staticmethod
+    def _histogram(lines: list, name: str, description: str, samples: list):
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} histogram".format(name))
+        for labels, histogram in samples:
+            label_text = Metrics._labels(labels)
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label_text, le, cumulative))
+            lines.append("{}_sum{{{}}} {}".format(name, label_text, repr(histogram.total)))
+            lines.append("{}_count{{{}}} {}".format(name, label_text, histogram.count))
+
+metrics = Metrics()
+
+def _route_template(scope) -> str:
+    # FastAPI releases including routers lazily keep the prefixed path there,
+    # scope["route"] is then the route of the router, without its prefix
+    effective = scope.get("fastapi", {}).get("effective_route_context")
+    if effective is not None:
+        return effective.path
+
+    route = scope.get("route")
+    if route is None:
+        # Starlette releases that do not record the matched route
+        for candidate in scope["app"].router.routes:
+            if candidate.matches(scope)[0] == Match.FULL:
+                route = candidate
+                break
+    # Unmatched paths share one label, any path would be a new series
+    return getattr(route, "path", None) or "unmatched"
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request, from its start until the
+    last byte of the response is sent, by method, route template and status
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        failed = True
+        try:
+            await self.app(scope, receive, send_with_status)
+            failed = False
+        finally:
+            metrics.observe_request(scope["method"], _route_template(scope), status[0],
+                                    time.perf_counter() - started, failed)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, DECIMAL, Date, DateTime, ForeignKey, String, text
+from sqlalchemy import Column, DECIMAL, Date, DateTime, ForeignKey, Index, String, text
 from sqlalchemy.dialects.mysql import INTEGER
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
@@ -29,14 +29,19 @@ class User(Base):
     discord_username = Column(String(200), nullable=False, unique=True)
     pin = Column(String(256))
     balance = Column(DECIMAL(12, 2), nullable=False, server_default=text("0.00"))
+    opening_balance = Column(DECIMAL(12, 2), nullable=False, server_default=text("0.00"))
     date_created = Column(DateTime, nullable=False, server_default=text("current_timestamp()"))
 
 class Income(Base):
     __tablename__ = 'income'
+    __table_args__ = (
+        Index('ix_income_user_date_created', 'user_id', 'date_created'),
+        Index('ix_income_user_category_date_created', 'user_id', 'income_category_id', 'date_created'),
+    )
 
     id = Column(INTEGER(11), primary_key=True, nullable=False,autoincrement=True)
     income_category_id = Column(ForeignKey('income_category.id'), primary_key=True, nullable=False, index=True)
-    user_id = Column(ForeignKey('user.id'), primary_key=True, nullable=False, index=True)
+    user_id = Column(ForeignKey('user.id'), primary_key=True, nullable=False)
     description = Column(String(250), nullable=False)
     amount = Column(DECIMAL(12, 2), nullable=False, server_default=text("0.00"))
     date_created = Column(DateTime, nullable=False, server_default=text("current_timestamp()"))
@@ -47,9 +52,12 @@ class Income(Base):
 
 class MonthlySummary(Base):
     __tablename__ = 'monthly_summary'
+    __table_args__ = (
+        Index('ux_monthly_summary_user_month', 'user_id', 'month', unique=True),
+    )
 
     id = Column(INTEGER(11), primary_key=True, nullable=False,autoincrement=True)
-    user_id = Column(ForeignKey('user.id'), primary_key=True, nullable=False, index=True)
+    user_id = Column(ForeignKey('user.id'), primary_key=True, nullable=False)
     month = Column(INTEGER(11), nullable=False)
     total_income = Column(DECIMAL(12, 2), nullable=False, server_default=text("0.00"))
     total_outcome = Column(DECIMAL(12, 2), nullable=False, server_default=text("0.00"))
@@ -58,12 +66,33 @@ class MonthlySummary(Base):
     user = relationship('User')
 
 
+class BalanceCheckpoint(Base):
+    __tablename__ = 'balance_checkpoint'
+    __table_args__ = (
+        Index('ux_balance_checkpoint_user_month', 'user_id', 'month', unique=True),
+    )
+
+    id = Column(INTEGER(11), primary_key=True, nullable=False,autoincrement=True)
+    user_id = Column(ForeignKey('user.id'), primary_key=True, nullable=False)
+    month = Column(INTEGER(11), nullable=False)
+    total_income = Column(DECIMAL(14, 2), nullable=False, server_default=text("0.00"))
+    total_outcome = Column(DECIMAL(14, 2), nullable=False, server_default=text("0.00"))
+    total_outcome_plan = Column(DECIMAL(14, 2), nullable=False, server_default=text("0.00"))
+    date_created = Column(DateTime, nullable=False, server_default=text("current_timestamp()"))
+
+    user = relationship('User')
+
+
 class Outcome(Base):
     __tablename__ = 'outcome'
+    __table_args__ = (
+        Index('ix_outcome_user_date_created', 'user_id', 'date_created'),
+        Index('ix_outcome_user_category_date_created', 'user_id', 'outcome_category_id', 'date_created'),
+    )
 
     id = Column(INTEGER(11), primary_key=True, nullable=False,autoincrement=True)
     outcome_category_id = Column(ForeignKey('outcome_category.id'), primary_key=True, nullable=False, index=True)
-    user_id = Column(ForeignKey('user.id'), primary_key=True, nullable=False, index=True)
+    user_id = Column(ForeignKey('user.id'), primary_key=True, nullable=False)
     description = Column(String(250), nullable=False)
     amount = Column(DECIMAL(12, 2), nullable=False, server_default=text("0.00"))
     date_spend = Column(Date, nullable=False)
@@ -74,10 +103,14 @@ class Outcome(Base):
     
 class OutcomePlan(Base):
     __tablename__ = 'outcome_plan'
+    __table_args__ = (
+        Index('ix_outcome_plan_user_date_created', 'user_id', 'date_created'),
+        Index('ix_outcome_plan_user_category_date_created', 'user_id', 'outcome_category_id', 'date_created'),
+    )
 
     id = Column(INTEGER(11), primary_key=True, nullable=False,autoincrement=True)
     outcome_category_id = Column(ForeignKey('outcome_category.id'), primary_key=True, nullable=False, index=True)
-    user_id = Column(ForeignKey('user.id'), primary_key=True, nullable=False, index=True)
+    user_id = Column(ForeignKey('user.id'), primary_key=True, nullable=False)
     description = Column(String(250), nullable=False)
     amount = Column(DECIMAL(12, 2), nullable=False, server_default=text("0.00"))
     date_spend = Column(Date, nullable=False)
@@ -89,9 +122,12 @@ class OutcomePlan(Base):
 
 class Saving(Base):
     __tablename__ = 'saving'
+    __table_args__ = (
+        Index('ix_saving_user_date_created', 'user_id', 'date_created'),
+    )
 
     id = Column(INTEGER(11), primary_key=True, nullable=False,autoincrement=True)
-    user_id = Column(ForeignKey('user.id'), primary_key=True, nullable=False, index=True)
+    user_id = Column(ForeignKey('user.id'), primary_key=True, nullable=False)
     description = Column(String(200), nullable=False)
     date_created = Column(DateTime, nullable=False,server_default=text("current_timestamp()"))
     amount = Column(DECIMAL(12, 2), nullable=False)
@@ -1,6 +1,7 @@
 from enum import Enum
 from typing import Optional, List
-from datetime import date
+from datetime import date, datetime
+from decimal import Decimal
 from pydantic import BaseModel
 
 class IncomeType(str):
@@ -10,4 +11,35 @@ class IncomeType(str):
     CASH='CASH'
     GOPAY='GOPAY'
     OVO='OVO'
-    SHOPEE_PAY='SHOPEE PAY'
\ No newline at end of file
+    SHOPEE_PAY='SHOPEE PAY'
+
+# Keyset pagination of the list endpoints
+PAGE_LIMIT_DEFAULT = 100
+PAGE_LIMIT_MAX = 1000
+
+# Bulk insert of the ledger rows
+BULK_ROWS_MAX = 5000
+
+# Length of the description column of Income and Outcome
+DESCRIPTION_MAX = 250
+
+class IncomeRow(BaseModel):
+    income_category_id: int
+    description: str
+    amount: Decimal
+    date_created: Optional[datetime] = None
+
+class IncomeBulk(BaseModel):
+    user_id: int
+    rows: List[IncomeRow]
+
+class OutcomeRow(BaseModel):
+    outcome_category_id: int
+    description: str
+    amount: Decimal
+    date_spend: date
+    date_created: Optional[datetime] = None
+
+class OutcomeBulk(BaseModel):
+    user_id: int
+    rows: List[OutcomeRow]
@@ -1,8 +1,180 @@
+from datetime import date, datetime
+from decimal import Decimal
+from inspect import signature
 from typing import Optional, Any
 
+from fastapi import routing
+from fastapi.datastructures import Default
 from pydantic import BaseModel
+from sqlalchemy import inspect
+from starlette.responses import JSONResponse
+
+from . import database
+
+try:
+	import orjson
+except ImportError:  # plain json is used instead
+	orjson = None
+
+try:
+	from pydantic import field_validator
+	content_validator = field_validator("content", mode="before")
+except ImportError:  # pydantic 1
+	from pydantic import validator
+	content_validator = validator("content", pre=True, allow_reuse=True)
+
+
+class IncomeCategorySchema(BaseModel):
+	id: int
+	name: str
+	emoticon: Optional[str] = None
+
+
+class OutcomeCategorySchema(BaseModel):
+	id: int
+	name: str
+	emoticon: Optional[str] = None
+
+
+class UserSchema(BaseModel):
+	id: int
+	discord_username: str
+	balance: Optional[Decimal] = None
+	opening_balance: Optional[Decimal] = None
+	date_created: Optional[datetime] = None
+
+
+class IncomeSchema(BaseModel):
+	id: int
+	user_id: int
+	income_category_id: int
+	description: str
+	amount: Decimal
+	date_created: Optional[datetime] = None
+	income_category: Optional[IncomeCategorySchema] = None
+
+
+class OutcomeSchema(BaseModel):
+	id: int
+	user_id: int
+	outcome_category_id: int
+	description: str
+	amount: Decimal
+	date_spend: date
+	date_created: Optional[datetime] = None
+	outcome_category: Optional[OutcomeCategorySchema] = None
+
+
+class OutcomePlanSchema(OutcomeSchema):
+	pass
+
+
+class SavingSchema(BaseModel):
+	id: int
+	user_id: int
+	description: str
+	amount: Decimal
+	due_date: date
+	date_created: Optional[datetime] = None
+
+
+# Schema of each ORM class a route may return, the pin of a User is left out
+SCHEMAS = {
+	database.IncomeCategory: IncomeCategorySchema,
+	database.OutcomeCategory: OutcomeCategorySchema,
+	database.User: UserSchema,
+	database.Income: IncomeSchema,
+	database.Outcome: OutcomeSchema,
+	database.OutcomePlan: OutcomePlanSchema,
+	database.Saving: SavingSchema,
+}
+
+_COLUMN, _DECIMAL, _RELATIONSHIP = range(3)
+
+def _fields(model, schema) -> tuple:
+	names = getattr(schema, "model_fields", None) or schema.__fields__
+	mapper = inspect(model)
+	fields = []
+	for name in names:
+		if name in mapper.relationships:
+			fields.append((name, _RELATIONSHIP))
+		elif isinstance(mapper.columns[name].type, database.DECIMAL):
+			fields.append((name, _DECIMAL))
+		else:
+			fields.append((name, _COLUMN))
+	return tuple(fields)
+
+_FIELDS = {model: _fields(model, schema) for model, schema in SCHEMAS.items()}
+
+def _row(row, fields: tuple) -> dict:
+	state = row.__dict__
+	plain = {}
+	for name, kind in fields:
+		if kind == _RELATIONSHIP:
+			# Only when already loaded, a lazy load would query per row
+			value = state.get(name)
+			plain[name] = _row(value, _FIELDS[type(value)]) if value is not None else None
+			continue
+		value = state[name] if name in state else getattr(row, name)
+		plain[name] = float(value) if kind == _DECIMAL and value is not None else value
+	return plain
+
+def to_content(value: Any) -> Any:
+	"""
+	Plain data of a response content: ORM objects become dicts of the
+	fields of their schema with Decimal as float, lists and dicts are walked
+	@param value: ORM object, list, dict or plain value
+	@return: Plain value
+	"""
+	fields = _FIELDS.get(type(value))
+	if fields is not None:
+		return _row(value, fields)
+	if isinstance(value, Decimal):
+		return float(value)
+	if isinstance(value, (list, tuple)):
+		if value and type(value[0]) in _FIELDS:
+			row_fields = _FIELDS[type(value[0])]
+			return [_row(row, row_fields) if type(row) is type(value[0]) else to_content(row) for row in value]
+		return [to_content(item) for item in value]
+	if isinstance(value, dict):
+		return {key: to_content(item) for key, item in value.items()}
+	return value
 
 
 class BaseResponse(BaseModel):
 	status: str
-	content: Optional[Any] = None
\ No newline at end of file
+	content: Optional[Any] = None
+	# Keyset cursor of the next page, set by the paginated list endpoints
+	next_after_id: Optional[int] = None
+
+	@content_validator
+	def plain_content(cls, content):
+		return to_content(content)
+
+
+def _default(value: Any) -> Any:
+	if isinstance(value, BaseModel):
+		return dict(value)
+	if isinstance(value, Decimal):
+		return float(value)
+	if isinstance(value, (date, datetime)):
+		return value.isoformat()
+	raise TypeError("Type is not JSON serializable: {}".format(type(value).__name__))
+
+
+class FastJSONResponse(JSONResponse):
+	"""
+	JSON response encoded with orjson when it is installed. The content is
+	already plain data (see BaseResponse), so no generic encoder walks it.
+	"""
+	def render(self, content: Any) -> bytes:
+		if orjson is not None:
+			return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+		return super().render(_default(content) if isinstance(content, BaseModel) else content)
+
+
+# FastAPI releases that serialize a response_model straight to JSON bytes
+# with pydantic-core only do so while the response class is left to its
+# default, on those replacing it would be slower
+DEFAULT_RESPONSE_CLASS = (Default(JSONResponse) if "dump_json" in signature(routing.serialize_response).parameters
+						  else FastJSONResponse)
@@ -0,0 +1,90 @@
+import os, hmac, asyncio, hashlib, threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+# scrypt cost of new hashes: CPU/memory cost (power of 2), block size and
+# parallelism. Memory used per hash is 128 * N * r bytes (16 MiB by default).
+PIN_SCRYPT_N = int(os.environ.get("PIN_SCRYPT_N", 2 ** 14))
+PIN_SCRYPT_R = int(os.environ.get("PIN_SCRYPT_R", 8))
+PIN_SCRYPT_P = int(os.environ.get("PIN_SCRYPT_P", 1))
+
+# Processes hashing pins, so logins do not stall the event loop
+PIN_HASH_WORKERS = int(os.environ.get("PIN_HASH_WORKERS", os.cpu_count() or 1))
+
+SALT_BYTES = 16
+SCHEME = "scrypt"
+
+def hash_pin(pin: str, n: int = PIN_SCRYPT_N, r: int = PIN_SCRYPT_R,
+             p: int = PIN_SCRYPT_P, salt: bytes = None) -> str:
+    """
+    Hash a pin with scrypt and a random per pin salt
+    @param pin: Plain pin
+    @return: str "scrypt$n$r$p$salt$hash", salt and hash in hex
+    """
+    salt = salt or os.urandom(SALT_BYTES)
+    digest = hashlib.scrypt(pin.encode(), salt=salt, n=n, r=r, p=p,
+                            maxmem=256 * n * r * p)
+    return "$".join((SCHEME, str(n), str(r), str(p), salt.hex(), digest.hex()))
+
+def legacy_hash_pin(pin: str) -> str:
+    """
+    Salted SHA-256 used before scrypt, with the SALT environment variable
+    @param pin: Plain pin
+    @return: str hex digest
+    """
+    return hashlib.sha256((pin + os.environ.get("SALT")).encode()).hexdigest()
+
+def verify_pin(pin: str, stored: Optional[str]) -> Tuple[bool, bool]:
+    """
+    Check a pin against its stored hash, scrypt or legacy SHA-256
+    @param pin: Plain pin
+    @param stored: Stored hash
+    @return: (pin matches, hash should be replaced by one with the current cost)
+    """
+    if not stored or pin is None:
+        return False, False
+
+    if not stored.startswith(SCHEME + "$"):
+        return hmac.compare_digest(legacy_hash_pin(pin), stored), True
+
+    _, n, r, p, salt, digest = stored.split("$")
+    n, r, p = int(n), int(r), int(p)
+    candidate = hash_pin(pin, n, r, p, bytes.fromhex(salt)).rsplit("$", 1)[1]
+    matches = hmac.compare_digest(candidate, digest)
+    return matches, matches and (n, r, p) != (PIN_SCRYPT_N, PIN_SCRYPT_R, PIN_SCRYPT_P)
+
+class PinHasher:
+    """
+    Runs hash_pin and verify_pin on a process pool, created on first use.
+    scrypt is CPU and memory heavy on purpose, on the event loop a single
+    login would block every other request.
+    """
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    async def hash(self, pin: str) -> str:
+        """
+        Hash a pin with the current cost
+        @param pin: Plain pin
+        @return: str stored hash
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor(), hash_pin, pin)
+
+    async def verify(self, pin: str, stored: Optional[str]) -> Tuple[bool, bool]:
+        """
+        Check a pin against its stored hash
+        @param pin: Plain pin
+        @param stored: Stored hash
+        @return: (pin matches, hash should be replaced)
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor(), verify_pin, pin, stored)
+
+pin_hasher = PinHasher(PIN_HASH_WORKERS)
@@ -0,0 +1,25 @@
+"""
+Recompute the balance_checkpoint table from the ledger tables.
+
+    python -m budgetdiary.rebuild_checkpoints            # every user
+    python -m budgetdiary.rebuild_checkpoints <user_id>  # one user
+
+Run it once after applying migrations/0003_balance_checkpoint.sql, with the
+bot stopped, and again whenever the checkpoints are suspected to be off.
+"""
+import sys
+import time
+import asyncio
+from .controller.BalanceCheckpoint import BalanceCheckpoint
+from .utils import Debug, DebugLevel
+
+def main(argv):
+    target_user_id = int(argv[0]) if argv else None
+    start = time.perf_counter()
+    rows = asyncio.run(BalanceCheckpoint.rebuild(target_user_id))
+    Debug.msg("rebuild_checkpoints",
+              "{} checkpoints written in {:.2f}s".format(rows, time.perf_counter() - start),
+              DebugLevel.INFO)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,10 +1,14 @@
-from datetime import date
-from fastapi import APIRouter, Form
+from datetime import date, datetime
+from decimal import Decimal
+from fastapi import APIRouter, Form, Query
+from fastapi.responses import StreamingResponse
 
 from ..controller.Income import Income as IncomeController
 from ..controller.User import User as UserController
+from ..controller.IncomeCategory import IncomeCategory as IncomeCategoryController
+from ..model.requests import PAGE_LIMIT_DEFAULT, PAGE_LIMIT_MAX, BULK_ROWS_MAX, DESCRIPTION_MAX, IncomeBulk
 from ..model.response import BaseResponse
-from ..utils import Debug
+from ..utils import Debug, Util
 
 subroute = APIRouter()
 
@@ -24,45 +28,64 @@ async def get_by_id(id: int):
         return BaseResponse(**{"status": "Server error"})
 
 @subroute.get("/all", response_model=BaseResponse)
-async def get_all():
+async def get_all(after_id: int = 0, limit: int = Query(PAGE_LIMIT_DEFAULT, ge=1, le=PAGE_LIMIT_MAX),
+                  stream: bool = False):
     debug_identifier = "Income|get_all"
     try:
-        income = await IncomeController.get_all()
+        if stream:
+            return StreamingResponse(Util.to_ndjson(IncomeController.stream_all(after_id)),
+                                     media_type="application/x-ndjson")
+
+        income = await IncomeController.get_all(after_id, limit)
         if not income:
             Debug.msg(debug_identifier, "Data not found")
             return BaseResponse(**{"status": "Data not found"})
 
-        return BaseResponse(**{"status": "Success", "content": income})
+        next_after_id = income[-1].id if len(income) == limit else None
+        return BaseResponse(**{"status": "Success", "content": income, "next_after_id": next_after_id})
 
     except Exception as e:
         Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
         return BaseResponse(**{"status": "Server error"})
     
 @subroute.get("/user_id/{user_id}/all", response_model=BaseResponse)
-async def get_all(user_id: int):
+async def get_all_by_user_id(user_id: int, after_id: int = 0,
+                             limit: int = Query(PAGE_LIMIT_DEFAULT, ge=1, le=PAGE_LIMIT_MAX),
+                             stream: bool = False):
 
     debug_identifier = "Income|get_all_by_user_id"
     try:
-        income = await IncomeController.get_all_by_user_id(user_id)
+        if stream:
+            return StreamingResponse(Util.to_ndjson(IncomeController.stream_all(after_id, user_id)),
+                                     media_type="application/x-ndjson")
+
+        income = await IncomeController.get_all_by_user_id(user_id, after_id, limit)
         if not income:
             Debug.msg(debug_identifier, "Data not found")
             return BaseResponse(**{"status": "Data not found"})
 
-        return BaseResponse(**{"status": "Success", "content": income})
+        next_after_id = income[-1].id if len(income) == limit else None
+        return BaseResponse(**{"status": "Success", "content": income, "next_after_id": next_after_id})
 
     except Exception as e:
         Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
         return BaseResponse(**{"status": "Server error"})
 
 @subroute.post("/add", response_model=BaseResponse)
-async def add(user_id:int = Form(...),description:str = Form(...), amount:float = Form(...),due_date:date=Form(...)):
+async def add(user_id:int = Form(...), income_category_id:int = Form(...), description:str = Form(...),
+              amount:float = Form(...), due_date:date = Form(...)):
     debug_identifier = "IncomeRoute|add"
     try:
         user = await UserController.get_by_id(user_id)
         if not user:
             Debug.msg(debug_identifier, "User not found")
             return BaseResponse(**{"status": "User not found"})
-        income = await IncomeController.add(user_id,description,amount,due_date)
+        if not await IncomeCategoryController.get_by_id(income_category_id):
+            Debug.msg(debug_identifier, "IncomeCategory not found")
+            return BaseResponse(**{"status": "IncomeCategory not found"})
+        # The day comes from the form, the time keeps the entries of a day in order
+        income = await IncomeController.add(user_id, income_category_id, description, amount,
+                                            datetime.combine(due_date, datetime.now().time()))
         if not income:
             Debug.msg(debug_identifier, "Income not found")
             return BaseResponse(**{"status": "Income not found"})
@@ -73,6 +96,42 @@ async def add(user_id:int = Form(...),description:str = Form(...), amount:float
         Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
         return BaseResponse(**{"status": "Server error"})
 
+@subroute.post("/bulk", response_model=BaseResponse)
+async def add_bulk(bulk: IncomeBulk):
+    debug_identifier = "IncomeRoute|add_bulk"
+    try:
+        if not bulk.rows or len(bulk.rows) > BULK_ROWS_MAX:
+            message = "Between 1 and {} rows are accepted".format(BULK_ROWS_MAX)
+            Debug.msg(debug_identifier, message)
+            return BaseResponse(**{"status": message})
+
+        long_rows = [index for index, row in enumerate(bulk.rows)
+                     if len(row.description) > DESCRIPTION_MAX]
+        if long_rows:
+            message = "Description longer than {} characters".format(DESCRIPTION_MAX)
+            Debug.msg(debug_identifier, message)
+            return BaseResponse(**{"status": message, "content": long_rows})
+
+        user = await UserController.get_by_id(bulk.user_id)
+        if not user:
+            Debug.msg(debug_identifier, "User not found")
+            return BaseResponse(**{"status": "User not found"})
+
+        category_ids = {category.id for category in await IncomeCategoryController.get_all()}
+        invalid_rows = [index for index, row in enumerate(bulk.rows)
+                        if row.income_category_id not in category_ids]
+        if invalid_rows:
+            Debug.msg(debug_identifier, "IncomeCategory not found")
+            return BaseResponse(**{"status": "IncomeCategory not found", "content": invalid_rows})
+
+        ids = await IncomeController.add_bulk(bulk.user_id, [dict(row) for row in bulk.rows])
+
+        return BaseResponse(**{"status": "Success", "content": ids})
+
+    except Exception as e:
+        Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
+        return BaseResponse(**{"status": "Server error"})
+
 @subroute.put("/update/id/{id}", response_model=BaseResponse)
 async def update_by_id(id: int, user_id:int = Form(...),description:str = Form(...), amount: str = Form(...), due_date:date = Form(...)):
                       
@@ -83,21 +142,15 @@ async def update_by_id(id: int, user_id:int = Form(...),description:str = Form(.
             Debug.msg(debug_identifier, "User not found")
             return BaseResponse(**{"status": "User not found"})
         
-        updated_income = await IncomeController.get_by_id(id)
-        if not updated_income:
+        # due_date is kept in the form for compatibility, Income rows have none
+        values = {"description": description, "amount": Decimal(amount)}
+        matched, income = await IncomeController.update_by_id(id, values)
+        if not matched:
             Debug.msg(debug_identifier, "Income does not exist")
             return BaseResponse(**{"status": "Income does not exist"})
 
-        updated_income.user_id = user_id
-        updated_income.description = description
-        updated_income.amount = amount
-        updated_income.due_date = due_date
-
-        income = await IncomeController.update_by_id(id, updated_income)
-        if not income:
-            Debug.msg(debug_identifier, "Income not found")
-            return BaseResponse(**{"status": "Income not found"})
-
+        # Without UPDATE .. RETURNING only the changed columns are sent back
+        income = income if income is not None else dict(values, id=id)
         return BaseResponse(**{"status": "Success", "content": income})
 
     except Exception as e:
@@ -108,12 +161,9 @@ async def update_by_id(id: int, user_id:int = Form(...),description:str = Form(.
 async def delete_by_id(id: int):
     debug_identifier = "IncomeRoute|delete_by_id"
     try:
-        income = await IncomeController.get_by_id(id)
-        if not income:
+        if not await IncomeController.delete_by_id(id):
             Debug.msg(debug_identifier, "Income does not exist")
             return BaseResponse(**{"status": "Income does not exist"})
-        
-        await IncomeController.delete_by_id(id)
 
         return BaseResponse(**{"status": "Success", "content": "Delete action successful"})
 
@@ -0,0 +1,81 @@
+import codecs
+from datetime import date
+from typing import Optional
+from fastapi import APIRouter, File, Query, UploadFile
+from fastapi.responses import StreamingResponse
+
+from ..__database import own_transactions
+from ..controller.Ledger import Ledger as LedgerController, IMPORT_CHUNK_ROWS, EXPORT_COLUMNS
+from ..controller.User import User as UserController
+from ..model.requests import BULK_ROWS_MAX
+from ..model.response import BaseResponse
+from ..utils import Debug, Util
+
+subroute = APIRouter()
+
+@subroute.get("/user_id/{user_id}/overview", response_model=BaseResponse)
+async def get_overview(user_id: int, first_date: Optional[date] = None, last_date: Optional[date] = None):
+    debug_identifier = "Ledger|get_overview"
+    try:
+        today = date.today()
+        first_date = first_date or today.replace(day=1)
+        last_date = last_date or today
+        if last_date < first_date:
+            Debug.msg(debug_identifier, "Invalid period")
+            return BaseResponse(**{"status": "Invalid period"})
+
+        overview = await LedgerController.get_overview(user_id, first_date, last_date)
+
+        return BaseResponse(**{"status": "Success", "content": overview})
+
+    except Exception as e:
+        Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
+        return BaseResponse(**{"status": "Server error"})
+
+@subroute.post("/user_id/{user_id}/import", response_model=BaseResponse)
+async def import_csv(user_id: int, file: UploadFile = File(...),
+                     chunk_rows: int = Query(IMPORT_CHUNK_ROWS, ge=1, le=BULK_ROWS_MAX)):
+    debug_identifier = "Ledger|import_csv"
+    try:
+        # Committed chunk by chunk, the request transaction stays unused
+        with own_transactions():
+            user = await UserController.get_by_id(user_id)
+        if not user:
+            Debug.msg(debug_identifier, "User not found")
+            return BaseResponse(**{"status": "User not found"})
+
+        # Decoded line by line as the import reads it, the upload is never held whole
+        lines = codecs.iterdecode(file.file, "utf-8-sig")
+        stats = await LedgerController.import_csv(user_id, lines, chunk_rows)
+
+        return BaseResponse(**{"status": "Success", "content": stats})
+
+    except Exception as e:
+        Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
+        return BaseResponse(**{"status": "Server error"})
+
+@subroute.get("/user_id/{user_id}/export", response_model=BaseResponse)
+async def export(user_id: int, format: str = "csv",
+                 first_date: Optional[date] = None, last_date: Optional[date] = None):
+    debug_identifier = "Ledger|export"
+    try:
+        if format not in ("csv", "ndjson"):
+            Debug.msg(debug_identifier, "Invalid format")
+            return BaseResponse(**{"status": "Invalid format"})
+
+        user = await UserController.get_by_id(user_id)
+        if not user:
+            Debug.msg(debug_identifier, "User not found")
+            return BaseResponse(**{"status": "User not found"})
+
+        rows = LedgerController.stream_export(user_id, first_date, last_date)
+        if format == "ndjson":
+            return StreamingResponse(Util.to_ndjson(rows), media_type="application/x-ndjson")
+
+        filename = "ledger-{}.csv".format(user_id)
+        return StreamingResponse(Util.to_csv(rows, EXPORT_COLUMNS), media_type="text/csv",
+                                 headers={"Content-Disposition": "attachment; filename={}".format(filename)})
+
+    except Exception as e:
+        Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
+        return BaseResponse(**{"status": "Server error"})
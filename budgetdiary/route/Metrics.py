@@ -0,0 +1,23 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import PlainTextResponse
+
+from ..metrics import metrics, METRICS_HOSTS
+from ..utils import Debug
+
+subroute = APIRouter()
+
+@subroute.get("", response_class=PlainTextResponse)
+async def get_metrics(request: Request):
+    debug_identifier = "Metrics|get_metrics"
+    try:
+        # Only for a scraper on the same host, not for requests relayed by a proxy
+        if (request.client is None or request.client.host not in METRICS_HOSTS
+                or "x-forwarded-for" in request.headers):
+            Debug.msg(debug_identifier, "Remote client refused")
+            return PlainTextResponse("Not Found", status_code=404)
+
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    except Exception as e:
+        Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
+        return PlainTextResponse("Server error", status_code=500)
@@ -1,10 +1,14 @@
 from datetime import date
-from fastapi import APIRouter, Form
+from decimal import Decimal
+from fastapi import APIRouter, Form, Query
+from fastapi.responses import StreamingResponse
 
 from ..controller.Outcome import Outcome as OutcomeController
 from ..controller.User import User as UserController
+from ..controller.OutcomeCategory import OutcomeCategory as OutcomeCategoryController
+from ..model.requests import PAGE_LIMIT_DEFAULT, PAGE_LIMIT_MAX, BULK_ROWS_MAX, DESCRIPTION_MAX, OutcomeBulk
 from ..model.response import BaseResponse
-from ..utils import Debug
+from ..utils import Debug, Util
 
 subroute = APIRouter()
 
@@ -24,45 +28,62 @@ async def get_by_id(id: int):
         return BaseResponse(**{"status": "Server error"})
 
 @subroute.get("/all", response_model=BaseResponse)
-async def get_all():
+async def get_all(after_id: int = 0, limit: int = Query(PAGE_LIMIT_DEFAULT, ge=1, le=PAGE_LIMIT_MAX),
+                  stream: bool = False):
     debug_identifier = "Outcome|get_all"
     try:
-        outcome = await OutcomeController.get_all()
+        if stream:
+            return StreamingResponse(Util.to_ndjson(OutcomeController.stream_all(after_id)),
+                                     media_type="application/x-ndjson")
+
+        outcome = await OutcomeController.get_all(after_id, limit)
         if not outcome:
             Debug.msg(debug_identifier, "Data not found")
             return BaseResponse(**{"status": "Data not found"})
 
-        return BaseResponse(**{"status": "Success", "content": outcome})
+        next_after_id = outcome[-1].id if len(outcome) == limit else None
+        return BaseResponse(**{"status": "Success", "content": outcome, "next_after_id": next_after_id})
 
     except Exception as e:
         Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
         return BaseResponse(**{"status": "Server error"})
     
 @subroute.get("/user_id/{user_id}/all", response_model=BaseResponse)
-async def get_all(user_id: int):
+async def get_all_by_user_id(user_id: int, after_id: int = 0,
+                             limit: int = Query(PAGE_LIMIT_DEFAULT, ge=1, le=PAGE_LIMIT_MAX),
+                             stream: bool = False):
 
     debug_identifier = "Outcome|get_all_by_user_id"
     try:
-        outcome = await OutcomeController.get_all_by_user_id(user_id)
+        if stream:
+            return StreamingResponse(Util.to_ndjson(OutcomeController.stream_all(after_id, user_id)),
+                                     media_type="application/x-ndjson")
+
+        outcome = await OutcomeController.get_all_by_user_id(user_id, after_id, limit)
         if not outcome:
             Debug.msg(debug_identifier, "Data not found")
             return BaseResponse(**{"status": "Data not found"})
 
-        return BaseResponse(**{"status": "Success", "content": outcome})
+        next_after_id = outcome[-1].id if len(outcome) == limit else None
+        return BaseResponse(**{"status": "Success", "content": outcome, "next_after_id": next_after_id})
 
     except Exception as e:
         Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
         return BaseResponse(**{"status": "Server error"})
 
 @subroute.post("/add", response_model=BaseResponse)
-async def add(user_id:int = Form(...),description:str = Form(...), amount:float = Form(...),due_date:date=Form(...)):
+async def add(user_id:int = Form(...), outcome_category_id:int = Form(...), description:str = Form(...),
+              amount:float = Form(...), due_date:date = Form(...)):
     debug_identifier = "OutcomeRoute|add"
     try:
         user = await UserController.get_by_id(user_id)
         if not user:
             Debug.msg(debug_identifier, "User not found")
             return BaseResponse(**{"status": "User not found"})
-        outcome = await OutcomeController.add(user_id,description,amount,due_date)
+        if not await OutcomeCategoryController.get_by_id(outcome_category_id):
+            Debug.msg(debug_identifier, "OutcomeCategory not found")
+            return BaseResponse(**{"status": "OutcomeCategory not found"})
+        outcome = await OutcomeController.add(user_id, outcome_category_id, description, amount, due_date)
         if not outcome:
             Debug.msg(debug_identifier, "Outcome not found")
             return BaseResponse(**{"status": "Outcome not found"})
@@ -73,6 +94,42 @@ async def add(user_id:int = Form(...),description:str = Form(...), amount:float
         Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
         return BaseResponse(**{"status": "Server error"})
 
+@subroute.post("/bulk", response_model=BaseResponse)
+async def add_bulk(bulk: OutcomeBulk):
+    debug_identifier = "OutcomeRoute|add_bulk"
+    try:
+        if not bulk.rows or len(bulk.rows) > BULK_ROWS_MAX:
+            message = "Between 1 and {} rows are accepted".format(BULK_ROWS_MAX)
+            Debug.msg(debug_identifier, message)
+            return BaseResponse(**{"status": message})
+
+        long_rows = [index for index, row in enumerate(bulk.rows)
+                     if len(row.description) > DESCRIPTION_MAX]
+        if long_rows:
+            message = "Description longer than {} characters".format(DESCRIPTION_MAX)
+            Debug.msg(debug_identifier, message)
+            return BaseResponse(**{"status": message, "content": long_rows})
+
+        user = await UserController.get_by_id(bulk.user_id)
+        if not user:
+            Debug.msg(debug_identifier, "User not found")
+            return BaseResponse(**{"status": "User not found"})
+
+        category_ids = {category.id for category in await OutcomeCategoryController.get_all()}
+        invalid_rows = [index for index, row in enumerate(bulk.rows)
+                        if row.outcome_category_id not in category_ids]
+        if invalid_rows:
+            Debug.msg(debug_identifier, "OutcomeCategory not found")
+            return BaseResponse(**{"status": "OutcomeCategory not found", "content": invalid_rows})
+
+        ids = await OutcomeController.add_bulk(bulk.user_id, [dict(row) for row in bulk.rows])
+
+        return BaseResponse(**{"status": "Success", "content": ids})
+
+    except Exception as e:
+        Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
+        return BaseResponse(**{"status": "Server error"})
+
 @subroute.put("/update/id/{id}", response_model=BaseResponse)
 async def update_by_id(id: int, user_id:int = Form(...),description:str = Form(...), amount: str = Form(...), due_date:date = Form(...)):
                       
@@ -83,21 +140,15 @@ async def update_by_id(id: int, user_id:int = Form(...),description:str = Form(.
             Debug.msg(debug_identifier, "User not found")
             return BaseResponse(**{"status": "User not found"})
         
-        updated_outcome = await OutcomeController.get_by_id(id)
-        if not updated_outcome:
+        # due_date is kept in the form for compatibility, Outcome rows have none
+        values = {"description": description, "amount": Decimal(amount)}
+        matched, outcome = await OutcomeController.update_by_id(id, values)
+        if not matched:
             Debug.msg(debug_identifier, "Outcome does not exist")
             return BaseResponse(**{"status": "Outcome does not exist"})
 
-        updated_outcome.user_id = user_id
-        updated_outcome.description = description
-        updated_outcome.amount = amount
-        updated_outcome.due_date = due_date
-
-        outcome = await OutcomeController.update_by_id(id, updated_outcome)
-        if not outcome:
-            Debug.msg(debug_identifier, "Outcome not found")
-            return BaseResponse(**{"status": "Outcome not found"})
-
+        # Without UPDATE .. RETURNING only the changed columns are sent back
+        outcome = outcome if outcome is not None else dict(values, id=id)
         return BaseResponse(**{"status": "Success", "content": outcome})
 
     except Exception as e:
@@ -108,12 +159,9 @@ async def update_by_id(id: int, user_id:int = Form(...),description:str = Form(.
 async def delete_by_id(id: int):
     debug_identifier = "OutcomeRoute|delete_by_id"
     try:
-        outcome = await OutcomeController.get_by_id(id)
-        if not outcome:
+        if not await OutcomeController.delete_by_id(id):
             Debug.msg(debug_identifier, "Outcome does not exist")
             return BaseResponse(**{"status": "Outcome does not exist"})
-        
-        await OutcomeController.delete_by_id(id)
 
         return BaseResponse(**{"status": "Success", "content": "Delete action successful"})
 
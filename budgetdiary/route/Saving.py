@@ -1,10 +1,13 @@
 from datetime import date
-from fastapi import APIRouter, Form
+from decimal import Decimal
+from fastapi import APIRouter, Form, Query
+from fastapi.responses import StreamingResponse
 
 from ..controller.Saving import Saving as SavingController
 from ..controller.User import User as UserController
+from ..model.requests import PAGE_LIMIT_DEFAULT, PAGE_LIMIT_MAX
 from ..model.response import BaseResponse
-from ..utils import Debug
+from ..utils import Debug, Util
 
 subroute = APIRouter()
 
@@ -24,31 +27,44 @@ async def get_by_id(id: int):
         return BaseResponse(**{"status": "Server error"})
 
 @subroute.get("/all", response_model=BaseResponse)
-async def get_all():
+async def get_all(after_id: int = 0, limit: int = Query(PAGE_LIMIT_DEFAULT, ge=1, le=PAGE_LIMIT_MAX),
+                  stream: bool = False):
     debug_identifier = "Saving|get_all"
     try:
-        saving = await SavingController.get_all()
+        if stream:
+            return StreamingResponse(Util.to_ndjson(SavingController.stream_all(after_id)),
+                                     media_type="application/x-ndjson")
+
+        saving = await SavingController.get_all(after_id, limit)
         if not saving:
             Debug.msg(debug_identifier, "Data not found")
             return BaseResponse(**{"status": "Data not found"})
 
-        return BaseResponse(**{"status": "Success", "content": saving})
+        next_after_id = saving[-1].id if len(saving) == limit else None
+        return BaseResponse(**{"status": "Success", "content": saving, "next_after_id": next_after_id})
 
     except Exception as e:
         Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
         return BaseResponse(**{"status": "Server error"})
     
 @subroute.get("/user_id/{user_id}/all", response_model=BaseResponse)
-async def get_all(user_id: int):
+async def get_all_by_user_id(user_id: int, after_id: int = 0,
+                             limit: int = Query(PAGE_LIMIT_DEFAULT, ge=1, le=PAGE_LIMIT_MAX),
+                             stream: bool = False):
 
     debug_identifier = "Saving|get_all_by_user_id"
     try:
-        saving = await SavingController.get_all_by_user_id(user_id)
+        if stream:
+            return StreamingResponse(Util.to_ndjson(SavingController.stream_all(after_id, user_id)),
+                                     media_type="application/x-ndjson")
+
+        saving = await SavingController.get_all_by_user_id(user_id, after_id, limit)
         if not saving:
             Debug.msg(debug_identifier, "Data not found")
             return BaseResponse(**{"status": "Data not found"})
 
-        return BaseResponse(**{"status": "Success", "content": saving})
+        next_after_id = saving[-1].id if len(saving) == limit else None
+        return BaseResponse(**{"status": "Success", "content": saving, "next_after_id": next_after_id})
 
     except Exception as e:
         Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
@@ -83,21 +99,14 @@ async def update_by_id(id: int, user_id:int = Form(...),description:str = Form(.
             Debug.msg(debug_identifier, "User not found")
             return BaseResponse(**{"status": "User not found"})
         
-        updated_saving = await SavingController.get_by_id(id)
-        if not updated_saving:
+        values = {"description": description, "amount": Decimal(amount), "due_date": due_date}
+        matched, saving = await SavingController.update_by_id(id, values)
+        if not matched:
             Debug.msg(debug_identifier, "Saving does not exist")
             return BaseResponse(**{"status": "Saving does not exist"})
 
-        updated_saving.user_id = user_id
-        updated_saving.description = description
-        updated_saving.amount = amount
-        updated_saving.due_date = due_date
-
-        saving = await SavingController.update_by_id(id, updated_saving)
-        if not saving:
-            Debug.msg(debug_identifier, "Saving not found")
-            return BaseResponse(**{"status": "Saving not found"})
-
+        # Without UPDATE .. RETURNING only the changed columns are sent back
+        saving = saving if saving is not None else dict(values, id=id)
         return BaseResponse(**{"status": "Success", "content": saving})
 
     except Exception as e:
@@ -108,12 +117,9 @@ async def update_by_id(id: int, user_id:int = Form(...),description:str = Form(.
 async def delete_by_id(id: int):
     debug_identifier = "SavingRoute|delete_by_id"
     try:
-        saving = await SavingController.get_by_id(id)
-        if not saving:
+        if not await SavingController.delete_by_id(id):
             Debug.msg(debug_identifier, "Saving does not exist")
             return BaseResponse(**{"status": "Saving does not exist"})
-        
-        await SavingController.delete_by_id(id)
 
         return BaseResponse(**{"status": "Success", "content": "Delete action successful"})
 
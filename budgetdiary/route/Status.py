@@ -0,0 +1,59 @@
+from fastapi import APIRouter
+
+from ..__database import DB_MODE, db_executor, sync_pool_monitor, async_pool_monitor, async_engine
+from ..cache import single_flight, aggregate_cache
+from ..controller.Income import Income as IncomeController
+from ..controller.Outcome import Outcome as OutcomeController
+from ..controller.IncomeCategory import IncomeCategory as IncomeCategoryController
+from ..controller.OutcomeCategory import OutcomeCategory as OutcomeCategoryController
+from ..controller.User import User as UserController
+from ..model.response import BaseResponse
+from ..utils import Debug
+
+subroute = APIRouter()
+
+@subroute.get("/database", response_model=BaseResponse)
+async def database():
+    debug_identifier = "Status|database"
+    try:
+        content = {"mode": DB_MODE, "pool": sync_pool_monitor.stats()}
+        if async_engine:
+            content["async_pool"] = async_pool_monitor.stats()
+        if db_executor:
+            content["executor"] = db_executor.stats()
+        content["write_behind"] = {"income": IncomeController.queue.stats(),
+                                   "outcome": OutcomeController.queue.stats()}
+
+        return BaseResponse(**{"status": "Success", "content": content})
+
+    except Exception as e:
+        Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
+        return BaseResponse(**{"status": "Server error"})
+
+@subroute.get("/cache", response_model=BaseResponse)
+async def cache():
+    debug_identifier = "Status|cache"
+    try:
+        content = {
+            "user": UserController.cache.stats(),
+            "income_category": IncomeCategoryController.cache.stats(),
+            "outcome_category": OutcomeCategoryController.cache.stats(),
+            "aggregate": aggregate_cache.stats(),
+            "single_flight": single_flight.stats()
+        }
+
+        return BaseResponse(**{"status": "Success", "content": content})
+
+    except Exception as e:
+        Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
+        return BaseResponse(**{"status": "Server error"})
+
+@subroute.get("/log", response_model=BaseResponse)
+async def log():
+    debug_identifier = "Status|log"
+    try:
+        return BaseResponse(**{"status": "Success", "content": Debug.stats()})
+
+    except Exception as e:
+        Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
+        return BaseResponse(**{"status": "Server error"})
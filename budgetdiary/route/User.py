@@ -1,9 +1,11 @@
-from fastapi import APIRouter, Form
+from fastapi import APIRouter, Form, Query
+from fastapi.responses import StreamingResponse
 from typing import Optional
 
 from ..controller.User import User as UserController
+from ..model.requests import PAGE_LIMIT_DEFAULT, PAGE_LIMIT_MAX
 from ..model.response import BaseResponse
-from ..utils import Debug
+from ..utils import Debug, Util
 
 subroute = APIRouter()
 
@@ -41,16 +43,22 @@ async def get_by_id(id: int):
 
 
 @subroute.get("/all", response_model=BaseResponse)
-async def get_all():
+async def get_all(after_id: int = 0, limit: int = Query(PAGE_LIMIT_DEFAULT, ge=1, le=PAGE_LIMIT_MAX),
+                  stream: bool = False):
     debug_identifier = "User|get_all"
     try:
-        users = await UserController.get_all()
+        if stream:
+            return StreamingResponse(Util.to_ndjson(UserController.stream_all(after_id), exclude=("pin",)),
+                                     media_type="application/x-ndjson")
+
+        users = await UserController.get_all(after_id, limit)
         if not users:
             message = "Data not found"
             Debug.msg(debug_identifier, message)
             return BaseResponse(**{"status": message})
 
-        return BaseResponse(**{"status": "Success", "content": users})
+        next_after_id = users[-1].id if len(users) == limit else None
+        return BaseResponse(**{"status": "Success", "content": users, "next_after_id": next_after_id})
 
     except Exception as e:
         message = "Server error"
@@ -62,16 +70,11 @@ async def get_all():
 async def add(discord_username:str = Form(...), pin:Optional[str] = Form(None)):
     debug_identifier = "UserRoute|add"
     try:
-        if await UserController.get_by_discord_username(discord_username):
-            message = "User already exists"
-            Debug.msg(debug_identifier, message)
-            return BaseResponse(**{"status": message})
-        
         encrypted_pin = await UserController.encrypt_pin(pin)
+        # One INSERT, the unique discord_username reports a taken name
         user = await UserController.add(discord_username, encrypted_pin)
-
         if not user:
-            message = "User not found"
+            message = "User already exists"
             Debug.msg(debug_identifier, message)
             return BaseResponse(**{"status": message})
 
@@ -88,31 +91,32 @@ async def update_by_id(id: int, discord_username: Optional[str] = Form(None),
                        pin: Optional[str] = Form(None), balance: Optional[float] = Form(None)):
     debug_identifier = "UserRoute|update_by_id"
     try:
-        updated_user = await UserController.get_by_id(id)
-        if not updated_user:
-            message = "User does not exist"
-            Debug.msg(debug_identifier, message)
-            return BaseResponse(**{"status": message})
-        
-        check_if_exist = await UserController.get_by_discord_username(discord_username)
-        if check_if_exist and check_if_exist.discord_username != updated_user.discord_username:
-            message = "Username already exists"
-            Debug.msg(debug_identifier, message)
-            return BaseResponse(**{"status": message})
-
+        values = {}
         if discord_username:
-            updated_user.discord_username = discord_username
+            check_if_exist = await UserController.get_by_discord_username(discord_username)
+            if check_if_exist and check_if_exist.id != id:
+                message = "Username already exists"
+                Debug.msg(debug_identifier, message)
+                return BaseResponse(**{"status": message})
+            values["discord_username"] = discord_username
         if pin:
-            updated_user.pin = pin
+            values["pin"] = await UserController.encrypt_pin(pin)
         if balance:
-            updated_user.balance = balance
+            values["balance"] = balance
+        if not values:
+            message = "Nothing to update"
+            Debug.msg(debug_identifier, message)
+            return BaseResponse(**{"status": message})
 
-        user = await UserController.update_by_id(id, updated_user)
-        if not user:
-            message = "User not found"
+        matched, user = await UserController.update_by_id(id, values)
+        if not matched:
+            message = "User does not exist"
             Debug.msg(debug_identifier, message)
             return BaseResponse(**{"status": message})
 
+        # Without UPDATE .. RETURNING only the changed columns are sent back
+        user = user if user is not None else {key: value for key, value in dict(values, id=id).items()
+                                              if key != "pin"}
         return BaseResponse(**{"status": "Success", "content": user})
 
     except Exception as e:
@@ -126,32 +130,31 @@ async def update_by_username(discord_username: str, new_discord_username:Optiona
 
     debug_identifier = "UserRoute|update_by_name"
     try:
-        if not (new_discord_username and pin and balance):
-            message = "Nothing to update"
-            Debug.msg(debug_identifier, message)
-            return BaseResponse(**{"status": message})
-        updated_user = await UserController.get_by_discord_username(discord_username)
-        if not updated_user:
-            message = "User does not exist"
-            Debug.msg(debug_identifier, message)
-            return BaseResponse(**{"status": message})
+        values = {}
         if new_discord_username:
             check_if_exist = await UserController.get_by_discord_username(new_discord_username)
-            if check_if_exist and check_if_exist.discord_username != updated_user.discord_username:
+            if check_if_exist and check_if_exist.discord_username != discord_username:
                 message = "User already exist"
                 Debug.msg(debug_identifier, message)
                 return BaseResponse(**{"status": message})
-            updated_user.discord_username = new_discord_username
+            values["discord_username"] = new_discord_username
         if pin:
-            updated_user.pin = pin
+            values["pin"] = await UserController.encrypt_pin(pin)
         if balance:
-            updated_user.balance = balance
+            values["balance"] = balance
+        if not values:
+            message = "Nothing to update"
+            Debug.msg(debug_identifier, message)
+            return BaseResponse(**{"status": message})
 
-        user = await UserController.update_by_discord_username(discord_username, updated_user, balance)
-        if not user:
-            Debug.msg(debug_identifier, "User not found")
-            return BaseResponse(**{"status": "User not found"})
+        matched, user = await UserController.update_by_discord_username(discord_username, values)
+        if not matched:
+            message = "User does not exist"
+            Debug.msg(debug_identifier, message)
+            return BaseResponse(**{"status": message})
 
+        # Without UPDATE .. RETURNING only the changed columns are sent back
+        user = user if user is not None else {key: value for key, value in values.items() if key != "pin"}
         return BaseResponse(**{"status": "Success", "content": user})
 
     except Exception as e:
@@ -163,13 +166,10 @@ async def update_by_username(discord_username: str, new_discord_username:Optiona
 async def delete_by_id(id: int):
     debug_identifier = "UserRoute|delete_by_id"
     try:
-        user = await UserController.get_by_id(id)
-        if not user:
+        if not await UserController.delete_by_id(id):
             message = "User does not exist"
             Debug.msg(debug_identifier, message)
             return BaseResponse(**{"status": message})
-        
-        await UserController.delete_by_id(id)
 
         message = "Delete action successful"
         Debug.msg(debug_identifier, message)
@@ -184,22 +184,15 @@ async def delete_by_id(id: int):
 async def delete_by_username(target_username: str):
     debug_identifier = "UserRoute|delete_by_username"
     try:
-        user = await UserController.get_by_discord_username(target_username)
-        if not user:
+        if not await UserController.delete_by_discord_username(target_username):
             message = "User does not exist"
             Debug.msg(debug_identifier, message)
             return BaseResponse(**{"status": message})
 
-        deleted = await UserController.delete_by_discord_username(target_username)
-        if not deleted:
-            message = "Failed to delete user"
-            Debug.msg(debug_identifier, message)
-            return BaseResponse(**{"status": message})
-
         message = "Delete action successful"
         Debug.msg(debug_identifier, message)
         return BaseResponse(**{"status": "Success", "content": message})
 
     except Exception as e:
         Debug.msg(debug_identifier, "Exception Raised: {}".format(e))
-        return BaseResponse(**{"status": "Server error"})
+        return BaseResponse(**{"status": "Server error"})
\ No newline at end of file
@@ -1,6 +1,6 @@
-import sys, time
+import io, os, csv, sys, time, json, queue, atexit, random, threading
 from enum import Enum
-from typing import Any
+from typing import Any, Iterable, Iterator
 from datetime import datetime, timedelta, date
 
 class Util:
@@ -10,6 +10,48 @@ class Util:
             time.strftime("%H:%M:%S", time.localtime())
         )
 
+    def to_dict(obj, exclude: Iterable[str] = ()) -> dict:
+        """
+        Column values of an ORM object
+        @param obj: ORM object
+        @param exclude: Column names left out
+        @return: dict of column name and value
+        """
+        return {column.key: getattr(obj, column.key) for column in obj.__table__.columns
+                if column.key not in exclude}
+
+    def to_ndjson(rows: Iterable, exclude: Iterable[str] = ()) -> Iterator[str]:
+        """
+        Encode ORM objects or dicts as newline delimited JSON, one line per row
+        @param rows: Iterable of ORM objects or dict
+        @param exclude: Column names left out
+        @return: Generator of JSON lines
+        """
+        for row in rows:
+            if not isinstance(row, dict):
+                row = Util.to_dict(row, exclude)
+            yield json.dumps(row, default=str) + "\n"
+
+    def to_csv(rows: Iterable[dict], columns: Iterable[str]) -> Iterator[str]:
+        """
+        Encode dicts as CSV, a header line then one line per dict
+        @param rows: Iterable of dict
+        @param columns: Keys written, in order
+        @return: Generator of CSV lines
+        """
+        rows = iter(rows)
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=list(columns), extrasaction="ignore")
+        writer.writeheader()
+        while True:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            row = next(rows, None)
+            if row is None:
+                return
+            writer.writerow(row)
+
 class DebugLevel(Enum):
     INFO = "INFO"
     WARNING = "WARNING"
@@ -17,37 +59,167 @@ class DebugLevel(Enum):
     CRITICAL = "CRITICAL"
 
 
+# Records below this level are dropped before they are formatted
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+if LOG_LEVEL not in DebugLevel.__members__:
+    raise RuntimeError("Unknown LOG_LEVEL '{}', expected one of {}".format(
+        LOG_LEVEL, ", ".join(DebugLevel.__members__)))
+
+# "json" writes one JSON object per line, "text" the [identifier][time][level] lines
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+
+# Share of the INFO records written, 0.1 keeps about one in ten
+LOG_INFO_SAMPLE = float(os.environ.get("LOG_INFO_SAMPLE", 1))
+
+# Records waiting for the writer thread, new ones are dropped when it is full
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+# Records formatted and written per write call at most
+_WRITE_BATCH = 500
+
+_LEVEL_RANK = {DebugLevel.INFO: 0, DebugLevel.WARNING: 1, DebugLevel.ERROR: 2, DebugLevel.CRITICAL: 3}
+
+
 class __Debug:
-    def __init__(self):
-        ...
+    """
+    Logger behind Debug.msg. A call only filters by level, samples INFO
+    records and queues the raw record; a writer thread formats the queued
+    records (JSON lines or text) and writes them in batches, so a route
+    never waits on stdout. INFO and WARNING go to stdout, ERROR and
+    CRITICAL to stderr. When the queue is full new records are dropped and
+    counted instead of blocking the caller.
+    """
+    def __init__(self, level: str = LOG_LEVEL, log_format: str = LOG_FORMAT,
+                 info_sample: float = LOG_INFO_SAMPLE, queue_size: int = LOG_QUEUE_SIZE):
+        self.min_rank = _LEVEL_RANK[DebugLevel[level]]
+        self.json = log_format == "json"
+        self.info_sample = info_sample
+        self.queue_size = queue_size
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        atexit.register(self.flush)
 
-    def msg(self, identifier: str, content: Any, debug_level: DebugLevel = DebugLevel.INFO):
-        c = None
+    def _start(self):
+        with self._lock:
+            # Once per process, a forked worker starts its own writer
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.SimpleQueue()
+            threading.Thread(target=self._write, args=(self._queue,),
+                             name="budgetdiary-log", daemon=True).start()
+            self._pid = os.getpid()
+
+    def msg(self, identifier: str, content: Any, debug_level: DebugLevel = DebugLevel.INFO, **fields):
+        rank = _LEVEL_RANK[debug_level]
+        if rank < self.min_rank:
+            return
+        if rank == 0 and self.info_sample < 1 and random.random() >= self.info_sample:
+            self.sampled_out += 1
+            return
+
+        if self._pid != os.getpid():
+            self._start()
+        if self._queue.qsize() >= self.queue_size:
+            self.dropped += 1
+            return
+        self._queue.put((time.time(), identifier, content, debug_level, fields))
+
+    def _format(self, record: tuple) -> str:
+        created, identifier, content, debug_level, fields = record
         try:
             c = str(content)
-        except:
+        except Exception:
+            c = repr(content)
+
+        if self.json:
+            entry = {"time": datetime.fromtimestamp(created).isoformat(timespec="milliseconds"),
+                     "level": debug_level.value,
+                     "identifier": str(identifier),
+                     "message": c}
+            entry.update(fields)
+            return json.dumps(entry, default=str)
+
+        line = "[{}][{}][{}] {}".format(str(identifier), time.strftime("%H:%M:%S", time.localtime(created)),
+                                        str(debug_level), c)
+        return line + " " + json.dumps(fields, default=str) if fields else line
+
+    def _write(self, records: queue.SimpleQueue):
+        reported_drops = 0
+        while True:
+            batch = [records.get()]
+            while len(batch) < _WRITE_BATCH:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+            # Markers of flush(), set once the records queued before them are written
+            flushed = [record for record in batch if isinstance(record, threading.Event)]
+            if flushed:
+                batch = [record for record in batch if not isinstance(record, threading.Event)]
+
+            dropped = self.dropped
+            if dropped != reported_drops:
+                batch.append((time.time(), "Debug|msg",
+                              "{} records dropped, the log queue was full".format(dropped - reported_drops),
+                              DebugLevel.WARNING, {}))
+                reported_drops = dropped
+
+            out, err = [], []
+            for record in batch:
+                try:
+                    line = self._format(record)
+                except Exception as e:
+                    line = "[Debug|msg] Record could not be formatted: {!r}".format(e)
+                (err if _LEVEL_RANK[record[3]] >= 2 else out).append(line + "\n")
             try:
-                c = repr(content)
-            except:
-                ...
+                for stream, lines in ((sys.stdout, out), (sys.stderr, err)):
+                    if lines:
+                        stream.write("".join(lines))
+                        stream.flush()
+            except Exception:
+                # Nowhere left to report it
+                pass
+            self.written += len(batch)
+            for done in flushed:
+                done.set()
+
+    def flush(self, timeout: float = 5):
+        """
+        Wait until the records queued so far are written, for scripts and shutdown
+        @param timeout: Seconds waited at most
+        """
+        if self._pid == os.getpid():
+            done = threading.Event()
+            self._queue.put(done)
+            done.wait(timeout)
 
-        content = "[{}][{}][{}] {}".format(str(identifier), Util.get_current_strftime(), str(debug_level), c)
-        if (debug_level == DebugLevel.INFO) or (debug_level == DebugLevel.WARNING):
-            print(content, file=sys.stdout)
-        else:
-            print(content, file=sys.stderr)
+    def stats(self) -> dict:
+        """
+        Snapshot of the logger usage
+        @return: dict of queued, written, dropped and sampled out record counts
+        """
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out
+        }
 
-    def info(self, identifier: str, content: Any):
-        self.msg(identifier, content, DebugLevel.INFO)
+    def info(self, identifier: str, content: Any, **fields):
+        self.msg(identifier, content, DebugLevel.INFO, **fields)
 
-    def warning(self, identifier: str, content: Any):
-        self.msg(identifier, content, DebugLevel.WARNING)
+    def warning(self, identifier: str, content: Any, **fields):
+        self.msg(identifier, content, DebugLevel.WARNING, **fields)
 
-    def error(self, identifier: str, content: Any):
-        self.msg(identifier, content, DebugLevel.ERROR)
+    def error(self, identifier: str, content: Any, **fields):
+        self.msg(identifier, content, DebugLevel.ERROR, **fields)
 
-    def critical(self, identifier: str, content: Any):
-        self.msg(identifier, content, DebugLevel.CRITICAL)
+    def critical(self, identifier: str, content: Any, **fields):
+        self.msg(identifier, content, DebugLevel.CRITICAL, **fields)
 
 
 Debug = __Debug()
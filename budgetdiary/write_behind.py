@@ -0,0 +1,191 @@
+import os, time, asyncio
+from typing import Awaitable, Callable, List, Tuple
+
+from .__database import own_transactions
+from .utils import Debug, DebugLevel
+
+# Opt-in: Income.add and Outcome.add are queued and committed in groups
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "0").lower() in ("1", "true", "yes", "on")
+
+# A group is committed this many milliseconds after its first row was
+# queued, or as soon as it holds this many rows
+WRITE_BEHIND_INTERVAL_MS = float(os.environ.get("WRITE_BEHIND_INTERVAL_MS", 5))
+WRITE_BEHIND_MAX_ROWS = int(os.environ.get("WRITE_BEHIND_MAX_ROWS", 200))
+
+class GroupCommitQueue:
+    """
+    Write-behind queue for the inserts of concurrent requests. A background
+    task takes the rows queued within interval_ms of the first one (at most
+    max_rows) and stores them with one call of insert, in one transaction,
+    so the commit and its fsync are paid once per group instead of once per
+    row. Each caller waits for the commit of its group and gets its new id;
+    a row is never acknowledged before it is stored.
+    """
+    def __init__(self, name: str, insert: Callable[[List[Tuple[int, dict]]], Awaitable[List[int]]],
+                 enabled: bool = WRITE_BEHIND, interval_ms: float = WRITE_BEHIND_INTERVAL_MS,
+                 max_rows: int = WRITE_BEHIND_MAX_ROWS):
+        self.name = name
+        self.insert = insert
+        self.enabled = enabled
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self._loop = None
+        self._task = None
+        self._pending = []
+        self._ready = None
+        self._full = None
+        self._closing = False
+        self.groups = 0
+        self.rows = 0
+        self.max_group = 0
+        self.failures = 0
+        self.total_wait = 0.0
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        if self._pending:
+            # The previous task died with rows queued, their callers must not wait forever
+            self._fail_pending(self._task_error())
+        self._loop = loop
+        self._pending = []
+        self._ready = asyncio.Event()
+        self._full = asyncio.Event()
+        self._closing = False
+        # Started outside of the request scope, every group commits on its own
+        with own_transactions():
+            self._task = loop.create_task(self._run())
+
+    async def submit(self, user_id: int, row: dict) -> int:
+        """
+        Queue a row and wait until the group holding it is committed
+        @param user_id: The id of the User of the row
+        @param row: dict of the columns of the row
+        @return: int id of the new row
+        """
+        self._start()
+        future = self._loop.create_future()
+        self._pending.append((user_id, row, future, time.perf_counter()))
+        self._ready.set()
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+        return await future
+
+    def _task_error(self) -> BaseException:
+        task = self._task
+        if task is not None and task.done() and not task.cancelled():
+            return task.exception()
+        return None
+
+    def _fail_pending(self, error: BaseException = None):
+        """
+        Fail the futures of the rows still queued with error, or cancel them
+        """
+        pending, self._pending = self._pending, []
+        for _, _, future, _ in pending:
+            if future.done():
+                continue
+            try:
+                if error is None:
+                    future.cancel()
+                else:
+                    future.set_exception(error)
+            except RuntimeError:
+                # Future of an event loop that is already closed
+                pass
+
+    async def _run(self):
+        try:
+            await self._flush_groups()
+        except Exception as e:
+            self._fail_pending(e)
+            raise
+        except BaseException:
+            self._fail_pending()
+            raise
+
+    async def _flush_groups(self):
+        while True:
+            await self._ready.wait()
+            if not self._pending:
+                # Woken by close() with nothing left to write
+                return
+            if len(self._pending) < self.max_rows and not self._closing:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            group = self._pending[:self.max_rows]
+            del self._pending[:self.max_rows]
+            if not self._pending and not self._closing:
+                self._ready.clear()
+            if len(self._pending) < self.max_rows:
+                self._full.clear()
+            await self._commit(group)
+
+    async def _commit(self, group: list):
+        try:
+            await self._commit_group(group)
+        finally:
+            # Cancelled or interrupted before an outcome was set
+            for _, _, future, _ in group:
+                if not future.done():
+                    future.cancel()
+
+    async def _commit_group(self, group: list):
+        try:
+            ids = await self.insert([(user_id, row) for user_id, row, _, _ in group])
+        except Exception as e:
+            self.failures += 1
+            if len(group) > 1:
+                # One bad row must not fail the others, retry them one by one
+                Debug.msg("GroupCommitQueue|{}".format(self.name),
+                          "Group of {} rows failed, committing them one by one: {}".format(len(group), e),
+                          DebugLevel.WARNING)
+                for item in group:
+                    await self._commit([item])
+                return
+            _, _, future, _ = group[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+
+        now = time.perf_counter()
+        self.groups += 1
+        self.rows += len(group)
+        self.max_group = max(self.max_group, len(group))
+        for (_, _, future, queued), new_id in zip(group, ids):
+            self.total_wait += now - queued
+            if not future.done():
+                future.set_result(new_id)
+
+    async def close(self):
+        """
+        Commit the rows still queued and stop the background task
+        """
+        task = self._task
+        if task is None or task.done():
+            return
+        self._closing = True
+        self._ready.set()
+        self._full.set()
+        await task
+        self._task = None
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the queue usage
+        @return: dict of group, row, failure and wait figures
+        """
+        return {
+            "enabled": self.enabled,
+            "pending": len(self._pending),
+            "groups": self.groups,
+            "rows": self.rows,
+            "avg_group": self.rows / self.groups if self.groups else 0.0,
+            "max_group": self.max_group,
+            "failures": self.failures,
+            "avg_wait": self.total_wait / self.rows if self.rows else 0.0
+        }
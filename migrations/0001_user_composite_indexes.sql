@@ -0,0 +1,22 @@
+-- Composite indexes led by user_id for the ledger tables, so the user scoped
+-- date range and category queries become index range scans.
+-- The single column user_id indexes are covered by the new ones.
+
+ALTER TABLE `income`
+    ADD INDEX `ix_income_user_date_created` (`user_id`, `date_created`),
+    ADD INDEX `ix_income_user_category_date_created` (`user_id`, `income_category_id`, `date_created`);
+
+ALTER TABLE `outcome`
+    ADD INDEX `ix_outcome_user_date_created` (`user_id`, `date_created`),
+    ADD INDEX `ix_outcome_user_category_date_created` (`user_id`, `outcome_category_id`, `date_created`);
+
+ALTER TABLE `outcome_plan`
+    ADD INDEX `ix_outcome_plan_user_date_created` (`user_id`, `date_created`),
+    ADD INDEX `ix_outcome_plan_user_category_date_created` (`user_id`, `outcome_category_id`, `date_created`);
+
+ALTER TABLE `saving`
+    ADD INDEX `ix_saving_user_date_created` (`user_id`, `date_created`);
+
+-- Drop the old single column indexes once the ones above exist, e.g.
+-- ALTER TABLE `income` DROP INDEX `user_id`;
+-- (check the actual names with SHOW INDEX FROM `income`)
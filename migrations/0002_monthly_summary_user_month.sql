@@ -0,0 +1,23 @@
+-- One monthly_summary row per user and month (month is YYYYMM), kept up to
+-- date by the ledger writes with INSERT ... ON DUPLICATE KEY UPDATE.
+-- The unique index is the key of that upsert and also covers user_id.
+
+ALTER TABLE `monthly_summary`
+    ADD UNIQUE INDEX `ux_monthly_summary_user_month` (`user_id`, `month`);
+
+-- Backfill the totals from the existing ledger rows. Run it once, before the
+-- application starts writing deltas.
+DELETE FROM `monthly_summary`;
+
+INSERT INTO `monthly_summary` (`user_id`, `month`, `total_income`, `total_outcome`)
+SELECT `user_id`, `month`, SUM(`total_income`), SUM(`total_outcome`)
+FROM (
+    SELECT `user_id`, EXTRACT(YEAR_MONTH FROM `date_created`) AS `month`,
+           `amount` AS `total_income`, 0 AS `total_outcome`
+    FROM `income`
+    UNION ALL
+    SELECT `user_id`, EXTRACT(YEAR_MONTH FROM `date_created`) AS `month`,
+           0 AS `total_income`, `amount` AS `total_outcome`
+    FROM `outcome`
+) AS `ledger`
+GROUP BY `user_id`, `month`;
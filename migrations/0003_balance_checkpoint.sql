@@ -0,0 +1,17 @@
+-- Per user month end cumulative totals of income, outcome and outcome_plan
+-- (bucketed by date_created), so the balance before a date is one checkpoint
+-- lookup plus the rows of that month.
+-- Fill it afterwards with: python -m budgetdiary.rebuild_checkpoints
+
+CREATE TABLE `balance_checkpoint` (
+    `id` INT(11) NOT NULL AUTO_INCREMENT,
+    `user_id` INT(11) NOT NULL,
+    `month` INT(11) NOT NULL,
+    `total_income` DECIMAL(14,2) NOT NULL DEFAULT 0.00,
+    `total_outcome` DECIMAL(14,2) NOT NULL DEFAULT 0.00,
+    `total_outcome_plan` DECIMAL(14,2) NOT NULL DEFAULT 0.00,
+    `date_created` DATETIME NOT NULL DEFAULT current_timestamp(),
+    PRIMARY KEY (`id`, `user_id`),
+    UNIQUE INDEX `ux_balance_checkpoint_user_month` (`user_id`, `month`),
+    CONSTRAINT `balance_checkpoint_ibfk_1` FOREIGN KEY (`user_id`) REFERENCES `user` (`id`)
+);
@@ -0,0 +1,9 @@
+-- User registration is a single INSERT that relies on this index to reject
+-- a discord username that is already taken (see User.add).
+-- Databases created from the original dump already have it, check with
+--   SHOW INDEX FROM `user` WHERE Column_name = 'discord_username';
+-- and only run the statement below when no unique index is listed.
+-- Duplicate usernames have to be merged or renamed first.
+
+ALTER TABLE `user`
+    ADD UNIQUE INDEX `discord_username` (`discord_username`);
@@ -0,0 +1,16 @@
+-- user.balance is now kept by the server: every Income and Outcome add,
+-- update and delete adds its amount to it in the same transaction
+-- (balance = balance + delta). The balance the bot kept so far is left as it
+-- is, the part the ledger rows do not explain (the opening balance and the
+-- corrections made by hand) is stored in opening_balance, so that
+--   balance = opening_balance + SUM(income.amount) - SUM(outcome.amount)
+-- Run it with the bot stopped, when deploying the server release that keeps
+-- the balance.
+
+ALTER TABLE `user`
+    ADD COLUMN `opening_balance` DECIMAL(12,2) NOT NULL DEFAULT 0.00 AFTER `balance`;
+
+UPDATE `user` u
+SET u.opening_balance = u.balance - (
+      COALESCE((SELECT SUM(i.amount) FROM `income` i WHERE i.user_id = u.id), 0)
+    - COALESCE((SELECT SUM(o.amount) FROM `outcome` o WHERE o.user_id = u.id), 0));